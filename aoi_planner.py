@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Queries for many areas of interest (AOIs) at once.
+
+The AOIs are read from a GeoJSON file (e.g. userfiles/polygon.geojson, one
+feature per AOI). Running one query per AOI would return the same Sentinel-1
+frames many times, so the queries are planned first:
+    - AOIs closer than `merge_distance` are merged, the convex hull of every
+      group is used as the footprint of a single query
+    - footprints larger than `max_extent` (degrees) are split into tiles
+    - the queries run concurrently (see query_engine.py for the windows and
+      the cache of a single query)
+    - results are deduplicated by UUID and every product is mapped back to
+      the AOIs its footprint intersects (STRtree spatial index)
+"""
+
+import json
+import logging
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from shapely import wkt
+from shapely.geometry import shape, box
+from shapely.ops import unary_union
+from shapely.strtree import STRtree
+
+
+def read_aois(path):
+    """List of (name, geometry) from a GeoJSON file.
+
+    The name is taken from the 'name' or 'id' property of a feature, otherwise
+    the features are numbered.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if data.get("type") == "FeatureCollection":
+        features = data["features"]
+    elif data.get("type") == "Feature":
+        features = [data]
+    else:
+        features = [{"type": "Feature", "properties": {}, "geometry": data}]
+    aois = []
+    for i, feature in enumerate(features):
+        props = feature.get("properties") or {}
+        name = str(props.get("name", props.get("id", f"aoi_{i}")))
+        aois.append((name, shape(feature["geometry"])))
+    return aois
+
+
+def _query_tree(tree, geoms, geom):
+    """Indices of `geoms` whose bounding boxes intersect `geom`."""
+    hits = tree.query(geom)
+    if len(hits) == 0:
+        return []
+    # Shapely >= 2.0 returns indices, older versions the geometries
+    if hasattr(hits[0], "geom_type"):
+        index = {id(g): i for i, g in enumerate(geoms)}
+        return [index[id(g)] for g in hits]
+    return [int(i) for i in hits]
+
+
+def merge_aois(aois, merge_distance=0.1):
+    """Group AOIs closer than `merge_distance`, return lists of indices."""
+    geoms = [geom for _, geom in aois]
+    tree = STRtree(geoms)
+    # Union-find over pairs of neighbouring AOIs
+    parent = list(range(len(geoms)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, geom in enumerate(geoms):
+        for j in _query_tree(tree, geoms, geom.buffer(merge_distance)):
+            if j != i and geom.distance(geoms[j]) <= merge_distance:
+                parent[root(i)] = root(j)
+
+    groups = OrderedDict()
+    for i in range(len(geoms)):
+        groups.setdefault(root(i), []).append(i)
+    return list(groups.values())
+
+
+def tile(geom, max_extent):
+    """Split a geometry into parts with bounding boxes of max. `max_extent`."""
+    minx, miny, maxx, maxy = geom.bounds
+    if maxx - minx <= max_extent and maxy - miny <= max_extent:
+        return [geom]
+    tiles = []
+    x = minx
+    while x < maxx:
+        y = miny
+        while y < maxy:
+            part = geom.intersection(box(x, y, x + max_extent, y + max_extent))
+            if not part.is_empty:
+                tiles.append(part.convex_hull)
+            y += max_extent
+        x += max_extent
+    return tiles
+
+
+class QueryPlanner:
+    """Plan and run the queries for a list of AOIs.
+
+    Parameters
+    ----------
+    engine : QueryEngine
+        Engine used for the single queries (see query_engine.py).
+    aois : list of (str, geometry)
+        Named AOIs, e.g. from `read_aois()`.
+    merge_distance : float
+        AOIs closer than this (degrees) are queried together.
+    max_extent : float
+        Maximum width and height (degrees) of a query footprint.
+    workers : int
+        Number of queries running at the same time.
+    """
+
+    def __init__(self, engine, aois, merge_distance=0.1, max_extent=5.0, workers=4):
+        self.engine = engine
+        self.aois = list(aois)
+        self.merge_distance = merge_distance
+        self.max_extent = max_extent
+        self.workers = workers
+        self._geoms = [geom for _, geom in self.aois]
+        self._tree = STRtree(self._geoms)
+
+    def footprints(self):
+        """Footprints of the planned queries."""
+        footprints = []
+        for group in merge_aois(self.aois, self.merge_distance):
+            hull = unary_union([self._geoms[i] for i in group]).convex_hull
+            footprints += tile(hull, self.max_extent)
+        logging.info(f"Query plan: {len(self.aois)} AOIs in {len(footprints)} queries")
+        return footprints
+
+    def match(self, footprint):
+        """Names of the AOIs intersecting a product footprint (WKT)."""
+        geom = wkt.loads(footprint)
+        return [
+            self.aois[i][0] for i in _query_tree(self._tree, self._geoms, geom)
+            if self._geoms[i].intersects(geom)
+        ]
+
+    def products(self, start=None, end=None, **keywords):
+        """Dict {uuid: properties} of all products, sorted by 'beginposition'.
+
+        The names of the intersecting AOIs are added to the properties of
+        every product as 'aois'. Products that only intersect the merged
+        footprint but none of the AOIs are dropped.
+        """
+        def run(footprint):
+            return list(self.engine.products(footprint.wkt, start, end, **keywords))
+
+        products = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for results in executor.map(run, self.footprints()):
+                for product_id, properties in results:
+                    if product_id not in products:
+                        products[product_id] = properties
+        logging.info(f"Query plan: {len(products)} unique products found")
+
+        selected = []
+        for product_id, properties in products.items():
+            properties['aois'] = self.match(properties['footprint'])
+            if properties['aois']:
+                selected.append((product_id, properties))
+        selected.sort(key=lambda item: item[1]['beginposition'])
+        return OrderedDict(selected)
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Asynchronous HTTP client for the metadata requests to SciHUB.
+
+`SentinelAPI` sends one request at a time, so looking up the metadata of a
+long list of products costs the full latency of the hub for every product.
+The client sends the same metadata requests (query pages, OData metadata and
+status) with aiohttp:
+    - the requests run on an event loop in a background thread, the scripts
+      stay synchronous and call `client.run(client.<request>(...))`
+    - the connections are pooled and kept alive between the calls
+    - at most `concurrency` requests are sent at the same time
+    - metadata of many products is requested in batches of `batch_size`
+      UUIDs per OData filter query (see also lta_status.py), and all batches
+      are sent at once
+One client is kept per account (`for_api()`). The package `aiohttp` is
+optional; without it `for_api()` returns None and the scripts send the
+requests one by one with the API as before. LTA triggers and downloads are
+always sent with the API (see rate_limiter.py and dwn_engine.py).
+"""
+
+import asyncio
+import atexit
+import logging
+import threading
+
+from time import perf_counter
+from urllib.parse import quote, urljoin
+from sentinelsat import SentinelAPIError
+# Parser of the OData entries of SentinelAPI.get_product_odata(), sentinelsat
+# has no public function for the entries of a batched query
+from sentinelsat.sentinel import _parse_odata_response
+from metrics import metrics
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+CONCURRENCY = 8  # requests sent at the same time
+BATCH_SIZE = 20  # UUIDs in one OData filter query (length of the URL)
+KEEPALIVE = 60  # seconds an idle connection is kept open
+
+
+async def _check(response):
+    """Raise SentinelAPIError for an error response of the hub."""
+    if response.status < 400:
+        return
+    msg = response.headers.get('cause-message')
+    if not msg:
+        msg = (await response.text())[:200] or response.reason
+    raise SentinelAPIError(f"{response.status}: {msg}")
+
+
+class AsyncClient:
+    """Pooled asynchronous requests with the account of an API.
+
+    Parameters
+    ----------
+    api : SentinelAPI
+        API of the account (its api_url, credentials and timeout are used).
+    concurrency : int
+        Maximum number of requests (and open connections) at the same time.
+    batch_size : int
+        Number of UUIDs in a single OData filter query.
+    keepalive : float
+        Seconds an idle connection is kept open for the next request.
+    """
+
+    def __init__(self, api, concurrency=CONCURRENCY, batch_size=BATCH_SIZE,
+                 keepalive=KEEPALIVE):
+        if aiohttp is None:
+            raise ImportError("The asynchronous client needs the aiohttp package")
+        self.api = api
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.keepalive = keepalive
+        self.session = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self.run(self._open())
+
+    async def _open(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency,
+                                         keepalive_timeout=self.keepalive)
+        auth = self.api.session.auth
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            auth=aiohttp.BasicAuth(*auth) if auth else None,
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=self.api.timeout)
+        )
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    def run(self, coro):
+        """Run a coroutine of the client and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def close(self):
+        if self.session is None:
+            return
+        self.run(self.session.close())
+        self.session = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def _url(self, path):
+        return urljoin(self.api.api_url, path)
+
+    def _search_url(self, limit, offset=0, order_by=None):
+        # OpenSearch URL of SentinelAPI.query(), pages of at most page_size
+        url = f"search?format=json&rows={min(limit, self.api.page_size)}&start={offset}"
+        if order_by:
+            url += f"&orderby={order_by}"
+        return self._url(url)
+
+    def _batches(self, product_ids):
+        product_ids = list(dict.fromkeys(product_ids))
+        return [product_ids[i:i + self.batch_size]
+                for i in range(0, len(product_ids), self.batch_size)]
+
+    async def _get_json(self, url, kind):
+        async with self._semaphore:
+            start = perf_counter()
+            async with self.session.get(url) as r:
+                await _check(r)
+                data = await r.json(content_type=None)
+            metrics.observe('async_request_seconds', perf_counter() - start, kind=kind)
+        return data
+
+    # Queries
+    # =======
+    async def query_page(self, query, limit, offset=0, order_by=None):
+        """Raw entries of one page of an OpenSearch query and the total count."""
+        url = self._search_url(limit, offset, order_by)
+        async with self._semaphore:
+            start = perf_counter()
+            async with self.session.post(url, data={'q': query}) as r:
+                await _check(r)
+                feed = (await r.json(content_type=None))['feed']
+            metrics.observe('async_request_seconds', perf_counter() - start, kind='query')
+        if feed['opensearch:totalResults'] is None:
+            raise SentinelAPIError('Invalid query string. Check the parameters and format.')
+        entries = feed.get('entry', [])
+        # A single product is returned as a dict
+        if isinstance(entries, dict):
+            entries = [entries]
+        return entries, int(feed['opensearch:totalResults'])
+
+    async def query_pages(self, query, offsets, limit, order_by=None):
+        """Raw entries of the pages at `offsets`, all requested at once."""
+        pages = await asyncio.gather(*(
+            self.query_page(query, limit, offset, order_by) for offset in offsets
+        ))
+        return [entries for entries, _ in pages]
+
+    # Metadata
+    # ========
+    async def odata(self, product_id):
+        """Metadata of a product with `api.get_product_odata()` (in a thread
+        of the event loop)."""
+        async with self._semaphore:
+            start = perf_counter()
+            info = await self._loop.run_in_executor(
+                None, self.api.get_product_odata, product_id)
+            metrics.observe('async_request_seconds', perf_counter() - start, kind='odata')
+        return info
+
+    async def _filter(self, product_ids, select=None):
+        filt = " or ".join(f"Id eq '{pid}'" for pid in product_ids)
+        url = self._url(f"odata/v1/Products?$format=json&$top={len(product_ids)}"
+                        f"&$filter={quote(filt)}")
+        if select is not None:
+            url += f"&$select={select}"
+        return (await self._get_json(url, 'odata_batch'))['d']['results']
+
+    async def _odata_batch(self, product_ids):
+        try:
+            results = await self._filter(product_ids)
+            return {item['Id']: _parse_odata_response(item) for item in results}
+        except (SentinelAPIError, aiohttp.ClientError, KeyError, ValueError) as e:
+            # Fall back to one request per product for this batch
+            logging.warning(f"Batched metadata query failed ({e}), "
+                            f"fetching products one by one")
+        infos = await asyncio.gather(*(self.odata(pid) for pid in product_ids),
+                                     return_exceptions=True)
+        result = {}
+        for pid, info in zip(product_ids, infos):
+            if isinstance(info, Exception):
+                logging.warning(f"Could not get the metadata of {pid}: {info}")
+            else:
+                result[pid] = info
+        return result
+
+    async def odata_many(self, product_ids):
+        """Dict {uuid: metadata} of many products (missing if not found)."""
+        result = {}
+        for batch in await asyncio.gather(*(
+            self._odata_batch(batch) for batch in self._batches(product_ids)
+        )):
+            result.update(batch)
+        metrics.inc('async_odata_products_total', len(result))
+        return result
+
+    async def _status_batch(self, product_ids):
+        try:
+            results = await self._filter(product_ids, 'Id,Online')
+            return {item['Id']: bool(item['Online']) for item in results}
+        except (SentinelAPIError, aiohttp.ClientError, KeyError, ValueError) as e:
+            metrics.inc('status_poll_errors_total')
+            logging.warning(f"Batched status query failed ({e}), "
+                            f"checking products one by one")
+        infos = await self._odata_batch(product_ids)
+        return {pid: info['Online'] for pid, info in infos.items()}
+
+    async def status(self, product_ids):
+        """Dict {uuid: Online} of many products (missing if not found)."""
+        result = {}
+        for batch in await asyncio.gather(*(
+            self._status_batch(batch) for batch in self._batches(product_ids)
+        )):
+            result.update(batch)
+        return result
+
+
+# Clients shared by all code paths in the process, one per account
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def for_api(api):
+    """Client of the account of `api` (None if aiohttp is not installed)."""
+    if aiohttp is None:
+        return None
+    auth = api.session.auth
+    key = (api.api_url, auth[0] if auth else None)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = AsyncClient(api)
+        return _clients[key]
+
+
+@atexit.register
+def close_all():
+    """Close the connections of all clients."""
+    with _clients_lock:
+        for client in _clients.values():
+            try:
+                client.close()
+            except Exception as e:
+                logging.debug(f"Could not close the client: {e}")
+        _clients.clear()
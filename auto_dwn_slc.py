@@ -7,22 +7,99 @@ Created on Thu Oct 17 14:58:32 2019
 
 IMPORTANT: Set your SciHUB account credentials in apihub.txt!
 
-- The script downloads Sentinel products based on a query.
+- The script downloads Sentinel products based on a query (fetched in time
+windows and cached on disk, see query_engine.py), either for a single
+footprint or for several AOIs from a GeoJSON file (see aoi_planner.py).
 - Only works for 'Online' products. Archived products (in LTA) have to be
 retrieved and downloaded using the *_LTA.py scripts instead.
+- Several products are downloaded at the same time (`workers` parameter),
+spread over all accounts in apihub.txt (see credentials.py).
+- Interrupted downloads are resumed with HTTP Range requests (dwn_engine.py).
+- Products can also be streamed straight to a file share or to an
+S3-compatible object store (see sinks.py), or only selected files of the
+products can be extracted during the download (see safe_extract.py).
+- Downloaded products are tracked in a SQLite catalog (catalog.py), which is
+built from the download folder on the first run and updated after every
+download.
+- The transfer rate of all downloads can be limited, with different limits
+at different times of day, and the products can be downloaded in a given
+order, e.g. smallest first (see bandwidth.py).
+- Products that were already downloaded for another project (download
+folder) are linked from a shared store instead of downloaded again (see
+content_store.py).
+- The products are selected from the query results by orbit, polarisation,
+size and coverage of the AOIs, without reprocessed duplicates (see
+selection.py).
 """
 
 import logging
 import sys
-from os import walk
-from datetime import datetime
 from collections import OrderedDict
+from datetime import datetime
 from shapely.geometry import box
-from sentinelsat import SentinelAPI, InvalidChecksumError, SentinelAPILTAError
+from credentials import CredentialPool
+from query_engine import QueryEngine
+from aoi_planner import QueryPlanner, read_aois
+from dwn_pool import download_pool
+from catalog import Catalog
+from sinks import open_sink
+from content_store import ContentStore
+from selection import select_products
+from metrics import metrics
+import bandwidth
 # from sentinelsat import read_geojson, geojson_to_wkt
 
 
-def main(dwndir, logpath, apipath, qp):
+def download_products(pool, cat, titles, dwndir, workers=4, segments=1,
+                      store=None):
+    """Download products (dict {uuid: title}) and record them in the catalog.
+
+    Products held by the content `store` are linked instead of downloaded.
+    Returns the set of UUIDs that could not be downloaded and the last
+    exception raised by a failed download.
+    """
+    # Set some parameters
+    max_attempts = 10
+    checksum = True
+
+    # Link the products that were downloaded into another download folder
+    if store is not None:
+        sink = open_sink(dwndir)
+        titles = OrderedDict(titles)
+        for product_id, title in list(titles.items()):
+            product_info = store.link(product_id, sink.url(title + '.zip'))
+            if product_info is not None:
+                cat.mark_done(product_info)
+                del titles[product_id]
+
+    def on_done(product_info):
+        # Offline products are only triggered, not downloaded, they are kept
+        # in the catalog to be checked again (see dwn_daemon.py)
+        if product_info['Online']:
+            cat.mark_done(product_info)
+            if store is not None:
+                store.add(product_info)
+        else:
+            cat.mark_offline(product_info)
+
+    # Main loop for downloading (bounded pool of concurrent workers)
+    return_values, failed, last_exception = download_pool(
+        pool.api, list(titles), dwndir, titles,
+        workers=workers,
+        checksum=checksum,
+        max_attempts=max_attempts,
+        segments=segments,
+        on_done=on_done,
+        pool=pool
+    )
+    for product_id in failed:
+        cat.mark_failed(product_id, titles[product_id])
+    return failed, last_exception
+
+
+def main(dwndir, logpath, apipath, qp, workers=4, segments=1, catpath=None,
+         cachedir=None, metpath=None, bw=None, stream=False, extract=None,
+         storepath=None, sel=None):
     # Configure file for logging
     # ==========================
     logging.basicConfig(
@@ -35,117 +112,99 @@ def main(dwndir, logpath, apipath, qp):
         f.write(loghead)
     logging.info('Started auto_dwn_slc.py')
 
-    # Read password file
-    # ==================
+    # Timings and counters of all stages (see metrics.py)
+    metrics.configure(metpath)
+
+    # Bandwidth limit shared by all downloads (see bandwidth.py)
+    bw = bw if bw is not None else {}
+    bandwidth.limiter.configure(bw.get('rate'), bw.get('windows'))
+
+    # Output sink: folder, file share or object store (see sinks.py), or only
+    # the selected files of the products (see safe_extract.py)
+    dwndir = open_sink(dwndir, stream, extract)
+
+    # Products shared with the download folders of other projects (see
+    # content_store.py)
+    store = ContentStore(storepath) if storepath is not None else None
+
+    # Read password file (one or more accounts)
+    # ==========================================
     try:
-        with open(apipath) as f:
-            (usrnam, psswrd) = f.readline().split(" ")
-            if psswrd.endswith("\n"):
-                psswrd = psswrd[:-1]
+        pool = CredentialPool.from_file(apipath)
     except IOError:
         logging.error("Error reading the password file!")
         sys.exit("Error reading the password file!")
 
     # Connect to API using <username> and <password>
     # ===============================================
-    print("Connecting to SciHub API...")
-    api = SentinelAPI(usrnam, psswrd, "https://scihub.copernicus.eu/dhus")
+    print(f"Connecting to SciHub API with {len(pool)} account(s)...")
+    api = pool.api
 
     # Search by SciHub query keywords
     # ===============================
-    products = api.query(qp['footprint'],
-                         beginposition=(qp['strtime'], qp['endtime']),
-                         endposition=(qp['strtime'], qp['endtime']),
-                         platformname=qp['platformname'],
-                         producttype=qp['producttype'])
-
-    # Create list of files for download
-    # =================================
-    fresh_products = []
-    for item_key in products.keys():
-        item = products[item_key]
-        fresh_products.append(item['title'])
-
-    # List of already downloaded items
-    already_downloaded = []
-
-    # r=root, d=directories, f=files
-    for r, d, f in walk(dwndir):
-        for file in f:
-            if ".zip" in file and ".incomplete" not in file:
-                already_downloaded.append(file[:-4])
-
-    # Find all files that haven not been downloaded yet (by filename)
-    new_files = set(fresh_products) - set(already_downloaded)
-    for_download = list(new_files)
-
-    # Get UUID-s of the files for download
-    uuid_list = []
-    for item_key in products.keys():
-        item = products[item_key]
-        if item['title'] in for_download:
-            uuid_list.append(item['uuid'])
+    # Only the properties needed for the download order are kept
+    engine = QueryEngine(api, cachedir)
+    keywords = dict(endposition=(qp['strtime'], qp['endtime']),
+                    platformname=qp['platformname'],
+                    producttype=qp['producttype'])
+    if qp.get('aois'):
+        planner = QueryPlanner(engine, read_aois(qp['aois']))
+        results = planner.products(qp['strtime'], qp['endtime'], **keywords).items()
+    else:
+        results = engine.products(qp['footprint'], qp['strtime'], qp['endtime'],
+                                  **keywords)
+    # Keep only the products that are needed (see selection.py)
+    if sel:
+        aois = planner.aois if qp.get('aois') else [('footprint', qp['footprint'])]
+        results = select_products(results, aois, **sel).items()
+    products = OrderedDict(
+        (product_id, {key: properties.get(key)
+                      for key in ('title', 'size', 'beginposition')})
+        for product_id, properties in results
+    )
+
+    # Find all files that have not been downloaded yet
+    # ================================================
+    # The catalog of downloaded files is created by walking the download
+    # folder once and walked again only if files were added to the folder
+    # since the last run (or on every run if no catalog file is used)
+    cat = Catalog(catpath if catpath is not None else ':memory:')
+    cat.refresh(dwndir)
+    uuid_list = cat.missing(products)
 
     # Download files from the list
     # ============================
     # Check if there were any new files found, otherwise skip download
     if len(uuid_list) > 0:
-        logging.info("{len(uuid_list)} files selected for download!")
-        # Set some parameters
-        max_attempts = 10
-        checksum = True
-        # Set for catching errors
-        return_values = OrderedDict()
-        last_exception = None
-
-        # Main loop for downloading
-        for i, product_id in enumerate(uuid_list):
-            logging.info(f"Start download {i + 1} of {len(uuid_list)}")
-
-            # For multiple attempts of loading the same file
-            for att_num in range(max_attempts):
-                try:
-                    product_info = api.download(product_id, dwndir, checksum)
-                    return_values[product_id] = product_info
-                    break
-                except (KeyboardInterrupt, SystemExit):
-                    raise
-                except InvalidChecksumError as e:
-                    last_exception = e
-                    logging.warning(
-                        "Invalid checksum. The downloaded file for"
-                        f" '{products[product_id]['title']}' is corrupted."
-                    )
-                except SentinelAPILTAError as e:
-                    last_exception = e
-                    logging.warning(
-                        f"There was an error retrieving"
-                        f" '{products[product_id]['title']}' from the LTA"
-                    )
-                    break
-                except Exception as e:
-                    last_exception = e
-                    logging.warning(
-                        "There was an error downloading %s"
-                        f" '{products[product_id]['title']}'."
-                    )
-            # Log the number of the file that was just downloaded
-            logging.info(f"{i + 1}/{len(uuid_list)} products downloaded")
+        logging.info(f"{len(uuid_list)} files selected for download!")
+        missing = OrderedDict((pid, products[pid]) for pid in uuid_list)
+        titles = OrderedDict(
+            (pid, products[pid]['title'])
+            for pid in bandwidth.order_products(missing, bw.get('order'))
+        )
+        failed, last_exception = download_products(pool, cat, titles, dwndir,
+                                                   workers, segments, store)
+
+        # The new files are in the catalog already
+        cat.mark_scanned(dwndir)
 
         # If all downloads fail raise exception
-        failed = set(uuid_list) - set(return_values)
         if len(failed) == len(uuid_list) and last_exception is not None:
             raise last_exception
     else:
         # If no new files were found
         logging.info("No new files found!")
 
+    cat.close()
+    if store is not None:
+        store.close()
+    metrics.close()
     logging.info('The script has finished!')
     logging.shutdown()
 
 
 if __name__ == "__main__":
-    # Download folder
+    # Download folder (or 's3://<bucket>/<prefix>' for an object store)
     dwn_pth = 'R:\\Sentinel-1_SLC\\'
 
     # Path to log file
@@ -154,6 +213,12 @@ if __name__ == "__main__":
     # Path to file with SciHub credentials
     api_pth = ".\\userfiles\\apihub.txt"
 
+    # Path to the catalog of downloaded products (created on first run)
+    cat_pth = ".\\userfiles\\catalog.sqlite"
+
+    # Folder for cached query results
+    cache_pth = ".\\userfiles\\query_cache"
+
     # Set query parameters
     ############################################################################
     #   * (Date-type query parameter 'beginposition' expects a two-element tuple
@@ -177,12 +242,67 @@ if __name__ == "__main__":
     # pth_aoi = join(wrkdir, nam_aoi)
     # footprint = geojson_to_wkt(read_geojson(pth_aoi))
 
+    # Several AOIs from a GeoJSON file (one feature per AOI), used instead of
+    # the footprint if set (see aoi_planner.py)
+    aoi_pth = None  # ".\\userfiles\\polygon.geojson"
+
     query_params = {
         'strtime': strtime,
         'endtime': endtime,
         'platformname': platformname,
         'producttype': producttype,
-        'footprint': footprint
+        'footprint': footprint,
+        'aois': aoi_pth
+    }
+
+    # Number of products downloaded at the same time
+    max_workers = 4
+
+    # Number of byte-range segments of a single product downloaded at once
+    n_segments = 1
+
+    # Path (without extension) of the metrics files (.prom and .jsonl)
+    met_pth = ".\\userfiles\\metrics"
+
+    # Bandwidth limit of all downloads together (bytes/sec, None for no limit),
+    # time-of-day windows with their own limit and the order of the downloads
+    # ('smallest', 'largest', 'oldest', 'newest' or None for the query order)
+    # e.g. 2 MB/s during the day, no limit at night, smallest products first:
+    # {'rate': 2 * 2 ** 20, 'windows': [("20:00", "06:00", None)],
+    #  'order': 'smallest'}
+    bandwidth_params = {
+        'rate': None,
+        'windows': None,
+        'order': None
+    }
+
+    # Stream the products to the download folder in one pass (for a file
+    # share, see sinks.py), S3 URLs ('s3://<bucket>/<prefix>') are always
+    # streamed
+    stream_dwn = False
+
+    # Keep only these files of the products (glob patterns of the paths in
+    # the SAFE folder, see safe_extract.py), None for the whole zip files
+    extract_files = None  # ['manifest.safe', 'annotation/*.xml']
+
+    # Store of the products shared by the download folders of all projects,
+    # on the same disk as the download folders (hardlinks), None to download
+    # every product into every folder (see content_store.py)
+    store_pth = None  # 'R:\\.product_store\\'
+
+    # Selection of the products from the query results (see selection.py),
+    # None to download all products found by the query. All criteria are off
+    # (None or False), set the ones to use
+    selection_params = {
+        'relative_orbits': None,  # e.g. [22, 95, 146]
+        'orbit_direction': None,  # 'ASCENDING' or 'DESCENDING'
+        'polarisation': None,  # e.g. 'VV VH'
+        'max_size': None,  # e.g. '8 GB'
+        'min_coverage': None,  # share of the AOI covered by a product, e.g. 0.05
+        'drop_reprocessed': False,  # only the latest version of a product
+        'best_per_pass': False  # one product per satellite, orbit and day
     }
 
-    main(dwn_pth, log_pth, api_pth, query_params)
+    main(dwn_pth, log_pth, api_pth, query_params, max_workers, n_segments,
+         cat_pth, cache_pth, met_pth, bandwidth_params, stream_dwn, extract_files,
+         store_pth, selection_params)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Bandwidth limit shared by all downloads of the process.
+
+The uplink of the download machine is shared with other users, so the
+transfer rate of all downloads together (all workers and segments) can be
+capped:
+    - `rate` is the default limit in bytes/sec (None means no limit)
+    - `windows` are time-of-day periods with their own limit, e.g.
+      [("20:00", "06:00", None), ("06:00", "20:00", 2 * 2 ** 20)] for full
+      speed at night and 2 MB/s during working hours (a window may cross
+      midnight, the first matching window is used)
+Every downloaded block goes through `limiter.consume()` (see dwn_engine.py),
+which waits until the block fits into the limit. The waits are shared
+between the threads, so the total rate stays at the limit no matter how many
+downloads run at the same time.
+
+`order_products()` sorts the products before they are queued for download
+(e.g. smallest first), so more products are finished within an allowed
+window.
+"""
+
+import logging
+import re
+import threading
+
+from datetime import datetime, time
+from time import monotonic, sleep
+from metrics import metrics
+
+
+ORDERS = ('smallest', 'largest', 'oldest', 'newest')
+
+SIZE_UNITS = {'B': 1, 'KB': 2 ** 10, 'MB': 2 ** 20, 'GB': 2 ** 30, 'TB': 2 ** 40}
+
+
+def _parse_time(value):
+    if isinstance(value, time):
+        return value
+    hours, minutes = value.split(':')
+    return time(int(hours), int(minutes))
+
+
+def parse_windows(windows):
+    """List of (start, end, rate) with 'HH:MM' strings converted to times."""
+    if not windows:
+        return []
+    return [(_parse_time(start), _parse_time(end), rate) for start, end, rate in windows]
+
+
+def _in_window(now, start, end):
+    if start <= end:
+        return start <= now < end
+    # Window crosses midnight
+    return now >= start or now < end
+
+
+class BandwidthLimiter:
+    """Token bucket of bytes with a time-of-day dependent rate.
+
+    Parameters
+    ----------
+    rate : float, optional
+        Limit (bytes/sec) outside of all windows. No limit if None.
+    windows : list, optional
+        Tuples (start, end, rate) with the local time of day as 'HH:MM' and
+        the limit (bytes/sec, None for no limit) within the window.
+    burst : float
+        Seconds of transfer at the limit that can be sent at once.
+    """
+
+    def __init__(self, rate=None, windows=None, burst=1.):
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.configure(rate, windows)
+
+    def configure(self, rate=None, windows=None):
+        """Set the default limit and the time windows."""
+        with self.lock:
+            self.rate = rate
+            self.windows = parse_windows(windows)
+            self.tokens = 0.
+            self.stamp = monotonic()
+            self._current = None
+        if rate is not None or self.windows:
+            logging.info(f"Bandwidth limit: {self._describe(rate)}, "
+                         f"windows: {windows or []}")
+
+    @staticmethod
+    def _describe(rate):
+        return "none" if rate is None else f"{rate / 2 ** 20:.2f} MB/s"
+
+    def rate_at(self, now=None):
+        """Limit (bytes/sec or None) at the local time `now`."""
+        now = (now if now is not None else datetime.now()).time()
+        for start, end, rate in self.windows:
+            if _in_window(now, start, end):
+                return rate
+        return self.rate
+
+    def consume(self, nbytes):
+        """Wait until `nbytes` can be transferred within the limit."""
+        rate = self.rate_at() if self.windows else self.rate
+        with self.lock:
+            if rate != self._current:
+                # Start of a new window (or a new limit)
+                logging.info(f"Bandwidth limit changed to {self._describe(rate)}")
+                metrics.set('bandwidth_limit_bytes', rate if rate is not None else 0)
+                self._current = rate
+                self.tokens = 0.
+                self.stamp = monotonic()
+            if rate is None:
+                return 0.
+            now = monotonic()
+            self.tokens = min(rate * self.burst,
+                              self.tokens + (now - self.stamp) * rate)
+            self.stamp = now
+            # The bytes are taken right away, later threads wait behind them
+            self.tokens -= nbytes
+            wait = -self.tokens / rate if self.tokens < 0 else 0.
+        if wait > 0:
+            metrics.observe('bandwidth_wait_seconds', wait)
+            sleep(wait)
+        return wait
+
+
+# Limiter shared by all downloads of the process
+limiter = BandwidthLimiter()
+
+
+# Order of the downloads
+# ======================
+def size_bytes(value):
+    """Size in bytes from an int or a string such as '4.12 GB'."""
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.match(r'\s*([\d.]+)\s*([KMGT]?B)\s*$', str(value), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid size: {value}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def order_products(products, order=None):
+    """UUIDs of products (dict {uuid: properties}) in the order of download.
+
+    `order` is one of 'smallest', 'largest' (by 'size'), 'oldest', 'newest'
+    (by 'beginposition') or None to keep the order of the query. Products
+    with an unknown size or date are downloaded last.
+    """
+    if order is None:
+        return list(products)
+    if order not in ORDERS:
+        raise ValueError(f"Unknown order '{order}', expected one of {ORDERS}")
+
+    def key(product_id):
+        properties = products[product_id]
+        try:
+            if order in ('smallest', 'largest'):
+                value = size_bytes(properties['size'])
+            else:
+                value = properties['beginposition'].timestamp()
+        except (KeyError, ValueError, AttributeError):
+            return (1, 0)
+        return (0, -value if order in ('largest', 'newest') else value)
+
+    return sorted(products, key=key)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Offline benchmark of the download scripts against the mock hub (mock_dhus.py).
+
+The `main()` functions of the scripts are run one after another in a
+temporary folder, with the API pointed to a local mock server:
+    - auto_dwn_slc: query and download of all online products
+    - query_list_LTA: query of the list of products for the LTA workflow
+    - trigger_LTA: triggering all offline products (just below the mock quota)
+    - download_LTA: download of the whole list as products come online
+For every step the elapsed time, products/hour and bytes/sec are reported,
+together with the end-to-end time of the LTA backfill (query, trigger and
+download). Example:
+    python benchmark.py --products 40 --size-mb 8 --workers 4 --segments 2
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from datetime import timedelta
+from time import perf_counter
+from shapely.geometry import box
+
+import credentials
+import rate_limiter
+import auto_dwn_slc
+import query_list_LTA
+import trigger_LTA
+import download_LTA
+from mock_dhus import MockDHuS
+from query_engine import format_date
+
+
+def count_products(dwndir):
+    """Number of complete products in a folder."""
+    if not os.path.isdir(dwndir):
+        return 0
+    return len([f for f in os.listdir(dwndir) if f.endswith('.zip')])
+
+
+def run_step(name, hub, dwndir, func, *args, **kwargs):
+    """Run one script, return the measured values."""
+    hub.reset_stats()
+    # Every script starts with fresh trigger buckets of the accounts
+    rate_limiter._buckets.clear()
+    before = count_products(dwndir) if dwndir else 0
+    start = perf_counter()
+    func(*args, **kwargs)
+    seconds = perf_counter() - start
+    products = count_products(dwndir) - before if dwndir else 0
+    result = {
+        'step': name,
+        'seconds': round(seconds, 3),
+        'products': products,
+        'products_per_hour': round(products / seconds * 3600, 1),
+        'bytes': hub.stats['bytes'],
+        'bytes_per_sec': round(hub.stats['bytes'] / seconds),
+        'requests': hub.stats['requests'],
+        'triggers': hub.stats['triggers'],
+        'quota_errors': hub.stats['quota_errors'],
+    }
+    print(f"{name:15s} {seconds:8.1f} s {products:5d} products "
+          f"{result['products_per_hour']:10.0f} products/h "
+          f"{result['bytes_per_sec'] / 2 ** 20:8.1f} MB/s "
+          f"{hub.stats['requests']:6d} requests")
+    return result
+
+
+def main(n_products=40, size=4 * 2 ** 20, offline_ratio=0.5, restore_latency=2.,
+         quota=(2, 1.), accounts=2, workers=4, segments=2, bandwidth=None,
+         cut_ratio=0., workdir=None):
+    hub = MockDHuS(n_products, size, offline_ratio, restore_latency, quota,
+                   bandwidth=bandwidth, cut_ratio=cut_ratio)
+    credentials.API_URL = hub.start()
+    print(f"Mock DHuS on {credentials.API_URL}: {n_products} products of "
+          f"{size / 2 ** 20:.1f} MB, {offline_ratio:.0%} offline\n")
+
+    tmpdir = workdir if workdir is not None else tempfile.mkdtemp(prefix="scihub_bench_")
+    apipath = os.path.join(tmpdir, "apihub.txt")
+    with open(apipath, "w") as f:
+        for i in range(accounts):
+            f.write(f"bench{i} password\n")
+    logpath = os.path.join(tmpdir, "bench.log")
+    csvpath = os.path.join(tmpdir, "slc_list.csv")
+
+    # Query over the whole mock catalog
+    products = list(hub.products.values())
+    qp = {
+        'strtime': format_date(products[0].begin),
+        'endtime': format_date(products[-1].begin + timedelta(seconds=1)),
+        'platformname': 'Sentinel-1',
+        'producttype': 'SLC',
+        'footprint': box(13.0, 45.0, 17.0, 47.0),
+        'aois': None
+    }
+
+    # The LTA scripts check offline products more often than on the real hub
+    download_LTA.POLL_INTERVAL = max(restore_latency / 4, 0.1)
+
+    # Like on the real hub, the scripts trigger at a slightly lower rate than
+    # the quota: the token bucket would otherwise send a burst of triggers on
+    # top of the ones within the sliding window of the mock (403 errors)
+    script_quota = (1, quota[1] / quota[0] * 1.1)
+
+    results = []
+    try:
+        dwndir = os.path.join(tmpdir, "auto")
+        os.makedirs(dwndir, exist_ok=True)
+        results.append(run_step(
+            'auto_dwn_slc', hub, dwndir, auto_dwn_slc.main, dwndir, logpath,
+            apipath, qp, workers, segments, os.path.join(tmpdir, "catalog.sqlite"),
+            os.path.join(tmpdir, "query_cache")
+        ))
+
+        dwndir = os.path.join(tmpdir, "lta")
+        os.makedirs(dwndir, exist_ok=True)
+        backfill = [
+            run_step('query_list_LTA', hub, None, query_list_LTA.main, csvpath,
+                     apipath, qp, os.path.join(tmpdir, "query_cache_lta")),
+            # All products are triggered in one session (no download history)
+            run_step('trigger_LTA', hub, None, trigger_LTA.main, csvpath, logpath,
+                     apipath, script_quota, None, n_products),
+            run_step('download_LTA', hub, dwndir, download_LTA.main, dwndir,
+                     csvpath, logpath, apipath, segments),
+        ]
+        results += backfill
+        total = sum(r['seconds'] for r in backfill)
+        done = count_products(dwndir)
+        results.append({
+            'step': 'backfill', 'seconds': round(total, 3), 'products': done,
+            'products_per_hour': round(done / total * 3600, 1),
+        })
+        print(f"\nLTA backfill: {done} products in {total:.1f} s "
+              f"({done / total * 3600:.0f} products/h)")
+    finally:
+        hub.stop()
+        logging.shutdown()
+        if workdir is None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark against a mock SciHUB")
+    parser.add_argument("--products", type=int, default=40)
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--offline", type=float, default=0.5,
+                        help="share of the products in the LTA")
+    parser.add_argument("--restore", type=float, default=2.,
+                        help="seconds until a triggered product is online")
+    parser.add_argument("--quota", type=float, nargs=2, default=(2, 1.),
+                        metavar=("TRIGGERS", "SECONDS"))
+    parser.add_argument("--accounts", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--segments", type=int, default=2)
+    parser.add_argument("--bandwidth-mb", type=float, default=None,
+                        help="bandwidth of a single connection (MB/s)")
+    parser.add_argument("--cut", type=float, default=0.,
+                        help="share of the downloads that are cut off")
+    parser.add_argument("--workdir", default=None,
+                        help="keep the downloads and logs in this folder")
+    parser.add_argument("--json", default=None, help="write the results to a file")
+    args = parser.parse_args()
+
+    bench = main(args.products, int(args.size_mb * 2 ** 20), args.offline,
+                 args.restore, (int(args.quota[0]), args.quota[1]), args.accounts,
+                 args.workers, args.segments,
+                 args.bandwidth_mb * 2 ** 20 if args.bandwidth_mb else None,
+                 args.cut, args.workdir)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(bench, f, indent=2)
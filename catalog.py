@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Persistent catalog of downloaded products (SQLite).
+
+Products are stored by title (the file name without '.zip') and UUID,
+together with their size, MD5 checksum, path and status ('done', 'failed',
+or 'offline' and 'triggered' for products in the LTA). The catalog is
+updated as downloads complete, so the download folder does not have to be
+walked on every run. Existing archives are registered with `scan()`;
+`refresh()` scans the folder again only if it has changed since the last
+scan (modification time of the folder and of its subfolders), e.g. when
+products were copied into it by hand or by another tool.
+Small values that have to survive a restart (e.g. the ingestion date up to
+which the daemon has queried, see dwn_daemon.py) are kept in a meta table.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+
+from collections import OrderedDict
+from os.path import basename, splitext
+from datetime import datetime
+from sinks import open_sink
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    title TEXT PRIMARY KEY,
+    uuid TEXT UNIQUE,
+    size INTEGER,
+    md5 TEXT,
+    path TEXT,
+    status TEXT NOT NULL,
+    updated TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def folder_stamp(dwndir):
+    """Latest modification time (ns) of a download folder and of its
+    subfolders, None for an object store or a folder that does not exist."""
+    root = getattr(open_sink(dwndir), 'root', None)
+    if root is None or not os.path.isdir(root):
+        return None
+    stamp = os.stat(root).st_mtime_ns
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                stamp = max(stamp, entry.stat().st_mtime_ns)
+    return str(stamp)
+
+
+class Catalog:
+    """Catalog of products in a download folder.
+
+    Parameters
+    ----------
+    dbpath : str
+        Path to the SQLite database (created if missing). Use ':memory:' for
+        a catalog that only lives for the current run.
+    """
+
+    def __init__(self, dbpath=':memory:'):
+        self.dbpath = dbpath
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(dbpath, check_same_thread=False)
+        with self._con:
+            self._con.executescript(SCHEMA)
+
+    def __len__(self):
+        with self._lock:
+            return self._con.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+
+    def close(self):
+        self._con.close()
+
+    def scan(self, dwndir):
+        """Register all complete products ('.zip' files) found in `dwndir` (a
+        folder or an output sink, see sinks.py).
+
+        Files already in the catalog are left untouched. Returns the number of
+        newly registered files.
+        """
+        now = datetime.utcnow().isoformat()
+        rows = [
+            (splitext(basename(path.replace('\\', '/')))[0], path, 'done', now)
+            for path in open_sink(dwndir).paths()
+        ]
+        with self._lock, self._con:
+            before = self._con.total_changes
+            self._con.executemany(
+                "INSERT OR IGNORE INTO products (title, path, status, updated) "
+                "VALUES (?, ?, ?, ?)", rows
+            )
+            added = self._con.total_changes - before
+        logging.info(f"Catalog scan of {dwndir}: {added} new files registered")
+        return added
+
+    def refresh(self, dwndir, rescan=False):
+        """Scan `dwndir` if the catalog is empty, if the folder has changed
+        since the last scan or if `rescan` is True (an object store is only
+        scanned in the first two cases). Returns the number of newly
+        registered files."""
+        stamp = folder_stamp(dwndir)
+        key = f"scan_stamp:{open_sink(dwndir)}"
+        if not rescan and len(self) > 0 and (stamp is None or stamp == self.get_meta(key)):
+            return 0
+        added = self.scan(dwndir)
+        self.mark_scanned(dwndir, stamp)
+        return added
+
+    def mark_scanned(self, dwndir, stamp=None):
+        """Record the current state of `dwndir` as scanned, e.g. after the
+        downloads of a run, so they do not cause another scan."""
+        stamp = stamp if stamp is not None else folder_stamp(dwndir)
+        if stamp is not None:
+            self.set_meta(f"scan_stamp:{open_sink(dwndir)}", stamp)
+
+    def done(self):
+        """Return the sets of titles and UUIDs of downloaded products."""
+        with self._lock:
+            rows = self._con.execute(
+                "SELECT title, uuid FROM products WHERE status = 'done'"
+            ).fetchall()
+        titles = {row[0] for row in rows}
+        uuids = {row[1] for row in rows if row[1] is not None}
+        return titles, uuids
+
+    def missing(self, products):
+        """List of UUIDs from a query result (dict {uuid: properties}) that
+        have not been downloaded yet, in the order of the query result."""
+        titles, uuids = self.done()
+        return [
+            pid for pid, item in products.items()
+            if pid not in uuids and item['title'] not in titles
+        ]
+
+    def failed(self):
+        """Dict {uuid: title} of products whose download failed."""
+        with self._lock:
+            rows = self._con.execute(
+                "SELECT uuid, title FROM products "
+                "WHERE status = 'failed' AND uuid IS NOT NULL ORDER BY updated"
+            ).fetchall()
+        return OrderedDict(rows)
+
+    def offline(self):
+        """Dict {uuid: (title, status, updated)} of products in the LTA,
+        waiting for a trigger slot ('offline') or for the end of their
+        retrieval ('triggered'), `updated` is the UTC time of the last try."""
+        with self._lock:
+            rows = self._con.execute(
+                "SELECT uuid, title, status, updated FROM products "
+                "WHERE status IN ('offline', 'triggered') AND uuid IS NOT NULL "
+                "ORDER BY updated"
+            ).fetchall()
+        return OrderedDict(
+            (uuid, (title, status, datetime.fromisoformat(updated)))
+            for uuid, title, status, updated in rows
+        )
+
+    def get_meta(self, key, default=None):
+        """Value stored under `key` in the meta table."""
+        with self._lock:
+            row = self._con.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row is not None else default
+
+    def set_meta(self, key, value):
+        """Store a value under `key` in the meta table."""
+        with self._lock, self._con:
+            self._con.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, value)
+            )
+
+    def mark_done(self, product_info):
+        """Record a completed download (product info from the download)."""
+        self._set(product_info['id'], product_info['title'], 'done',
+                  product_info.get('size'), product_info.get('md5'),
+                  product_info.get('path'))
+
+    def mark_offline(self, product_info):
+        """Record a product that was not downloaded because it is in the
+        LTA, as 'triggered' if its retrieval was requested."""
+        status = 'triggered' if product_info.get('triggered') else 'offline'
+        now = datetime.utcnow().isoformat()
+        with self._lock, self._con:
+            self._con.execute(
+                "INSERT OR IGNORE INTO products (title, uuid, status, updated) "
+                "VALUES (?, ?, ?, ?)",
+                (product_info['title'], product_info['id'], status, now)
+            )
+            self._con.execute(
+                "UPDATE products SET status = ?, updated = ? "
+                "WHERE title = ? AND status != 'done'",
+                (status, now, product_info['title'])
+            )
+
+    def mark_failed(self, product_id, title):
+        """Record a failed download (unless the product is already done)."""
+        now = datetime.utcnow().isoformat()
+        with self._lock, self._con:
+            self._con.execute(
+                "INSERT OR IGNORE INTO products (title, uuid, status, updated) "
+                "VALUES (?, ?, 'failed', ?)",
+                (title, product_id, now)
+            )
+            self._con.execute(
+                "UPDATE products SET status = 'failed', updated = ? "
+                "WHERE title = ? AND status != 'done'",
+                (now, title)
+            )
+
+    def _set(self, product_id, title, status, size=None, md5=None, path=None):
+        with self._lock, self._con:
+            self._con.execute(
+                "INSERT OR REPLACE INTO products "
+                "(title, uuid, size, md5, path, status, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (title, product_id, size, md5, path, status,
+                 datetime.utcnow().isoformat())
+            )
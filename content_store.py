@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Content-addressed store of downloaded products, shared by several download
+folders (one per project).
+
+The same product is often needed by several projects. Instead of a new
+download of several GB, a product that is already held in the store is
+linked into the download folder of the other project:
+    - every completed download is registered under its UUID and MD5 checksum
+      and hardlinked into the store folder (`<root>/<md5[:2]>/<md5>.zip`),
+      so the data stays available when the first project deletes its copy
+    - a later request for the same UUID creates a hardlink in the new
+      download folder, or a reflink (copy-on-write clone, Linux Btrfs/XFS)
+      if hardlinks are not possible, or a symlink as the last resort
+    - every link is a reference of the product; `release()` removes a link
+      and the stored copy when no references are left, `gc()` does the same
+      for links that were deleted by hand
+Hardlinks and reflinks only work within one file system, so the store
+folder should be on the same disk (or share) as the download folders. If the
+store copy cannot be created, the first downloaded file is used as the
+stored copy instead.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+
+from datetime import datetime
+from os.path import abspath, dirname, exists, getsize, isfile, join
+from metrics import metrics
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, no reflinks
+    fcntl = None
+
+
+LINK_METHODS = ('hardlink', 'reflink', 'symlink')
+
+# ioctl of Linux that clones a file (copy-on-write)
+FICLONE = 0x40049409
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    uuid TEXT PRIMARY KEY,
+    md5 TEXT NOT NULL,
+    title TEXT,
+    size INTEGER,
+    path TEXT NOT NULL,
+    created TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS refs (
+    path TEXT PRIMARY KEY,
+    uuid TEXT NOT NULL,
+    method TEXT NOT NULL,
+    created TEXT NOT NULL
+);
+"""
+
+
+def _reflink(src, dst):
+    """Clone `src` into a new file `dst` (copy-on-write)."""
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this system")
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+
+def _symlink(src, dst):
+    os.symlink(abspath(src), dst)
+
+
+_LINKERS = {'hardlink': os.link, 'reflink': _reflink, 'symlink': _symlink}
+
+
+def _is_local_zip(path):
+    """True for a product file on a disk (not an object store or a folder
+    of extracted files, see sinks.py and safe_extract.py)."""
+    return bool(path) and path.endswith('.zip') and not path.startswith('s3://')
+
+
+class ContentStore:
+    """Products shared between download folders.
+
+    Parameters
+    ----------
+    root : str
+        Store folder (with the index `store.sqlite`), on the same file
+        system as the download folders.
+    methods : tuple
+        Link methods tried in this order ('hardlink', 'reflink', 'symlink').
+    """
+
+    def __init__(self, root, methods=LINK_METHODS):
+        for method in methods:
+            if method not in _LINKERS:
+                raise ValueError(f"Unknown link method '{method}', "
+                                 f"expected one of {LINK_METHODS}")
+        self.root = root
+        self.methods = methods
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(join(root, 'store.sqlite'),
+                                    check_same_thread=False)
+        with self._con:
+            self._con.executescript(SCHEMA)
+
+    def __len__(self):
+        with self._lock:
+            return self._con.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+
+    def close(self):
+        self._con.close()
+
+    def _object_path(self, md5):
+        md5 = md5.lower()
+        return join(self.root, md5[:2], md5 + '.zip')
+
+    def get(self, product_id):
+        """Stored product (dict) or None if the product is not held.
+
+        A stored copy that was removed or changed outside of the store is
+        replaced by another full copy in a download folder, or dropped from
+        the index if there is none.
+        """
+        with self._lock:
+            row = self._con.execute(
+                "SELECT uuid, md5, title, size, path FROM objects WHERE uuid = ?",
+                (product_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        obj = dict(zip(('id', 'md5', 'title', 'size', 'path'), row))
+        if self._intact(obj['path'], obj['size']):
+            return obj
+        # A download used as the stored copy was deleted, another full copy
+        # (not a symlink) takes its place
+        with self._lock:
+            refs = self._con.execute(
+                "SELECT path FROM refs WHERE uuid = ? AND method != 'symlink'",
+                (product_id,)
+            ).fetchall()
+        for path, in refs:
+            if not os.path.islink(path) and self._intact(path, obj['size']):
+                with self._lock, self._con:
+                    self._con.execute("UPDATE objects SET path = ? WHERE uuid = ?",
+                                      (path, product_id))
+                return dict(obj, path=path)
+        logging.warning(f"Stored copy of {obj['title']} is missing or "
+                        f"incomplete, removed from the store")
+        with self._lock, self._con:
+            self._con.execute("DELETE FROM objects WHERE uuid = ?", (product_id,))
+        return None
+
+    @staticmethod
+    def _intact(path, size):
+        return isfile(path) and not (size and getsize(path) != size)
+
+    def add(self, product_info):
+        """Register a completed download (product info from the download).
+
+        Returns True if the product is held by the store afterwards.
+        """
+        path = product_info.get('path')
+        md5 = product_info.get('md5')
+        if not _is_local_zip(path) or not md5 or not isfile(path):
+            return False
+        obj = self.get(product_info['id'])
+        if obj is not None and obj['md5'].lower() != md5.lower():
+            # Product was reprocessed under the same UUID, keep the new one
+            logging.warning(f"Checksum of {product_info['title']} changed, "
+                            f"replacing the stored copy")
+            self._remove_object(obj)
+            obj = None
+        if obj is None:
+            store_path = self._object_path(md5)
+            try:
+                os.makedirs(dirname(store_path), exist_ok=True)
+                if not exists(store_path):
+                    os.link(path, store_path)
+            except OSError as e:
+                # Different file system than the download folder
+                logging.info(f"No hardlink in the store for {product_info['title']}"
+                             f" ({e}), the download is the stored copy")
+                store_path = path
+            with self._lock, self._con:
+                self._con.execute(
+                    "INSERT OR REPLACE INTO objects "
+                    "(uuid, md5, title, size, path, created) VALUES (?, ?, ?, ?, ?, ?)",
+                    (product_info['id'], md5, product_info.get('title'),
+                     getsize(path), store_path, datetime.utcnow().isoformat())
+                )
+        self._add_ref(path, product_info['id'], 'download')
+        return True
+
+    def link(self, product_id, target):
+        """Link a stored product to the path `target`.
+
+        Returns the product info (dict with the path of the link) or None if
+        the product is not held or no link could be created.
+        """
+        if not _is_local_zip(target):
+            return None
+        obj = self.get(product_id)
+        if obj is None:
+            return None
+        if exists(target):
+            self._add_ref(target, product_id, 'existing')
+            return dict(obj, path=target, Online=True)
+
+        os.makedirs(dirname(abspath(target)), exist_ok=True)
+        temp_path = target + '.incomplete'
+        for method in self.methods:
+            try:
+                if os.path.lexists(temp_path):
+                    os.remove(temp_path)
+                _LINKERS[method](obj['path'], temp_path)
+            except OSError as e:
+                logging.debug(f"No {method} for {obj['title']}: {e}")
+                continue
+            os.replace(temp_path, target)
+            self._add_ref(target, product_id, method)
+            logging.info(f"Linked {obj['title']} from the store ({method})")
+            metrics.inc('store_links_total', method=method)
+            metrics.inc('store_bytes_saved_total', obj['size'] or 0)
+            return dict(obj, path=target, Online=True)
+        logging.warning(f"Could not link {obj['title']} from the store")
+        return None
+
+    def refcount(self, product_id):
+        """Number of download folders holding the product."""
+        with self._lock:
+            return self._con.execute(
+                "SELECT COUNT(*) FROM refs WHERE uuid = ?", (product_id,)
+            ).fetchone()[0]
+
+    def release(self, path):
+        """Remove a product file from a download folder.
+
+        The stored copy is removed as well when no references are left.
+        Returns the number of remaining references.
+        """
+        with self._lock, self._con:
+            row = self._con.execute(
+                "SELECT uuid FROM refs WHERE path = ?", (path,)
+            ).fetchone()
+            self._con.execute("DELETE FROM refs WHERE path = ?", (path,))
+        if os.path.lexists(path):
+            os.remove(path)
+        if row is None:
+            return 0
+        count = self.refcount(row[0])
+        if count == 0:
+            obj = self.get(row[0])
+            if obj is not None:
+                self._remove_object(obj)
+        return count
+
+    def gc(self):
+        """Drop the references of deleted files and the stored copies that
+        are not referenced anymore. Returns the number of removed products."""
+        with self._lock:
+            refs = self._con.execute("SELECT path FROM refs").fetchall()
+        gone = [(path,) for path, in refs if not os.path.lexists(path)]
+        with self._lock, self._con:
+            self._con.executemany("DELETE FROM refs WHERE path = ?", gone)
+            rows = self._con.execute(
+                "SELECT uuid, md5, title, size, path FROM objects "
+                "WHERE uuid NOT IN (SELECT uuid FROM refs)"
+            ).fetchall()
+        for row in rows:
+            self._remove_object(dict(zip(('id', 'md5', 'title', 'size', 'path'), row)))
+        logging.info(f"Store cleanup: {len(gone)} deleted links, "
+                     f"{len(rows)} products removed")
+        return len(rows)
+
+    def _add_ref(self, path, product_id, method):
+        with self._lock, self._con:
+            self._con.execute(
+                "INSERT OR REPLACE INTO refs (path, uuid, method, created) "
+                "VALUES (?, ?, ?, ?)",
+                (path, product_id, method, datetime.utcnow().isoformat())
+            )
+
+    def _remove_object(self, obj):
+        # Only the copy inside of the store folder is deleted here, a download
+        # used as the stored copy is removed by release()
+        if obj['path'] == self._object_path(obj['md5']) and exists(obj['path']):
+            os.remove(obj['path'])
+            try:
+                os.rmdir(dirname(obj['path']))
+            except OSError:
+                # Other products in the same folder
+                pass
+        with self._lock, self._con:
+            self._con.execute("DELETE FROM objects WHERE uuid = ?", (obj['id'],))
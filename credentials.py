@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Pool of SciHUB accounts.
+
+The password file (userfiles/apihub.txt) can contain several accounts, one
+`<username> <password>` pair per line. Every account has its own API session,
+LTA trigger quota (see rate_limiter.py) and a limit on concurrent downloads,
+so the throughput scales with the number of accounts:
+    - triggers go to the account whose next trigger slot opens first
+    - every product is assigned to one account (sticky assignment), so the
+      account that triggered the retrieval also downloads the product
+    - downloads of an account are limited to `max_downloads` at a time
+"""
+
+import logging
+import os
+import threading
+
+from contextlib import contextmanager
+from sentinelsat import SentinelAPI
+from rate_limiter import for_account, QUOTA_REQUESTS, QUOTA_PERIOD
+
+
+# Address of the hub, can be changed (e.g. to a local mock server, see
+# mock_dhus.py) with the SCIHUB_API_URL environment variable
+API_URL = os.environ.get("SCIHUB_API_URL", "https://scihub.copernicus.eu/dhus")
+
+# Concurrent downloads allowed for a single user
+MAX_DOWNLOADS = 2
+
+
+def read_credentials(apipath):
+    """List of (username, password) pairs from the password file.
+
+    Empty lines and lines starting with '#' are skipped. The password is the
+    rest of the line after the first space (only the line end is removed).
+    Raises IOError if the file can not be read, a line has no password or
+    the file contains no accounts.
+    """
+    accounts = []
+    with open(apipath) as f:
+        for num, line in enumerate(f, 1):
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            if " " not in line:
+                # The line is not printed, it may be a password
+                raise IOError(f"Line {num} of {apipath} is not a "
+                              f"'<username> <password>' pair")
+            (usrnam, psswrd) = line.split(" ", 1)
+            accounts.append((usrnam, psswrd))
+    if not accounts:
+        raise IOError(f"No accounts found in {apipath}")
+    return accounts
+
+
+class Account:
+    """A SciHUB account with its API session and limits."""
+
+    def __init__(self, username, password, api_url=None,
+                 quota=(QUOTA_REQUESTS, QUOTA_PERIOD), max_downloads=MAX_DOWNLOADS):
+        self.username = username
+        self.api = SentinelAPI(username, password, api_url or API_URL)
+        self.limiter = for_account(username, *quota)
+        self.max_downloads = max_downloads
+        self.slots = threading.BoundedSemaphore(max_downloads)
+
+    def __repr__(self):
+        return f"Account({self.username})"
+
+
+class CredentialPool:
+    """Accounts used for triggering and downloading products.
+
+    Parameters
+    ----------
+    accounts : list of Account
+        Accounts in the pool.
+    store : StateStore, optional
+        If given, the assignment of products to accounts is saved in the
+        state store (see state_store.py) and survives a restart.
+    """
+
+    def __init__(self, accounts, store=None):
+        if not accounts:
+            raise ValueError("Credential pool needs at least one account")
+        self.accounts = list(accounts)
+        self.store = None
+        self._by_name = {acc.username: acc for acc in self.accounts}
+        self._assigned = {}
+        self._lock = threading.Lock()
+        if store is not None:
+            self.attach_store(store)
+
+    @classmethod
+    def from_file(cls, apipath, api_url=None, quota=(QUOTA_REQUESTS, QUOTA_PERIOD),
+                  max_downloads=MAX_DOWNLOADS, store=None):
+        """Create a pool with all accounts from the password file."""
+        accounts = [
+            Account(usrnam, psswrd, api_url, quota, max_downloads)
+            for usrnam, psswrd in read_credentials(apipath)
+        ]
+        logging.info(f"Loaded {len(accounts)} SciHUB account(s)")
+        return cls(accounts, store)
+
+    def attach_store(self, store):
+        """Load (and from now on save) product assignments in `store`."""
+        self.store = store
+        with self._lock:
+            for product_id, username in store.accounts().items():
+                if username in self._by_name:
+                    self._assigned[product_id] = username
+
+    def __len__(self):
+        return len(self.accounts)
+
+    @property
+    def api(self):
+        """API of the first account (for queries and status checks)."""
+        return self.accounts[0].api
+
+    @property
+    def capacity(self):
+        """Total number of concurrent downloads of all accounts."""
+        return sum(acc.max_downloads for acc in self.accounts)
+
+    def assign(self, product_id, account=None):
+        """Account of a product, assigned on first use.
+
+        Unassigned products go to `account` if given, otherwise to the account
+        with the fewest assigned products.
+        """
+        with self._lock:
+            username = self._assigned.get(product_id)
+            if username is not None:
+                return self._by_name[username]
+            if account is None:
+                load = {acc.username: 0 for acc in self.accounts}
+                for name in self._assigned.values():
+                    load[name] += 1
+                account = min(self.accounts, key=lambda acc: load[acc.username])
+            self._assigned[product_id] = account.username
+        if self.store is not None:
+            self.store.set_account(product_id, account.username)
+        return account
+
+    def trigger_account(self):
+        """Account whose next LTA trigger slot opens first."""
+        return min(self.accounts, key=lambda acc: acc.limiter.next_slot())
+
+    def next_trigger_slot(self):
+        """Seconds until any account can trigger a retrieval."""
+        return min(acc.limiter.next_slot() for acc in self.accounts)
+
+    @contextmanager
+    def download_slot(self, product_id):
+        """Wait for a free download slot of the product's account and yield
+        the account."""
+        account = self.assign(product_id)
+        with account.slots:
+            yield account
@@ -10,23 +10,47 @@ IMPORTANT: Set your SciHUB account credentials in apihub.txt!
 Download files from SciHUB listed in a CSV file:
     - required values in CSV file are: 'id', 'title' and 'downloaded'
     - script reads the SciHUB credentials and connects to the API
-    - loads the CSV file into DataFrame
-    - For each file, check if it is 'Online', if not retrieve from LTA
-    - If it is 'Online', proceed with download
-    - Update the CSV file when the download is complete
+    - imports the CSV file into the state store (see state_store.py)
+    - For each file, check if it is 'Online', if not retrieve from LTA (the
+      status of all remaining files is refreshed in batches, see lta_status.py)
+    - Files are downloaded as soon as they are online, in the order of the
+      priority queue of the state store; while no file is online, the status
+      of all of them is checked again every 5 min
+    - If it is 'Online', proceed with download (interrupted downloads are
+      resumed with HTTP Range requests, see dwn_engine.py, or the products
+      are streamed to a file share or an object store, see sinks.py, or only
+      selected files of the products are extracted, see safe_extract.py)
+    - Update the state of the product when the download is complete (the CSV
+      file is written once at the end of the session)
+The script can run on several hosts at the same time with the same list (the
+CSV file and the state store on a shared folder): every product is claimed
+for download under a lease that is renewed while the download runs, the
+products of a crashed downloader are taken over once its lease expires (see
+state_store.py).
 """
 
-import pandas as pd
 import logging
 import sys
 
 from os.path import basename
 from datetime import datetime
 from time import sleep
-from sentinelsat import SentinelAPI, InvalidChecksumError
+from sentinelsat import InvalidChecksumError
+from lta_status import StatusPoller
+from state_store import LeaseLostError, StateStore, worker_id
+from credentials import CredentialPool
+from metrics import metrics
+from sinks import open_sink
+import async_client
+import dwn_engine
 
 
-def main(dwndir, csvpath, logpath, apipath):
+# Seconds between two checks of an offline product
+POLL_INTERVAL = 5 * 60
+
+
+def main(dwndir, csvpath, logpath, apipath, segments=1, metpath=None, stream=False,
+         extract=None):
     # Configure file for logging
     # ==========================
     logging.basicConfig(
@@ -40,26 +64,31 @@ def main(dwndir, csvpath, logpath, apipath):
     print("Started script download_LTA.py")
     logging.info("Started script download_LTA.py")
 
-    # Read password file
-    # ==================
+    # Timings and counters of all stages (see metrics.py)
+    metrics.configure(metpath)
+
+    # Output sink: folder, file share or object store (see sinks.py), or only
+    # the selected files of the products (see safe_extract.py)
+    dwndir = open_sink(dwndir, stream, extract)
+
+    # Read password file (one or more accounts)
+    # ==========================================
     try:
-        with open(apipath) as f:
-            (usrnam, psswrd) = f.readline().split(" ")
-            if psswrd.endswith("\n"):
-                psswrd = psswrd[:-1]
+        pool = CredentialPool.from_file(apipath)
     except IOError:
         logging.info("Error reading the password file!")
         sys.exit("Error reading the password file!")
 
     # Connect to API using <username> and <password>
     # ==============================================
-    print("Connecting to SciHub API...")
-    api = SentinelAPI(usrnam, psswrd, "https://scihub.copernicus.eu/dhus")
+    print(f"Connecting to SciHub API with {len(pool)} account(s)...")
+    api = pool.api
 
     # Read CSV file
     # =============
     try:
-        dwnfil = pd.read_csv(csvpath)
+        store = StateStore.from_csv(csvpath)
+        pool.attach_store(store)
         print(f"Import CSV file: {basename(csvpath)}")
         logging.info(f"Import CSV file: {basename(csvpath)}")
     except IOError:
@@ -70,53 +99,129 @@ def main(dwndir, csvpath, logpath, apipath):
     # ================================
     max_attempts = 10
     checksum = True
-    product_ids = list(dwnfil['uuid'])
+    # Products of downloaders that have stopped are downloaded again
+    owner = worker_id()
+    store.reclaim()
+    products = store.queue()
     # product_example = "672e5131-c79d-4500-b825-9dabf40662e3"
-    print(f"Found {len(product_ids)} products in CSV list.\n")
-    logging.info(f"Found {len(product_ids)} products in CSV list.\n")
+    print(f"Found {len(products)} products in CSV list.\n")
+    logging.info(f"Found {len(products)} products in CSV list.\n")
+
+    # The 'Online' status is checked for all remaining products at once
+    poller = StatusPoller(api)
+    waiting_states = ('queued', 'triggered', 'online', 'failed')
+
+    # Metadata of all products in a few concurrent requests instead of one
+    # request before every download (see async_client.py)
+    client = async_client.for_api(api)
+    infos = {}
+    if client is not None:
+        infos = client.run(client.odata_many(
+            [row[0] for row in products if row[2] in waiting_states]
+        ))
 
     # Main loop for download
     # ======================
-    for i, product_id in enumerate(product_ids):
-        if not dwnfil['downloaded'].get(i):
-            current_file = api.get_product_odata(product_id)
-            print(f"     Next file: {current_file['title']}")
+    waiting = 0
+    while products:
+        # Take the first product that is already online (products that are
+        # no longer waiting are skipped right away)
+        pending = [row[0] for row in products if row[2] in waiting_states]
+        online = poller.get(pending, refresh=waiting > 0)
+        i = next((j for j, row in enumerate(products)
+                  if row[2] not in waiting_states or online.get(row[0])), None)
+
+        # If no product is online (all are in LTA), wait and check all of
+        # them again every 5 min
+        if i is None:
+            if waiting == 0:
+                print(f"{len(pending)} files are offline, waiting {POLL_INTERVAL / 60:.0f} min...")
+                logging.info(f"{len(pending)} files are offline, waiting {POLL_INTERVAL / 60:.0f} min...")
+            else:
+                print(f"{waiting / 60:.0f} min has passed, files still Offline..")
+                logging.info(f"{waiting / 60:.0f} min has passed, files still Offline..")
+            sleep(POLL_INTERVAL)
+            waiting += POLL_INTERVAL
+            continue
+        waiting = 0
+
+        product_id, title, _ = products.pop(i)
+        if store.status(product_id) in waiting_states:
+            print(f"     Next file: {title}")
             print(f"     File uuid: {product_id}")
-            logging.info(f"     Next file: {current_file['title']}")
+            logging.info(f"     Next file: {title}")
             logging.info(f"     File uuid: {product_id}")
+            waited = store.since_trigger(product_id)
+            if store.status(product_id) == 'triggered' and waited is not None:
+                metrics.observe('wait_online_seconds', waited)
+                metrics.event('online', id=product_id, title=title,
+                              wait_seconds=round(waited))
 
-            # If product isn't online (it is in LTA), wait and check every 5 min
-            waiting = 0
-            while not current_file['Online']:
-                if waiting == 0:
-                    print("File is offline, waiting 5 min...")
-                    logging.info("File is offline, waiting 5 min...")
-                sleep(5*60)
-                waiting += 5
-                print(f"{waiting} min has passed, file still Offline..")
-                logging.info(f"{waiting} min has passed, file still Offline..")
-
-            # When file goes online proceed with download
-            for attempt_num in range(max_attempts):
-                try:
-                    api.download(product_id, dwndir, checksum)
-                    # Update CSV file
-                    dwnfil.at[i, 'downloaded'] = True
-                    dwnfil.to_csv(csvpath, index=False)
-                    logging.info("CSV file updated\n")
-                    break
-                except (KeyboardInterrupt, SystemExit):
-                    raise
-                except InvalidChecksumError as e:
-                    logging.info(f"Invalid checksum. The downloaded file for '{product_id}' is corrupted.")
-                    logging.error(e)
-                except Exception as e:
-                    logging.info(f"There was an error downloading {product_id}")
-                    logging.error(e)
-            else:
-                logging.info(f"    ****  File {product_id} was not Online!\n")
+            # Claim the product, unless another downloader is already on it
+            if not store.claim(product_id, owner):
+                logging.info(f"SKIP!  File {product_id} is handled by another process.\n")
+                continue
+
+            # The prefetched metadata is used by the first attempt only, the
+            # product is online now
+            product_info = infos.pop(product_id, None)
+            if product_info is not None:
+                product_info['Online'] = True
+
+            # When file goes online proceed with download (the claim is
+            # renewed while the download runs)
+            with store.lease(product_id, owner) as lease:
+                for attempt_num in range(max_attempts):
+                    if attempt_num > 0:
+                        metrics.inc('download_retries_total')
+                    try:
+                        # Use the account that triggered the retrieval
+                        account = pool.assign(product_id)
+                        product_info = dwn_engine.download(
+                            account.api, product_id, dwndir, checksum, segments,
+                            product_info=product_info, lease=lease
+                        )
+                        if not product_info['Online']:
+                            # Product went back to the LTA (its retrieval was
+                            # triggered if the account had a free trigger slot),
+                            # it is downloaded once it is online again
+                            status = 'triggered' if product_info.get('triggered') else 'queued'
+                            store.release(product_id, status, owner)
+                            poller.invalidate(product_id)
+                            products.append((product_id, title, status))
+                            logging.info(f"File {product_id} is offline again\n")
+                            break
+                        # Update state of the product (unless the claim was lost)
+                        if store.release(product_id, 'done', owner):
+                            metrics.inc('downloads_total', result='done')
+                            logging.info("Product state updated\n")
+                        break
+                    except (KeyboardInterrupt, SystemExit):
+                        store.release(product_id, 'online', owner)
+                        raise
+                    except LeaseLostError as e:
+                        # The product is downloaded by the new owner
+                        logging.warning(f"{e}, skipping it\n")
+                        break
+                    except InvalidChecksumError as e:
+                        product_info = None
+                        logging.info(f"Invalid checksum. The downloaded file for '{product_id}' is corrupted.")
+                        logging.error(e)
+                    except Exception as e:
+                        product_info = None
+                        logging.info(f"There was an error downloading {product_id}")
+                        logging.error(e)
+                else:
+                    store.release(product_id, 'failed', owner)
+                    metrics.inc('downloads_total', result='failed')
+                    logging.info(f"    ****  File {product_id} was not Online!\n")
         else:
-            logging.info(f"SKIP!  File {product_id} has already been downloaded.\n")
+            logging.info(f"SKIP!  File {product_id} is already downloaded or being downloaded.\n")
+
+    # Update the CSV file
+    store.export_csv(csvpath)
+    store.close()
+    metrics.close()
 
     # End message
     # ============
@@ -126,7 +231,7 @@ def main(dwndir, csvpath, logpath, apipath):
 
 
 if __name__ == "__main__":
-    # Download folder
+    # Download folder (or "s3://<bucket>/<prefix>" for an object store)
     dwn_pth = "R:\\Sentinel-1_SLC\\"
 
     # Path to CSV file with a list of products to be triggered
@@ -138,4 +243,19 @@ if __name__ == "__main__":
     # Path to file with SciHub credentials
     api_pth = ".\\userfiles\\apihub.txt"
 
-    main(dwn_pth, csv_pth, log_pth, api_pth)
+    # Number of byte-range segments of a product downloaded at the same time
+    n_segments = 4
+
+    # Path (without extension) of the metrics files (.prom and .jsonl)
+    met_pth = ".\\userfiles\\metrics_download"
+
+    # Stream the products to the download folder in one pass (for a file
+    # share, see sinks.py), S3 URLs are always streamed
+    stream_dwn = False
+
+    # Keep only these files of the products (glob patterns of the paths in
+    # the SAFE folder, see safe_extract.py), None for the whole zip files
+    extract_files = None  # ['manifest.safe', 'annotation/*.xml']
+
+    main(dwn_pth, csv_pth, log_pth, api_pth, n_segments, met_pth, stream_dwn,
+         extract_files)
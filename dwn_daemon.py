@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+IMPORTANT: Set your SciHUB account credentials in apihub.txt!
+
+Long-running version of auto_dwn_slc.py (instead of starting it once a week
+with start_py.bat):
+    - the API sessions and the catalog of downloaded products stay open
+    - every `interval` seconds only the products ingested since the last
+      query are requested ('ingestiondate' from the watermark to now)
+    - the watermark is saved in the catalog after every successful cycle, so
+      a restarted daemon continues where it stopped
+    - products whose download failed are tried again in the next cycle
+    - products in the LTA are kept in the catalog and checked at every
+      cycle, independent of the watermark: they are downloaded as soon as
+      they are online, and triggered again if no trigger slot was free or
+      their retrieval was requested more than `retrigger_after` ago
+New products are therefore downloaded within minutes of their publication,
+with a small query per cycle instead of a query over the last months. The
+bandwidth limit and its time-of-day windows (see bandwidth.py) are applied
+to all cycles, so the daemon can download at full speed at night only.
+"""
+
+import logging
+import sys
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from time import sleep
+from shapely.geometry import box
+from credentials import CredentialPool
+from query_engine import QueryEngine, parse_date, format_date
+from lta_status import StatusPoller
+from aoi_planner import QueryPlanner, read_aois
+from catalog import Catalog
+from sinks import open_sink
+from content_store import ContentStore
+from selection import select_products
+from metrics import metrics
+from auto_dwn_slc import download_products
+import bandwidth
+
+
+def query_new(engine, planner, qp, since, until, sel=None):
+    """Dict {uuid: properties} of products ingested between two dates.
+
+    The products are selected with the criteria `sel` (see selection.py).
+    """
+    keywords = dict(ingestiondate=(format_date(since), format_date(until)),
+                    platformname=qp['platformname'],
+                    producttype=qp['producttype'])
+    if planner is not None:
+        results = planner.products(**keywords).items()
+    else:
+        results = engine.products(qp['footprint'], **keywords)
+    if sel:
+        aois = planner.aois if planner is not None else [('footprint', qp['footprint'])]
+        results = select_products(results, aois, **sel).items()
+    return OrderedDict(
+        (product_id, {key: properties.get(key)
+                      for key in ('title', 'size', 'beginposition')})
+        for product_id, properties in results
+    )
+
+
+def offline_due(cat, poller, now, retrigger_after):
+    """Dict {uuid: title} of the products in the LTA (see
+    Catalog.offline()) that are tried again: products that are online now,
+    that are still waiting for a trigger slot or whose retrieval was
+    requested more than `retrigger_after` seconds ago."""
+    offline = cat.offline()
+    if not offline:
+        return OrderedDict()
+    online = poller.get(list(offline), refresh=True)
+    expired = now - timedelta(seconds=retrigger_after)
+    due = OrderedDict(
+        (pid, title) for pid, (title, status, updated) in offline.items()
+        if online.get(pid) or status == 'offline' or updated < expired
+    )
+    logging.info(f"{len(due)} of {len(offline)} products in the LTA are "
+                 f"checked again")
+    return due
+
+
+def main(dwndir, logpath, apipath, qp, catpath, workers=4, segments=1,
+         interval=10 * 60, overlap=timedelta(hours=1), metpath=None, metport=None,
+         bw=None, stream=False, extract=None, storepath=None, sel=None,
+         retrigger_after=24 * 60 * 60):
+    # Configure file for logging
+    # ==========================
+    logging.basicConfig(
+        filename=logpath,
+        format='%(asctime)s:%(module)s:%(levelname)s: %(message)s',
+        level=logging.INFO
+    )
+    with open(logpath, "a") as f:
+        loghead = f"\nStarting a new session\n{datetime.now()}\n" + 26 * "=" + "\n"
+        f.write(loghead)
+    logging.info('Started dwn_daemon.py')
+
+    # Timings and counters of all stages (see metrics.py), also served over
+    # HTTP for Prometheus if a port is given
+    metrics.configure(metpath, metport)
+
+    # Bandwidth limit shared by all downloads (see bandwidth.py)
+    bw = bw if bw is not None else {}
+    bandwidth.limiter.configure(bw.get('rate'), bw.get('windows'))
+
+    # Output sink: folder, file share or object store (see sinks.py), or only
+    # the selected files of the products (see safe_extract.py)
+    dwndir = open_sink(dwndir, stream, extract)
+
+    # Products shared with the download folders of other projects (see
+    # content_store.py)
+    store = ContentStore(storepath) if storepath is not None else None
+
+    # Read password file (one or more accounts)
+    # ==========================================
+    try:
+        pool = CredentialPool.from_file(apipath)
+    except IOError:
+        logging.error("Error reading the password file!")
+        sys.exit("Error reading the password file!")
+
+    # Connect to API using <username> and <password>
+    # ===============================================
+    print(f"Connecting to SciHub API with {len(pool)} account(s)...")
+    api = pool.api
+
+    # Open the catalog and the query engine
+    # =====================================
+    cat = Catalog(catpath)
+    # The windows of the daemon are short and never repeated, no cache needed
+    engine = QueryEngine(api)
+    planner = QueryPlanner(engine, read_aois(qp['aois'])) if qp.get('aois') else None
+    poller = StatusPoller(api)
+
+    # Products ingested after the watermark are queried, on the first run
+    # the query starts at the start time of the query parameters
+    watermark = parse_date(cat.get_meta('watermark', qp['strtime']))
+    logging.info(f"Watermark: {format_date(watermark)}")
+
+    # Main loop
+    # =========
+    try:
+        while True:
+            now = datetime.utcnow()
+            try:
+                # Files added to the download folder by hand or by another
+                # tool since the last cycle are registered
+                cat.refresh(dwndir)
+                # The windows overlap, products that are indexed late are not
+                # missed (downloaded products are skipped by the catalog)
+                products = query_new(engine, planner, qp, watermark - overlap, now,
+                                     sel)
+                missing = OrderedDict(
+                    (pid, products[pid]) for pid in cat.missing(products)
+                )
+                # Retry the failed downloads of earlier cycles
+                for product_id, title in cat.failed().items():
+                    missing.setdefault(product_id, {'title': title})
+                # Products in the LTA are only requested again when they are
+                # due, also if they are older than the query window
+                due = offline_due(cat, poller, now, retrigger_after)
+                for product_id in cat.offline():
+                    if product_id not in due:
+                        missing.pop(product_id, None)
+                for product_id, title in due.items():
+                    missing.setdefault(product_id, {'title': title})
+                titles = OrderedDict(
+                    (pid, missing[pid]['title'])
+                    for pid in bandwidth.order_products(missing, bw.get('order'))
+                )
+                if titles:
+                    logging.info(f"{len(titles)} files selected for download!")
+                    failed, _ = download_products(pool, cat, titles, dwndir,
+                                                  workers, segments, store)
+                    # The new files are in the catalog already
+                    cat.mark_scanned(dwndir)
+                    logging.info(f"{len(titles) - len(failed)} files downloaded, "
+                                 f"{len(failed)} failed")
+                watermark = now
+                cat.set_meta('watermark', format_date(watermark))
+                metrics.inc('daemon_cycles_total', result='ok')
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception as e:
+                # Query or download failed, try again in the next cycle
+                logging.error(f"Cycle failed: {e}")
+                metrics.inc('daemon_cycles_total', result='error')
+            sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopping...")
+    finally:
+        cat.close()
+        if store is not None:
+            store.close()
+        metrics.close()
+        logging.info('The daemon has stopped!')
+        logging.shutdown()
+
+
+if __name__ == "__main__":
+    # Download folder (or 's3://<bucket>/<prefix>' for an object store)
+    dwn_pth = 'R:\\Sentinel-1_SLC\\'
+
+    # Path to log file
+    log_pth = ".\\userfiles\\LOGFILE_daemon.log"
+
+    # Path to file with SciHub credentials
+    api_pth = ".\\userfiles\\apihub.txt"
+
+    # Path to the catalog of downloaded products (also keeps the watermark)
+    cat_pth = ".\\userfiles\\catalog.sqlite"
+
+    # Set query parameters
+    ############################################################################
+    # Ingestion date from which the first query starts (later queries start at
+    # the saved watermark)
+    strtime = 'NOW-2MONTH'
+
+    # Platform name:
+    platformname = 'Sentinel-1'
+
+    # Product type:
+    producttype = 'SLC'
+
+    # Geographical extents (minx, miny, maxx, maxy)
+    footprint = box(13.278422963870495, 45.33663869316604,
+                    16.687265418304985, 46.96845660190081)
+
+    # Several AOIs from a GeoJSON file (one feature per AOI), used instead of
+    # the footprint if set (see aoi_planner.py)
+    aoi_pth = None  # ".\\userfiles\\polygon.geojson"
+
+    query_params = {
+        'strtime': strtime,
+        'platformname': platformname,
+        'producttype': producttype,
+        'footprint': footprint,
+        'aois': aoi_pth
+    }
+
+    # Number of products downloaded at the same time
+    max_workers = 4
+
+    # Number of byte-range segments of a single product downloaded at once
+    n_segments = 1
+
+    # Seconds between two queries
+    poll_interval = 10 * 60
+
+    # Seconds after which a product that is still in the LTA is triggered
+    # again
+    retrigger_time = 24 * 60 * 60
+
+    # Path (without extension) of the metrics files (.prom and .jsonl) and port
+    # of the Prometheus endpoint (None to disable)
+    met_pth = ".\\userfiles\\metrics_daemon"
+    met_port = 9108
+
+    # Bandwidth limit of all downloads together (bytes/sec, None for no limit),
+    # time-of-day windows with their own limit and the order of the downloads
+    # ('smallest', 'largest', 'oldest', 'newest' or None for the query order),
+    # e.g. 2 MB/s during the day, no limit at night, oldest products first:
+    # {'rate': 2 * 2 ** 20, 'windows': [("20:00", "06:00", None)],
+    #  'order': 'oldest'}
+    bandwidth_params = {
+        'rate': None,
+        'windows': None,
+        'order': None
+    }
+
+    # Stream the products to the download folder in one pass (for a file
+    # share, see sinks.py), S3 URLs ('s3://<bucket>/<prefix>') are always
+    # streamed
+    stream_dwn = False
+
+    # Keep only these files of the products (glob patterns of the paths in
+    # the SAFE folder, see safe_extract.py), None for the whole zip files
+    extract_files = None  # ['manifest.safe', 'annotation/*.xml']
+
+    # Store of the products shared by the download folders of all projects
+    # (see content_store.py), None to disable
+    store_pth = None  # 'R:\\.product_store\\'
+
+    # Selection of the products from the query results (see selection.py),
+    # None to download all products found by the queries. All criteria are off
+    # (None or False), set the ones to use
+    selection_params = {
+        'relative_orbits': None,  # e.g. [22, 95, 146]
+        'orbit_direction': None,  # 'ASCENDING' or 'DESCENDING'
+        'polarisation': None,  # e.g. 'VV VH'
+        'max_size': None,  # e.g. '8 GB'
+        'min_coverage': None,  # share of the AOI covered by a product, e.g. 0.05
+        'drop_reprocessed': False,  # only the latest version of a product
+        'best_per_pass': False  # one product per satellite, orbit and day
+    }
+
+    main(dwn_pth, log_pth, api_pth, query_params, cat_pth, max_workers,
+         n_segments, poll_interval, metpath=met_pth, metport=met_port,
+         bw=bandwidth_params, stream=stream_dwn, extract=extract_files,
+         storepath=store_pth, sel=selection_params, retrigger_after=retrigger_time)
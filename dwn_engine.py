@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Resumable download of a single product using HTTP Range requests.
+
+The product is written into `<title>.zip.incomplete`, which is allocated to
+its final size. The file is divided into chunks of `chunk_size` bytes and the
+MD5 of every chunk that was completely written is stored next to it in
+`<title>.zip.incomplete.json` (chunk manifest). An interrupted download
+therefore continues with the missing chunks only, instead of starting from
+scratch. Large products can optionally be downloaded in several byte-range
+segments at the same time.
+
+The MD5 checksum of the whole product is computed while the data is written,
+so no second pass over the complete file is needed at the end. Chunks that
+arrive out of order (parallel segments, resumed downloads) are read back when
+the checksum reaches them and are compared with the manifest; a chunk that
+does not match is downloaded again instead of discarding the whole file.
+
+Products written to a file share or an object store (see sinks.py) are
+streamed instead: one sequential request, the MD5 checksum computed on the
+stream and the data written straight to the sink, without a chunk manifest.
+An interrupted stream to a file share is resumed from the end of the
+incomplete file (which is read back once for the checksum), a stream to an
+object store starts again.
+
+The function `download()` can be used in place of `SentinelAPI.download()`
+and returns the same product info dictionary. The time spent in the transfer,
+in writing to disk and in computing the checksum is recorded in metrics.py.
+The transfer rate of all downloads together is limited by bandwidth.py.
+
+A download of a product claimed in the state store (see state_store.py) is
+given the lease of the claim. It stops with LeaseLostError as soon as the
+claim is taken over by another downloader, leaving the temporary file and
+the chunk manifest to the new owner.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from os.path import exists, getsize
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from sentinelsat import InvalidChecksumError
+from rate_limiter import trigger_retrieval
+from metrics import metrics
+import bandwidth
+from sinks import open_sink
+from state_store import LeaseLostError
+
+
+CHUNK_SIZE = 8 * 2 ** 20  # 8 MB chunks
+
+
+class RangeNotSupportedError(Exception):
+    """Server ignored the Range header of a request."""
+    pass
+
+
+class _Md5Cursor:
+    """Incremental MD5 of a file that is written in chunks in any order.
+
+    Data of the chunk at the cursor position is hashed as it is written
+    (`feed()`). Chunks completed ahead of the cursor are read back from the
+    file once the cursor reaches them and are checked against the manifest.
+    """
+
+    def __init__(self, path, size, chunk_size, manifest):
+        self.path = path
+        self.size = size
+        self.chunk_size = chunk_size
+        self.manifest = manifest
+        self.md5 = hashlib.md5()
+        self.next_idx = 0
+        self.completed = set()
+        self.corrupt = set()
+        self.lock = threading.Lock()
+
+    def is_next(self, idx):
+        with self.lock:
+            return idx == self.next_idx
+
+    def feed(self, data):
+        """Hash data of the chunk at the cursor position (in order)."""
+        with self.lock:
+            self.md5.update(data)
+
+    def complete(self, idx, hashed=False):
+        """Mark chunk as written; `hashed` if it went through `feed()`."""
+        with self.lock:
+            if hashed:
+                self.next_idx += 1
+            else:
+                self.completed.add(idx)
+            self._advance()
+
+    def _advance(self):
+        # Read back completed chunks that are now contiguous with the cursor
+        while self.next_idx in self.completed:
+            idx = self.next_idx
+            self.completed.remove(idx)
+            start = perf_counter()
+            with open(self.path, 'rb') as f:
+                f.seek(idx * self.chunk_size)
+                data = f.read(min(self.chunk_size, self.size - idx * self.chunk_size))
+            expected = self.manifest.get(idx)
+            if expected is not None and hashlib.md5(data).hexdigest() != expected:
+                # Chunk was corrupted on disk, it has to be downloaded again
+                metrics.inc('corrupt_chunks_total')
+                self.corrupt.add(idx)
+                return
+            self.md5.update(data)
+            self.next_idx += 1
+            metrics.observe('stage_seconds', perf_counter() - start, stage='checksum')
+
+    def take_corrupt(self):
+        with self.lock:
+            corrupt, self.corrupt = self.corrupt, set()
+            return corrupt
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+def _load_state(state_path, temp_path, product_info, chunk_size):
+    """Return the chunk manifest {index: md5} of chunks already on disk."""
+    if exists(state_path):
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+            if (state['id'] == product_info['id']
+                    and state['size'] == product_info['size']
+                    and state['chunk_size'] == chunk_size
+                    and exists(temp_path)):
+                return {int(idx): md5 for idx, md5 in state['chunks'].items()}
+        except (ValueError, KeyError, OSError):
+            pass
+        logging.warning(f"Discarding invalid download state {state_path}")
+        return {}
+
+    # Incomplete file without a state file (e.g. left by SentinelAPI.download),
+    # which is written sequentially, so all full chunks can be kept (their MD5
+    # is unknown and they are only checked by the checksum of the product)
+    if exists(temp_path) and getsize(temp_path) <= product_info['size']:
+        return {idx: None for idx in range(getsize(temp_path) // chunk_size)}
+    return {}
+
+
+def _save_state(state_path, product_info, chunk_size, manifest):
+    """Write the state file atomically."""
+    state = {
+        'id': product_info['id'],
+        'size': product_info['size'],
+        'chunk_size': chunk_size,
+        'chunks': {str(idx): manifest[idx] for idx in sorted(manifest)}
+    }
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def _split_segments(chunks, segments):
+    """Split sorted chunk indices into at most `segments` runs of consecutive
+    chunks with roughly the same number of chunks."""
+    runs = []
+    for idx in chunks:
+        if runs and runs[-1][-1] == idx - 1:
+            runs[-1].append(idx)
+        else:
+            runs.append([idx])
+
+    # Split the longest runs until there are enough segments
+    while len(runs) < segments:
+        longest = max(runs, key=len)
+        if len(longest) < 2:
+            break
+        runs.remove(longest)
+        half = len(longest) // 2
+        runs += [longest[:half], longest[half:]]
+    return sorted(runs)
+
+
+def _fetch_run(session, url, temp_path, run, size, chunk_size, on_chunk,
+               cursor, timeout=None):
+    """Download a run of consecutive chunks with a single Range request."""
+    start = run[0] * chunk_size
+    end = min((run[-1] + 1) * chunk_size, size) - 1
+    headers = {'Range': f'bytes={start}-{end}'}
+    downloaded_bytes = 0
+    with session.get(url, stream=True, auth=session.auth, headers=headers,
+                     timeout=timeout) as r:
+        r.raise_for_status()
+        if r.status_code != 206 and not (start == 0 and end == size - 1):
+            raise RangeNotSupportedError(f"Range request for {url} returned {r.status_code}")
+
+        with open(temp_path, 'r+b') as f:
+            f.seek(start)
+            idx = run[0]
+            chunk_end = min((idx + 1) * chunk_size, size)
+            chunk_md5 = hashlib.md5()
+            live = cursor.is_next(idx)
+            pos = start
+            for data in r.iter_content(chunk_size=2 ** 20):
+                while data:
+                    # Never write past the end of the requested range
+                    part = data[:chunk_end - pos]
+                    data = data[len(part):]
+                    # Wait for the global bandwidth limit (see bandwidth.py)
+                    bandwidth.limiter.consume(len(part))
+                    t0 = perf_counter()
+                    f.write(part)
+                    t1 = perf_counter()
+                    chunk_md5.update(part)
+                    if live:
+                        cursor.feed(part)
+                    metrics.observe('stage_seconds', t1 - t0, stage='write')
+                    metrics.observe('stage_seconds', perf_counter() - t1, stage='checksum')
+                    pos += len(part)
+                    downloaded_bytes += len(part)
+                    if pos == chunk_end:
+                        f.flush()
+                        on_chunk(idx, chunk_md5.hexdigest(), live)
+                        if idx == run[-1]:
+                            return downloaded_bytes
+                        idx += 1
+                        chunk_end = min((idx + 1) * chunk_size, size)
+                        chunk_md5 = hashlib.md5()
+                        live = cursor.is_next(idx)
+    if pos != end + 1:
+        raise IOError(f"Connection closed after {pos} of {end + 1} bytes")
+    return downloaded_bytes
+
+
+def _stream(api, product_info, sink, name, checksum, lease=None):
+    """Stream a product into a sink in one sequential request."""
+    size = product_info['size']
+    md5 = hashlib.md5()
+    writer = sink.open(name)
+    try:
+        offset = writer.bytes
+        if offset > size:
+            writer.restart()
+            offset = 0
+        elif offset:
+            # Data of an interrupted download is kept (file shares)
+            logging.info(f"Resuming download of {product_info['title']} "
+                         f"at {offset} of {size} bytes")
+            for data in writer.read_back():
+                md5.update(data)
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        with api.session.get(product_info['url'], stream=True, auth=api.session.auth,
+                             headers=headers, timeout=api.timeout) as r:
+            r.raise_for_status()
+            if offset and r.status_code != 206:
+                logging.warning("Range requests not supported, restarting the download")
+                writer.restart()
+                md5 = hashlib.md5()
+                offset = 0
+            for data in r.iter_content(chunk_size=2 ** 20):
+                if lease is not None:
+                    lease.check()
+                bandwidth.limiter.consume(len(data))
+                t0 = perf_counter()
+                md5.update(data)
+                t1 = perf_counter()
+                writer.write(data)
+                metrics.observe('stage_seconds', t1 - t0, stage='checksum')
+                metrics.observe('stage_seconds', perf_counter() - t1, stage='write')
+        if writer.bytes != size:
+            raise IOError(f"Connection closed after {writer.bytes} of {size} bytes")
+        if checksum is True and md5.hexdigest().lower() != product_info['md5'].lower():
+            metrics.inc('checksum_errors_total')
+            raise InvalidChecksumError('File corrupt: checksums do not match')
+        if lease is not None:
+            lease.check(renew=True)
+        t0 = perf_counter()
+        path = writer.commit()
+        metrics.observe('stage_seconds', perf_counter() - t0, stage='write')
+    except LeaseLostError:
+        # The temporary data belongs to the new owner now
+        writer.close()
+        raise
+    except InvalidChecksumError:
+        writer.abort()
+        raise
+    except BaseException:
+        # Interrupted transfer, resumed by the next attempt if the sink can
+        if writer.resumable:
+            writer.suspend()
+        else:
+            writer.abort()
+        raise
+    return path, size - offset
+
+
+def download(api, product_id, dwndir, checksum=True, segments=1,
+             chunk_size=CHUNK_SIZE, product_info=None, max_refetch=3, lease=None):
+    """Download a product, resuming a previously interrupted download.
+
+    Parameters
+    ----------
+    api : SentinelAPI
+        Connected API instance (its session is used for the transfer).
+    product_id : str
+        UUID of the product.
+    dwndir : str or sink
+        Download folder or output sink (see sinks.py). Streaming sinks are
+        written in one sequential pass (`segments` and `chunk_size` are not
+        used).
+    checksum : bool
+        Verify the MD5 checksum of the complete file.
+    segments : int
+        Number of byte-range segments that are downloaded at the same time.
+    chunk_size : int
+        Resolution (in bytes) at which the download progress is recorded.
+    product_info : dict, optional
+        Result of `api.get_product_odata(product_id)`, if already known.
+    max_refetch : int
+        How many times chunks that were found corrupted on disk are
+        downloaded again.
+    lease : Lease, optional
+        Lease of the claim of the product (see state_store.py), the download
+        stops with LeaseLostError when it is lost.
+
+    Returns
+    -------
+    dict
+        Product info with the 'path' and 'downloaded_bytes' of the download.
+    """
+    if product_info is None:
+        product_info = api.get_product_odata(product_id)
+    sink = open_sink(dwndir)
+    name = product_info['title'] + '.zip'
+    path = sink.url(name)
+    product_info['path'] = path
+    product_info['downloaded_bytes'] = 0
+
+    if sink.exists(name):
+        # We assume that the product has been downloaded and is complete
+        return product_info
+
+    # Let the API trigger the retrieval of offline products from the LTA (if
+    # the account has a free trigger slot, see rate_limiter.py), 'triggered'
+    # tells whether the retrieval was requested
+    if not product_info['Online']:
+        triggered = trigger_retrieval(api, product_id, block=False,
+                                      product_info=product_info)
+        if triggered is None:
+            logging.info(f"No free LTA trigger slot for {product_info['title']}")
+            product_info['triggered'] = False
+            return product_info
+        if not triggered['Online']:
+            triggered['triggered'] = True
+            return triggered
+        # Came online since its status was read, downloaded below
+
+    if lease is not None:
+        lease.check()
+
+    if sink.streaming:
+        start = perf_counter()
+        # Some sinks read only parts of the product (see safe_extract.py)
+        fetched = sink.fetch(api, product_info, name) if hasattr(sink, 'fetch') else None
+        if fetched is not None:
+            product_info['path'], product_info['downloaded_bytes'] = fetched
+        else:
+            product_info['path'], product_info['downloaded_bytes'] = _stream(
+                api, product_info, sink, name, checksum, lease)
+        seconds = perf_counter() - start
+        nbytes = product_info['downloaded_bytes']
+        metrics.observe('transfer_seconds', seconds)
+        metrics.inc('transfer_bytes_total', nbytes)
+        metrics.event(
+            'download', id=product_id, title=product_info['title'],
+            size=product_info['size'], bytes=nbytes, seconds=round(seconds, 3),
+            bytes_per_sec=round(nbytes / max(seconds, 1e-6)), sink=str(sink)
+        )
+        return product_info
+
+    size = product_info['size']
+    temp_path = path + '.incomplete'
+    state_path = temp_path + '.json'
+    manifest = _load_state(state_path, temp_path, product_info, chunk_size)
+    if not exists(temp_path) or getsize(temp_path) > size:
+        manifest = {}
+        with open(temp_path, 'wb'):
+            pass
+    # Allocate the file to its final size, so chunks can be written anywhere
+    with open(temp_path, 'r+b') as f:
+        f.truncate(size)
+
+    n_chunks = (size + chunk_size - 1) // chunk_size
+    if manifest:
+        logging.info(
+            f"Resuming download of {product_info['title']}: "
+            f"{len(manifest)}/{n_chunks} chunks already on disk"
+        )
+
+    # Chunks already on disk are hashed (and verified) once, when the
+    # checksum reaches them
+    cursor = _Md5Cursor(temp_path, size, chunk_size, manifest)
+    for idx in sorted(manifest):
+        cursor.complete(idx)
+
+    lock = threading.Lock()
+
+    def on_chunk(idx, chunk_md5, hashed):
+        if lease is not None:
+            # Stop before the manifest of the new owner is overwritten
+            lease.check()
+        with lock:
+            manifest[idx] = chunk_md5
+            _save_state(state_path, product_info, chunk_size, manifest)
+        cursor.complete(idx, hashed)
+
+    def fetch(run):
+        return _fetch_run(api.session, product_info['url'], temp_path, run, size,
+                          chunk_size, on_chunk, cursor, api.timeout)
+
+    def missing_chunks():
+        # Drop chunks that did not match the manifest when read back
+        corrupt = cursor.take_corrupt()
+        for idx in corrupt:
+            logging.warning(f"Chunk {idx} of {product_info['title']} is corrupted")
+            metrics.inc('refetched_chunks_total')
+            manifest.pop(idx, None)
+            cursor.completed.discard(idx)
+        if corrupt:
+            _save_state(state_path, product_info, chunk_size, manifest)
+        return [idx for idx in range(n_chunks) if idx not in manifest]
+
+    start = perf_counter()
+    for attempt in range(max_refetch + 1):
+        missing = missing_chunks()
+        if not missing:
+            break
+        if lease is not None:
+            lease.check()
+        runs = _split_segments(missing, segments)
+        try:
+            if len(runs) == 1:
+                product_info['downloaded_bytes'] += fetch(runs[0])
+            else:
+                with ThreadPoolExecutor(max_workers=segments) as executor:
+                    product_info['downloaded_bytes'] += sum(executor.map(fetch, runs))
+        except RangeNotSupportedError:
+            # Server does not support Range requests, download everything
+            logging.warning("Range requests not supported, restarting the download")
+            manifest.clear()
+            cursor = _Md5Cursor(temp_path, size, chunk_size, manifest)
+            product_info['downloaded_bytes'] = fetch(list(range(n_chunks)))
+    else:
+        # Chunks found corrupted by the last refetch are left for the next
+        # attempt, which resumes from the manifest
+        missing = missing_chunks()
+        if missing:
+            raise IOError(f"{len(missing)} chunks of {product_info['title']} are "
+                          f"still missing after {max_refetch} refetches")
+    seconds = perf_counter() - start
+    metrics.observe('transfer_seconds', seconds)
+    metrics.inc('transfer_bytes_total', product_info['downloaded_bytes'])
+
+    # The files are still the new owner's if the claim was lost meanwhile
+    if lease is not None:
+        lease.check(renew=True)
+
+    # Check integrity with the MD5 checksum computed during the download
+    if checksum is True:
+        if (cursor.next_idx != n_chunks
+                or cursor.hexdigest().lower() != product_info['md5'].lower()):
+            os.remove(temp_path)
+            if exists(state_path):
+                os.remove(state_path)
+            metrics.inc('checksum_errors_total')
+            raise InvalidChecksumError('File corrupt: checksums do not match')
+
+    # Download successful, rename the temporary file to its proper name
+    os.replace(temp_path, path)
+    if exists(state_path):
+        os.remove(state_path)
+    metrics.event(
+        'download', id=product_id, title=product_info['title'], size=size,
+        bytes=product_info['downloaded_bytes'], seconds=round(seconds, 3),
+        bytes_per_sec=round(product_info['downloaded_bytes'] / max(seconds, 1e-6)),
+        segments=segments
+    )
+    return product_info
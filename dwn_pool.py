@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Bounded pool of download workers shared by the download scripts.
+
+Each product is downloaded by one worker, which keeps the retry logic of the
+original serial loop (up to `max_attempts` tries, retry on a corrupted file,
+give up immediately on an LTA error). Results of the workers are collected
+under a lock, so `return_values` and the last exception can be read safely
+once the pool has finished. The metadata of all products is requested at
+once before the downloads start, if aiohttp is installed (see
+async_client.py).
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from sentinelsat import InvalidChecksumError, SentinelAPILTAError
+from metrics import metrics
+from state_store import LeaseLostError
+import async_client
+import dwn_engine
+
+
+def download_product(api, product_id, dwndir, checksum=True, max_attempts=10,
+                     title=None, segments=1, product_info=None, lease=None):
+    """Download a single product, retrying on failure.
+
+    Interrupted downloads are resumed by the next attempt (see dwn_engine.py).
+    A known `product_info` is used by the first attempt, the others request
+    the metadata again. With the `lease` of a claimed product (see
+    state_store.py), the attempts stop as soon as the claim is lost.
+
+    Returns a tuple (product_info, last_exception). `product_info` is None if
+    all attempts failed.
+    """
+    if title is None:
+        title = product_id
+    last_exception = None
+
+    # For multiple attempts of loading the same file
+    for att_num in range(max_attempts):
+        if att_num > 0:
+            metrics.inc('download_retries_total')
+        try:
+            product_info = dwn_engine.download(api, product_id, dwndir, checksum,
+                                               segments, product_info=product_info,
+                                               lease=lease)
+            metrics.inc('downloads_total',
+                        result='done' if product_info['Online'] else 'triggered')
+            return product_info, None
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except LeaseLostError as e:
+            # Another downloader took over the product, not a failure
+            logging.warning(f"{e}, stopping the download of '{title}'")
+            return None, e
+        except InvalidChecksumError as e:
+            product_info = None
+            last_exception = e
+            logging.warning(
+                f"Invalid checksum. The downloaded file for '{title}' is corrupted."
+            )
+        except SentinelAPILTAError as e:
+            last_exception = e
+            logging.warning(
+                f"There was an error retrieving '{title}' from the LTA"
+            )
+            break
+        except Exception as e:
+            product_info = None
+            last_exception = e
+            logging.warning(f"There was an error downloading '{title}'.")
+
+    metrics.inc('downloads_total', result='failed')
+    metrics.event('download_failed', id=product_id, title=title,
+                  attempts=att_num + 1, error=repr(last_exception))
+    return None, last_exception
+
+
+def download_pool(api, uuid_list, dwndir, titles=None, workers=4,
+                  checksum=True, max_attempts=10, segments=1, on_done=None,
+                  pool=None):
+    """Download all products from `uuid_list` using a pool of `workers` threads.
+
+    Returns a tuple (return_values, failed, last_exception), where
+    `return_values` is an OrderedDict of product info (in the order of
+    `uuid_list`) for all successfully downloaded products and `failed` is a set
+    of UUIDs that could not be downloaded. The optional callback `on_done` is
+    called with the product info of every successful download as soon as it
+    finishes.
+
+    If a CredentialPool is given as `pool`, every product is downloaded with
+    the API of its account (see credentials.py) and `api` is not used.
+    """
+    if titles is None:
+        titles = {}
+    workers = max(1, min(workers, len(uuid_list)))
+    if pool is not None and workers > pool.capacity:
+        logging.warning(f"{workers} workers, but the {len(pool)} account(s) allow "
+                        f"only {pool.capacity} downloads at a time")
+
+    # Allow one pooled connection per worker (and segment) and disable the
+    # progress bars, which would overlap when several downloads run at once
+    apis = [api] if pool is None else [acc.api for acc in pool.accounts]
+    for api_ in apis:
+        adapter = HTTPAdapter(pool_connections=workers,
+                              pool_maxsize=workers * segments)
+        api_.session.mount("https://", adapter)
+        api_.session.mount("http://", adapter)
+        if workers > 1:
+            api_.show_progressbars = False
+
+    # Metadata of all products in a few concurrent requests instead of one
+    # request per product before every download
+    client = async_client.for_api(apis[0])
+    infos = client.run(client.odata_many(uuid_list)) if client is not None else {}
+
+    results = {}
+    state = {'done': 0, 'last_exception': None}
+    lock = threading.Lock()
+
+    def worker(product_id):
+        title = titles.get(product_id, product_id)
+        if pool is None:
+            logging.info(f"Start download of '{title}'")
+            product_info, exc = download_product(
+                api, product_id, dwndir, checksum, max_attempts, title, segments,
+                infos.get(product_id)
+            )
+        else:
+            # Wait for a free download slot of the account of the product
+            with pool.download_slot(product_id) as account:
+                logging.info(f"Start download of '{title}' ({account.username})")
+                product_info, exc = download_product(
+                    account.api, product_id, dwndir, checksum, max_attempts,
+                    title, segments, infos.get(product_id)
+                )
+        with lock:
+            if product_info is not None:
+                results[product_id] = product_info
+                if on_done is not None:
+                    on_done(product_info)
+            if exc is not None:
+                state['last_exception'] = exc
+            state['done'] += 1
+            metrics.set('queue_depth', len(uuid_list) - state['done'], stage='download')
+            # Log the number of files that were processed so far
+            logging.info(f"{state['done']}/{len(uuid_list)} products downloaded")
+
+    metrics.set('queue_depth', len(uuid_list), stage='download')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Consume the futures to re-raise KeyboardInterrupt/SystemExit
+        for future in [executor.submit(worker, pid) for pid in uuid_list]:
+            future.result()
+
+    return_values = OrderedDict(
+        (pid, results[pid]) for pid in uuid_list if pid in results
+    )
+    failed = set(uuid_list) - set(return_values)
+    return return_values, failed, state['last_exception']
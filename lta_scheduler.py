@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+IMPORTANT: Set your SciHUB account credentials in apihub.txt!
+
+Single scheduler for the LTA workflow that replaces running trigger_LTA.py and
+download_LTA.py one after another. The three stages run over the same CSV list
+(see query_list_LTA.py) at the same time:
+    - trigger: offline products are triggered one by one at the quota rate
+      (1 product per 30 min per user, see rate_limiter.py), using the account
+      of the pool whose next trigger slot opens first (see credentials.py),
+      in the order of the priority queue and only while the downloads can
+      drain them within their online window (see trigger_policy.py)
+    - poll: the 'Online' status of all pending products is checked together
+      in batched OData queries (see lta_status.py)
+    - download: products are downloaded as soon as they come online, by a
+      pool of download workers (each product is downloaded by the account
+      that triggered it), in the order of the priority queue, except for
+      products that have been online for more than half of the online window
+      (they are downloaded first, before they go offline again)
+
+The state of the products is kept in a state store next to the CSV file (see
+state_store.py), so the scheduler can be stopped and started again at any
+time. The scheduler sleeps until the next event (trigger slot, status poll or a
+finished download), so products that are already online never wait behind
+products that are still being restored from the LTA. Downloads are claimed
+under a lease, so several schedulers or download_LTA.py instances (also on
+other hosts) can share the list; the products of a downloader that stopped
+are taken over once its lease expires.
+"""
+
+import logging
+import sys
+
+from os.path import basename
+from datetime import datetime
+from time import monotonic, sleep
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import Counter
+from sentinelsat import SentinelAPILTAError
+from rate_limiter import is_quota_error, trigger_retrieval
+from credentials import CredentialPool
+from dwn_pool import download_product
+from lta_status import StatusPoller
+from state_store import CLAIMABLE, LeaseLostError, StateStore, worker_id
+from trigger_policy import TriggerPolicy
+from metrics import metrics
+
+
+class LTAScheduler:
+    """Pipeline triggering, polling and downloading of LTA products.
+
+    Parameters
+    ----------
+    pool : CredentialPool
+        SciHUB accounts used for triggering and downloading (see
+        credentials.py).
+    store : StateStore
+        State of the products in the list (see state_store.py).
+    dwndir : str
+        Download folder.
+    poll_interval : float
+        Seconds between two checks of the 'Online' status.
+    retrigger_after : float
+        Seconds after which a product that is still offline is triggered again.
+    workers : int, optional
+        Number of products downloaded at the same time, by default the sum of
+        the download limits of all accounts.
+    policy : TriggerPolicy, optional
+        Admission of new triggers (see trigger_policy.py).
+    max_trigger_errors : int
+        Failed triggers (other than quota errors) after which a product is
+        marked as failed. A product that failed to trigger moves to the end
+        of the queue.
+    """
+
+    def __init__(self, pool, store, dwndir,
+                 poll_interval=5 * 60, retrigger_after=24 * 60 * 60, workers=None,
+                 checksum=True, max_attempts=10, policy=None, max_trigger_errors=3):
+        self.pool = pool
+        self.api = pool.api
+        self.store = store
+        self.dwndir = dwndir
+        self.poll_interval = poll_interval
+        self.retrigger_after = retrigger_after
+        self.workers = workers if workers is not None else pool.capacity
+        if self.workers > pool.capacity:
+            logging.warning(f"{self.workers} workers, but the accounts allow only "
+                            f"{pool.capacity} downloads at a time")
+        self.checksum = checksum
+        self.max_attempts = max_attempts
+        self.policy = policy if policy is not None else TriggerPolicy(store)
+        self.max_trigger_errors = max_trigger_errors
+        self.trigger_errors = Counter()
+        self.owner = worker_id()
+
+        # Products of downloaders that have stopped are downloaded again
+        store.reclaim()
+
+        # Product status (see state_store.STATUSES), products that another
+        # process is downloading are marked as 'external'. The products are
+        # kept in the order of the priority queue.
+        products = store.queue()
+        self.titles = {pid: title for pid, title, _ in products}
+        self.status = {}
+        self.triggered_at = {}
+        self.online_at = {}
+        for pid, _, status in products:
+            self.status[pid] = self._local_status(status)
+            if status == 'triggered':
+                self.triggered_at[pid] = monotonic()
+        self.next_trigger = 0.
+        self.next_poll = 0.
+        self.running = {}
+        self.poller = StatusPoller(self.api, ttl=poll_interval)
+        self.counts = {'triggered': 0, 'downloaded': 0, 'failed': 0}
+
+    @staticmethod
+    def _local_status(status):
+        """Status of the scheduler for a status of the state store."""
+        if status in ('queued', 'online', 'failed'):
+            # Online status is checked again by the next poll
+            return 'queued'
+        if status == 'downloading':
+            return 'external'
+        return status
+
+    def pending(self, *states):
+        """List of products (in queue order) with one of the given states."""
+        return [pid for pid in self.titles if self.status[pid] in states]
+
+    def set_status(self, product_id, status):
+        """Change the status of a product, also in the state store (the claim
+        of a product downloaded by this scheduler is released).
+
+        Products that are not claimed by this scheduler are only changed
+        if nobody is downloading them. Returns False if the product was
+        claimed by another downloader (its status is read again).
+        """
+        if self.status.get(product_id) == 'downloading':
+            changed = self.store.release(product_id, status, self.owner)
+        else:
+            changed = self.store.transition(product_id, status, CLAIMABLE)
+        if not changed:
+            self.status[product_id] = self._local_status(self.store.status(product_id))
+            if self.status[product_id] == 'triggered':
+                self.triggered_at.setdefault(product_id, monotonic())
+            return False
+        self.status[product_id] = status
+        return True
+
+    def poll(self):
+        """Refresh the 'Online' status of all products waiting for download."""
+        # Products of other downloaders that have stopped are taken over
+        for pid in self.store.reclaim():
+            if self.status.get(pid) == 'external':
+                self.status[pid] = 'queued'
+        waiting = self.pending('queued', 'triggered')
+        if not waiting:
+            return
+        status = self.poller.refresh(waiting)
+        came_online = [pid for pid in waiting if status.get(pid)]
+        for pid in came_online:
+            # Time from the (last) trigger until the product is online
+            waited = self.store.since_trigger(pid)
+            if self.status[pid] == 'triggered' and waited is not None:
+                metrics.observe('wait_online_seconds', waited)
+                metrics.event('online', id=pid, title=self.titles[pid],
+                              wait_seconds=round(waited))
+            self.set_status(pid, 'online')
+            self.online_at[pid] = monotonic()
+        logging.info(
+            f"Status poll: {len(came_online)} of {len(waiting)} pending "
+            "products are online"
+        )
+
+    def trigger(self, now):
+        """Trigger the retrieval of the next offline product from the LTA."""
+        # New products only while the downloads can keep up with them
+        candidates = []
+        if self.pending('queued') and self.policy.admit():
+            candidates = self.pending('queued')
+        candidates += [
+            pid for pid in self.pending('triggered')
+            if now - self.triggered_at[pid] > self.retrigger_after
+        ]
+        if not candidates:
+            # Nothing to trigger, check again after the next status poll
+            self.next_trigger = now + self.poll_interval
+            return
+        product_id = candidates[0]
+        title = self.titles[product_id]
+        account = self.pool.trigger_account()
+        try:
+            product_info = trigger_retrieval(account.api, product_id, account.limiter,
+                                             block=False)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except SentinelAPILTAError as e:
+            if is_quota_error(e):
+                # The same product is tried again in the next slot
+                logging.info("User quota exceeded, postponing the next trigger")
+            else:
+                logging.info(f"There was an error retrieving {title} from the LTA")
+                self.trigger_failed(product_id, e)
+            self.next_trigger = now + self.pool.next_trigger_slot()
+            return
+        except Exception as e:
+            logging.info(f"There was an error triggering {title}")
+            logging.error(e)
+            self.trigger_failed(product_id, e)
+            self.next_trigger = now + self.poll_interval
+            return
+
+        self.next_trigger = now + self.pool.next_trigger_slot()
+        if product_info is None:
+            # No free trigger slot yet
+            return
+        self.pool.assign(product_id, account)
+        if product_info['Online']:
+            # Product came online in the meantime, it is downloaded by the
+            # download workers
+            if self.set_status(product_id, 'online'):
+                self.online_at[product_id] = now
+            return
+        logging.info(f"Triggered retrieval of {title} from the LTA ({account.username})")
+        if not self.set_status(product_id, 'triggered'):
+            return
+        self.triggered_at[product_id] = now
+        self.counts['triggered'] += 1
+
+    def trigger_failed(self, product_id, exc):
+        """Move a product that could not be triggered to the end of the
+        queue, or mark it as failed after `max_trigger_errors` errors."""
+        self.trigger_errors[product_id] += 1
+        if self.trigger_errors[product_id] >= self.max_trigger_errors:
+            if self.set_status(product_id, 'failed'):
+                self.counts['failed'] += 1
+                metrics.event('trigger_failed', id=product_id,
+                              title=self.titles[product_id], error=repr(exc))
+                logging.info(f"    ****  File {product_id} could not be triggered!\n")
+            return
+        # The other products are triggered first
+        self.titles[product_id] = self.titles.pop(product_id)
+
+    def download(self, product_id):
+        """Download a product with its account (runs in a worker thread)."""
+        with self.pool.download_slot(product_id) as account:
+            # The claim is renewed while the download runs
+            with self.store.lease(product_id, self.owner) as lease:
+                return download_product(
+                    account.api, product_id, self.dwndir, self.checksum,
+                    self.max_attempts, self.titles[product_id], lease=lease
+                )
+
+    def start_downloads(self, executor):
+        """Submit online products to the download pool (one per free worker
+        and free download slot of the product's account)."""
+        busy = Counter(self.pool.assign(pid).username for pid in self.running.values())
+        # Products that will soon go offline again come first
+        now = monotonic()
+        expiring = now - self.policy.online_window / 2
+        online = sorted(self.pending('online'),
+                        key=lambda pid: self.online_at.get(pid, now) > expiring)
+        for product_id in online:
+            if len(self.running) >= self.workers:
+                break
+            account = self.pool.assign(product_id)
+            if busy[account.username] >= account.max_downloads:
+                continue
+            # Claim the product, unless another downloader is already on it
+            if not self.store.claim(product_id, self.owner):
+                self.status[product_id] = 'external'
+                continue
+            self.status[product_id] = 'downloading'
+            logging.info(f"Start download of {self.titles[product_id]}")
+            future = executor.submit(self.download, product_id)
+            self.running[future] = product_id
+            busy[account.username] += 1
+
+    def collect(self, futures):
+        """Handle finished downloads."""
+        for future in futures:
+            product_id = self.running.pop(future)
+            product_info, exc = future.result()
+            if product_info is not None and not product_info['Online']:
+                # Product went offline again and its retrieval was triggered
+                self.set_status(product_id, 'triggered')
+                self.triggered_at[product_id] = monotonic()
+            elif product_info is not None:
+                self.finish(product_id, product_info)
+            elif isinstance(exc, LeaseLostError):
+                # Another downloader took over the product
+                self.status[product_id] = 'external'
+            elif isinstance(exc, SentinelAPILTAError):
+                # Product went offline again, wait for it to be restored
+                self.set_status(product_id, 'queued')
+            else:
+                self.set_status(product_id, 'failed')
+                self.counts['failed'] += 1
+                logging.info(f"    ****  File {product_id} could not be downloaded!\n")
+
+    def finish(self, product_id, product_info):
+        """Mark product as downloaded."""
+        if not self.set_status(product_id, 'done'):
+            return
+        self.counts['downloaded'] += 1
+        logging.info(f"Downloaded {product_info['title']}, product state updated\n")
+
+    def done(self):
+        return not self.pending('queued', 'triggered', 'online', 'downloading')
+
+    def run(self):
+        """Run the scheduler until all products are downloaded (or failed)."""
+        for account in self.pool.accounts:
+            account.api.show_progressbars = False
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self.done():
+                for status in ('queued', 'triggered', 'online', 'downloading'):
+                    metrics.set('queue_depth', len(self.pending(status)), stage=status)
+                now = monotonic()
+                if now >= self.next_poll:
+                    self.poll()
+                    self.next_poll = now + self.poll_interval
+                if now >= self.next_trigger:
+                    self.trigger(now)
+                self.start_downloads(executor)
+
+                # Sleep until the next trigger slot, status poll or until one
+                # of the running downloads finishes
+                if self.done():
+                    break
+                timeout = max(min(self.next_poll, self.next_trigger) - monotonic(), 0)
+                if self.running:
+                    finished, _ = wait(list(self.running), timeout=timeout,
+                                       return_when=FIRST_COMPLETED)
+                    self.collect(finished)
+                else:
+                    sleep(timeout)
+        return self.counts
+
+
+def main(dwndir, csvpath, logpath, apipath, workers=None, metpath=None):
+    # Configure file for logging
+    # ==========================
+    logging.basicConfig(
+        filename=logpath,
+        format="%(asctime)s - %(module)s - %(levelname)s - %(message)s",
+        level=logging.INFO
+    )
+    with open(logpath, "a") as f:
+        loghead = f"\nStarting a new session\n{datetime.now()}\n" + 26 * "=" + "\n"
+        f.write(loghead)
+    print("Started script lta_scheduler.py")
+    logging.info("Started script lta_scheduler.py")
+
+    # Timings and counters of all stages (see metrics.py)
+    metrics.configure(metpath)
+
+    # Read password file (one or more accounts)
+    # ==========================================
+    try:
+        pool = CredentialPool.from_file(apipath)
+    except IOError:
+        logging.error("Error reading the password file!")
+        sys.exit("Error reading the password file!")
+
+    # Connect to API using <username> and <password>
+    # ==============================================
+    print(f"Connecting to SciHub API with {len(pool)} account(s)...")
+
+    # Read CSV file
+    # =============
+    try:
+        store = StateStore.from_csv(csvpath)
+        pool.attach_store(store)
+        print(f"Import CSV file: {basename(csvpath)}")
+        logging.info(f"Import CSV file: {basename(csvpath)}")
+    except IOError:
+        logging.info("Error reading the CSV file!")
+        sys.exit("Error reading the CSV file!")
+    n_products = len(store.products())
+    print(f"Found {n_products} products in CSV list.\n")
+    logging.info(f"Found {n_products} products in CSV list.\n")
+
+    # Run the scheduler
+    # =================
+    scheduler = LTAScheduler(pool, store, dwndir, workers=workers)
+    counts = scheduler.run()
+
+    # Update the CSV file
+    store.export_csv(csvpath)
+    store.close()
+    metrics.close()
+
+    # End message
+    # ============
+    print("---------  Session finished  ---------")
+    logging.info(
+        f"{counts['triggered']} files triggered, {counts['downloaded']} files "
+        f"downloaded, {counts['failed']} files failed"
+    )
+    logging.info(f"---------  Session {dwndir} finished  ---------\n")
+    logging.shutdown()
+
+
+if __name__ == "__main__":
+    # Download folder
+    dwn_pth = "R:\\Sentinel-1_SLC\\"
+
+    # Path to CSV file with a list of products (see query_list_LTA.py)
+    csv_pth = ".\\userfiles\\slc_list.csv"
+
+    # Path to log file
+    log_pth = ".\\userfiles\\LOGFILE_scheduler.log"
+
+    # Path to file with SciHub credentials
+    api_pth = ".\\userfiles\\apihub.txt"
+
+    # Number of products downloaded at the same time (None: 2 per account)
+    max_workers = None
+
+    # Path (without extension) of the metrics files (.prom and .jsonl)
+    met_pth = ".\\userfiles\\metrics_scheduler"
+
+    main(dwn_pth, csv_pth, log_pth, api_pth, max_workers, met_pth)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Batched polling of the 'Online' status of products.
+
+Instead of one `api.get_product_odata()` call per product, the status of many
+products is obtained with a single OData query that filters on a list of
+UUIDs, e.g.:
+    odata/v1/Products?$filter=Id eq 'uuid1' or Id eq 'uuid2'&$select=Id,Online
+The results are cached for `ttl` seconds, so repeated checks of the same
+product do not cost another request until the cached value goes stale. If
+aiohttp is installed, all batches are sent at once over pooled connections
+(see async_client.py).
+"""
+
+import logging
+import threading
+
+from time import monotonic
+from urllib.parse import quote, urljoin
+from metrics import metrics
+import async_client
+
+
+class StatusPoller:
+    """Cache of the 'Online' status of products, refreshed in batches.
+
+    Parameters
+    ----------
+    api : SentinelAPI
+        Connected API instance (its session and api_url are used).
+    ttl : float
+        Seconds for which a cached status is considered fresh.
+    batch_size : int
+        Number of UUIDs in a single OData filter query (the length of the
+        query URL is limited on the server side).
+    """
+
+    def __init__(self, api, ttl=5 * 60, batch_size=20):
+        self.api = api
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _query_batch(self, product_ids):
+        """Fetch the 'Online' status of up to `batch_size` products."""
+        filt = " or ".join(f"Id eq '{pid}'" for pid in product_ids)
+        url = urljoin(
+            self.api.api_url,
+            "odata/v1/Products?$format=json&$select=Id,Online"
+            f"&$top={len(product_ids)}&$filter={quote(filt)}"
+        )
+        response = self.api.session.get(url, auth=self.api.session.auth,
+                                        timeout=self.api.timeout)
+        response.raise_for_status()
+        results = response.json()['d']['results']
+        return {item['Id']: bool(item['Online']) for item in results}
+
+    def _fetch_serial(self, product_ids):
+        """Fetch the status of `product_ids`, one batch after another."""
+        status = {}
+        for i in range(0, len(product_ids), self.batch_size):
+            batch = product_ids[i:i + self.batch_size]
+            try:
+                with metrics.timer('status_poll_seconds', mode='batch'):
+                    status.update(self._query_batch(batch))
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception as e:
+                metrics.inc('status_poll_errors_total')
+                # Fall back to one request per product for this batch
+                logging.warning("Batched status query failed, checking products one by one")
+                logging.error(e)
+                for pid in batch:
+                    try:
+                        with metrics.timer('status_poll_seconds', mode='single'):
+                            status[pid] = self.api.get_product_odata(pid)['Online']
+                    except (KeyboardInterrupt, SystemExit):
+                        raise
+                    except Exception as e:
+                        logging.warning(f"Could not check the status of {pid}")
+                        logging.error(e)
+        return status
+
+    def _fetch(self, product_ids):
+        """Fetch the status of `product_ids` in batches and update the cache."""
+        client = async_client.for_api(self.api)
+        if client is not None and len(product_ids) > self.batch_size:
+            # All batches at once
+            with metrics.timer('status_poll_seconds', mode='async'):
+                status = client.run(client.status(product_ids))
+        else:
+            status = self._fetch_serial(product_ids)
+        metrics.inc('status_poll_products_total', len(status))
+        now = monotonic()
+        with self._lock:
+            for pid, online in status.items():
+                self._cache[pid] = (online, now)
+        return status
+
+    def get(self, product_ids, refresh=False):
+        """Return a dict {uuid: Online} for `product_ids`.
+
+        Cached values younger than `ttl` are reused unless `refresh` is True.
+        Products whose status could not be obtained are left out.
+        """
+        product_ids = list(dict.fromkeys(product_ids))
+        now = monotonic()
+        status = {}
+        with self._lock:
+            for pid in product_ids:
+                cached = self._cache.get(pid)
+                if not refresh and cached is not None and now - cached[1] < self.ttl:
+                    status[pid] = cached[0]
+        stale = [pid for pid in product_ids if pid not in status]
+        if stale:
+            status.update(self._fetch(stale))
+        return status
+
+    def refresh(self, product_ids):
+        """Fetch the current status of `product_ids`, ignoring the cache."""
+        return self.get(product_ids, refresh=True)
+
+    def is_online(self, product_id, refresh=False):
+        """Status of a single product (False if it could not be obtained)."""
+        return self.get([product_id], refresh).get(product_id, False)
+
+    def invalidate(self, product_id=None):
+        """Drop the cached status of a product (or of all products)."""
+        with self._lock:
+            if product_id is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(product_id, None)
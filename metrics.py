@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Timings and counters of the download and LTA stages.
+
+All modules record into the process-wide `metrics` object:
+    - counters, e.g. `metrics.inc('triggers_total', result='accepted')`
+    - gauges, e.g. `metrics.set('queue_depth', 12, status='triggered')`
+    - timings, e.g. `with metrics.timer('status_poll_seconds'): ...`
+    - events with details of a single product, e.g. a finished download
+Nothing is written until `metrics.configure()` is called by a script. Then
+the events are appended to `<path>.jsonl` (one JSON object per line) and all
+values are written to `<path>.prom` in the Prometheus text format (which can
+be read by the textfile collector of the node exporter). Optionally the same
+text is served over HTTP on `port` (e.g. http://localhost:9108/metrics).
+
+Stages: query, status_poll, trigger, wait_online, transfer, checksum, write.
+"""
+
+import json
+import logging
+import os
+import threading
+
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from time import perf_counter, monotonic
+
+
+PREFIX = "scihub_"
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format(name, labels, value):
+    if labels:
+        text = ",".join(f'{k}="{v}"' for k, v in labels)
+        return f"{PREFIX}{name}{{{text}}} {value}"
+    return f"{PREFIX}{name} {value}"
+
+
+class Metrics:
+    """Registry of counters, gauges and timings.
+
+    Parameters
+    ----------
+    flush_interval : float
+        Minimum number of seconds between two writes of the Prometheus file.
+    """
+
+    def __init__(self, flush_interval=15):
+        self.flush_interval = flush_interval
+        self.counters = {}
+        self.gauges = {}
+        self.summaries = {}
+        self.prom_path = None
+        self._jsonl = None
+        self._server = None
+        self._last_flush = 0.
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def configure(self, path=None, port=None):
+        """Write metrics to `<path>.jsonl` and `<path>.prom`, serve on `port`."""
+        if path is not None:
+            self._jsonl = open(path + ".jsonl", "a")
+            self.prom_path = path + ".prom"
+        if port is not None:
+            self.serve(port)
+
+    def inc(self, name, value=1, **labels):
+        """Increase a counter."""
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self._maybe_flush()
+
+    def set(self, name, value, **labels):
+        """Set a gauge."""
+        with self._lock:
+            self.gauges[(name, _labels(labels))] = value
+
+    def observe(self, name, value, **labels):
+        """Record a single value (e.g. a duration) of a summary."""
+        key = (name, _labels(labels))
+        with self._lock:
+            count, total = self.summaries.get(key, (0, 0.))
+            self.summaries[key] = (count + 1, total + value)
+        self._maybe_flush()
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the duration (seconds) of the `with` block."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def event(self, kind, **fields):
+        """Append an event to the JSON-lines log."""
+        if self._jsonl is None:
+            return
+        record = {"time": datetime.utcnow().isoformat(), "event": kind}
+        record.update(fields)
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._jsonl.write(line + "\n")
+            self._jsonl.flush()
+
+    def render(self):
+        """All values in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(values.items()):
+                    if name not in typed:
+                        lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                        typed.add(name)
+                    lines.append(_format(name, labels, value))
+            typed = set()
+            for (name, labels), (count, total) in sorted(self.summaries.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {PREFIX}{name} summary")
+                    typed.add(name)
+                lines.append(_format(name + "_count", labels, count))
+                lines.append(_format(name + "_sum", labels, f"{total:.6f}"))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path=None):
+        """Write the Prometheus file (atomically, it may be read at any time)."""
+        path = path if path is not None else self.prom_path
+        if path is None:
+            return
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+        self._last_flush = monotonic()
+
+    def _maybe_flush(self):
+        if self.prom_path is None or monotonic() - self._last_flush < self.flush_interval:
+            return
+        # Only one thread writes the file, the others do not wait for it
+        if not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            self.write_prometheus()
+        except OSError as e:
+            logging.warning(f"Could not write metrics: {e}")
+        finally:
+            self._flush_lock.release()
+
+    def serve(self, port):
+        """Serve the metrics over HTTP (in a background thread)."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = HTTPServer(("", port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        thread.start()
+        logging.info(f"Serving metrics on port {port}")
+
+    def close(self):
+        """Write the final values and close the outputs."""
+        with self._flush_lock:
+            self.write_prometheus()
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+
+# Registry shared by all modules of the process
+metrics = Metrics()
@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Local mock of the SciHUB (DHuS) API, for benchmarks without the real hub.
+
+The server generates a catalog of fake Sentinel-1 products and implements the
+parts of the API that are used by sentinelsat and by the scripts:
+    - OpenSearch queries (search?q=...), paginated and ordered, filtered by
+      the date ranges, platform, product type and footprint of the query
+    - OData metadata of a product and batched metadata or 'Online' status
+      queries
+    - downloads ($value) with HTTP Range support; offline products return
+      202 (retrieval triggered) and come online after `restore_latency`
+    - the LTA quota of every user (403 when it is exceeded)
+Optionally the bandwidth of every connection is limited and a part of the
+downloads is cut off, to exercise resumed downloads. With `safe=True` the
+products are real zip files with the layout of a Sentinel-1 SAFE product
+(manifest, annotation XMLs and measurement TIFFs), e.g. for safe_extract.py.
+
+Point the scripts to the mock by setting `credentials.API_URL` (or the
+SCIHUB_API_URL environment variable) to the URL returned by `start()`. Run
+this file to start a server on its own:
+    python mock_dhus.py --port 8080 --products 200
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import zipfile
+
+from collections import OrderedDict, deque
+from io import BytesIO
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+from urllib.parse import urlsplit, parse_qs, unquote
+from uuid import UUID
+from shapely import wkt
+from shapely.geometry import box
+from query_engine import parse_date, format_date
+
+
+class MockProduct:
+    """A fake product of the mock hub."""
+
+    def __init__(self, uuid, title, begin, ingestion, footprint, size, md5, online):
+        self.uuid = uuid
+        self.title = title
+        self.begin = begin
+        self.ingestion = ingestion
+        self.footprint = footprint
+        self.size = size
+        self.md5 = md5
+        self.online = online
+        self.restored_at = None
+        self.data = None
+
+
+def _odata_date(value):
+    return f"/Date({int((value - datetime(1970, 1, 1)).total_seconds() * 1000)})/"
+
+
+def _gml(geom):
+    # DHuS writes the coordinates as "lat,lon"
+    coords = " ".join(f"{y},{x}" for x, y in geom.exterior.coords)
+    return (
+        '<gml:Polygon srsName="http://www.opengis.net/gml/srs/epsg.xml#4326" '
+        'xmlns:gml="http://www.opengis.net/gml"><gml:outerBoundaryIs>'
+        f'<gml:LinearRing><gml:coordinates>{coords}</gml:coordinates>'
+        '</gml:LinearRing></gml:outerBoundaryIs></gml:Polygon>'
+    )
+
+
+class MockDHuS:
+    """Catalog, LTA state and HTTP server of the mock hub.
+
+    Parameters
+    ----------
+    n_products : int
+        Number of products in the catalog.
+    size : int
+        Size of every product in bytes.
+    offline_ratio : float
+        Share of the products that are in the LTA at the start.
+    restore_latency : float
+        Seconds from a trigger until the product is online.
+    quota : tuple
+        LTA quota of every user: (triggers, period in seconds).
+    start : datetime
+        Acquisition time of the first product.
+    step : timedelta
+        Time between two acquisitions.
+    area : geometry
+        Products are placed on a grid of frames over this area.
+    ingestion_delay : timedelta
+        Time from the acquisition until the product is published.
+    bandwidth : float, optional
+        Bytes per second of a single download connection.
+    cut_ratio : float
+        Share of the downloads that are cut off half way.
+    seed : int
+        Seed of the random generator (same catalog for the same seed).
+    safe : bool
+        Products are SAFE zip files (kept in memory) of about `size` bytes.
+    """
+
+    def __init__(self, n_products=50, size=4 * 2 ** 20, offline_ratio=0.5,
+                 restore_latency=5., quota=(1, 31 * 60), start=datetime(2017, 1, 1),
+                 step=timedelta(hours=12), area=box(13.0, 45.0, 17.0, 47.0),
+                 ingestion_delay=timedelta(hours=3), bandwidth=None, cut_ratio=0.,
+                 seed=0, safe=False):
+        self.restore_latency = restore_latency
+        self.quota = quota
+        self.bandwidth = bandwidth
+        self.cut_ratio = cut_ratio
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.triggers = {}
+        self.stats = {'requests': 0, 'queries': 0, 'odata': 0, 'triggers': 0,
+                      'quota_errors': 0, 'downloads': 0, 'bytes': 0}
+
+        # All products share one block of random data, the first 32 bytes
+        # (the UUID) make the checksums different
+        self.size = size
+        self.block = bytes(self.random.getrandbits(8) for _ in range(min(size, 2 ** 16)))
+        self.products = OrderedDict()
+        minx, miny, maxx, maxy = area.bounds
+        for i in range(n_products):
+            uuid = str(UUID(int=self.random.getrandbits(128), version=4))
+            begin = start + i * step
+            # Frames of 2.5 x 2 degrees moving over the area
+            x = minx + (i * 1.5) % max(maxx - minx - 2.5, 1.)
+            y = miny + (i * 0.7) % max(maxy - miny - 2., 1.)
+            title = (f"S1A_IW_SLC__1SDV_{begin:%Y%m%dT%H%M%S}_"
+                     f"{begin + timedelta(seconds=25):%Y%m%dT%H%M%S}_{i:06d}_MOCK")
+            product = MockProduct(uuid, title, begin, begin + ingestion_delay,
+                                  box(x, y, x + 2.5, y + 2.), size, None,
+                                  self.random.random() >= offline_ratio)
+            if safe:
+                product.data = self._safe_zip(product)
+                product.size = len(product.data)
+            product.md5 = self._md5(product)
+            self.products[uuid] = product
+        self.server = None
+        self.url = None
+
+    # Product data
+    # ============
+    def _safe_zip(self, product):
+        """Zip file with the layout of a Sentinel-1 SLC SAFE product."""
+        safe = product.title + '.SAFE'
+        files = [f"s1a-iw{swath}-slc-{pol}-{product.begin:%Y%m%dt%H%M%S}-{swath:03d}"
+                 for swath in (1, 2, 3) for pol in ('vv', 'vh')]
+        tiff_size = max(self.size // len(files), 1)
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr(f"{safe}/manifest.safe",
+                        f"<xfdu:XFDU><metadataSection>{product.uuid}"
+                        f"</metadataSection></xfdu:XFDU>\n" * 50)
+            for name in files:
+                zf.writestr(f"{safe}/annotation/{name}.xml",
+                            f"<product><adsHeader>{name}</adsHeader></product>\n" * 200)
+            block = product.uuid.encode() + self.block
+            data = block * (tiff_size // len(block) + 1)
+            for name in files:
+                # Measurements are stored uncompressed (like in the SAFE zips)
+                zf.writestr(f"{safe}/measurement/{name}.tiff", data[:tiff_size],
+                            compress_type=zipfile.ZIP_STORED)
+        return buffer.getvalue()
+
+    def read(self, product, start, end):
+        """Bytes `start` to `end` (inclusive) of a product."""
+        if product.data is not None:
+            return product.data[start:end + 1]
+        header = product.uuid.replace('-', '').encode()
+        data = bytearray()
+        pos = start
+        while pos <= end:
+            if pos < len(header):
+                part = header[pos:end + 1]
+            else:
+                offset = pos % len(self.block)
+                part = self.block[offset:offset + end + 1 - pos]
+            data += part
+            pos += len(part)
+        return bytes(data)
+
+    def _md5(self, product):
+        md5 = hashlib.md5()
+        for pos in range(0, product.size, 2 ** 20):
+            md5.update(self.read(product, pos, min(pos + 2 ** 20, product.size) - 1))
+        return md5.hexdigest()
+
+    def is_online(self, product):
+        if product.online:
+            return True
+        if product.restored_at is not None and monotonic() >= product.restored_at:
+            product.online = True
+        return product.online
+
+    def trigger(self, product, user):
+        """Trigger the retrieval of a product, return the HTTP status code."""
+        with self.lock:
+            if product.restored_at is not None:
+                # Retrieval is already running
+                return 202
+            now = monotonic()
+            history = self.triggers.setdefault(user, deque())
+            while history and now - history[0] > self.quota[1]:
+                history.popleft()
+            if len(history) >= self.quota[0]:
+                self.stats['quota_errors'] += 1
+                return 403
+            history.append(now)
+            product.restored_at = now + self.restore_latency
+            self.stats['triggers'] += 1
+            return 202
+
+    # OpenSearch
+    # ==========
+    def search(self, query, rows, start, orderby):
+        """Products matching a query string, one page."""
+        selected = list(self.products.values())
+        for attr, low, high in re.findall(r"(\w+):\[(\S+) TO (\S+)\]", query):
+            key = {'beginposition': 'begin', 'endposition': 'begin',
+                   'ingestiondate': 'ingestion'}.get(attr.lower())
+            if key is None:
+                continue
+            low = parse_date(low) if low != '*' else None
+            high = parse_date(high) if high != '*' else None
+            selected = [
+                p for p in selected
+                if (low is None or getattr(p, key) >= low)
+                and (high is None or getattr(p, key) <= high)
+            ]
+        match = re.search(r'footprint:"Intersects\((.+)\)"', query)
+        if match:
+            area = wkt.loads(match.group(1))
+            selected = [p for p in selected if p.footprint.intersects(area)]
+        for attr, value in re.findall(r"(platformname|producttype):(\S+)", query):
+            if value not in ('Sentinel-1', 'SLC'):
+                selected = []
+        if orderby:
+            attr, _, direction = orderby.partition(' ')
+            key = 'ingestion' if attr == 'ingestiondate' else 'begin'
+            selected.sort(key=lambda p: getattr(p, key), reverse=direction == 'desc')
+        return selected[start:start + rows], len(selected)
+
+    def entry(self, product):
+        """OpenSearch entry of a product."""
+        value = f"{self.url}odata/v1/Products('{product.uuid}')/$value"
+        return {
+            'id': product.uuid,
+            'title': product.title,
+            'link': [{'href': value},
+                     {'rel': 'alternative', 'href': value[:-len('/$value')]},
+                     {'rel': 'icon', 'href': value[:-len('$value')] + 'Products(\'Quicklook\')/$value'}],
+            'summary': f"Date: {format_date(product.begin)}, Instrument: SAR-C, Satellite: Sentinel-1",
+            'date': [{'name': 'beginposition', 'content': format_date(product.begin)},
+                     {'name': 'endposition', 'content': format_date(product.begin + timedelta(seconds=25))},
+                     {'name': 'ingestiondate', 'content': format_date(product.ingestion)}],
+            'str': [{'name': 'footprint', 'content': product.footprint.wkt},
+                    {'name': 'platformname', 'content': 'Sentinel-1'},
+                    {'name': 'producttype', 'content': 'SLC'},
+                    {'name': 'identifier', 'content': product.title},
+                    {'name': 'uuid', 'content': product.uuid},
+                    {'name': 'size', 'content': f"{product.size / 2 ** 20:.2f} MB"}],
+        }
+
+    def odata(self, product):
+        """OData metadata of a product."""
+        return {
+            'Id': product.uuid,
+            'Name': product.title,
+            'ContentLength': str(product.size),
+            'Checksum': {'Algorithm': 'MD5', 'Value': product.md5.upper()},
+            'ContentDate': {'Start': _odata_date(product.begin),
+                            'End': _odata_date(product.begin + timedelta(seconds=25))},
+            'ContentGeometry': _gml(product.footprint),
+            'Online': self.is_online(product),
+            'CreationDate': _odata_date(product.ingestion),
+            'IngestionDate': _odata_date(product.ingestion),
+            '__metadata': {'media_src': f"{self.url}odata/v1/Products('{product.uuid}')/$value"},
+            'Attributes': {'results': []},
+        }
+
+    # Server
+    # ======
+    def start(self, host='127.0.0.1', port=0):
+        """Start the server in a background thread, return its API URL."""
+        hub = self
+
+        class Handler(_Handler):
+            mock = hub
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_port}/"
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        return self.url
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def reset_stats(self):
+        with self.lock:
+            for key in self.stats:
+                self.stats[key] = 0
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """HTTP handler of the mock hub (`mock` is set by `MockDHuS.start()`)."""
+
+    protocol_version = 'HTTP/1.1'
+    mock = None
+
+    def log_message(self, *args):
+        pass
+
+    def _user(self):
+        auth = self.headers.get('Authorization', '')
+        if auth.startswith('Basic '):
+            return base64.b64decode(auth[6:]).decode().split(':')[0]
+        return None
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_status(self, status, message=''):
+        body = message.encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        if message:
+            self.send_header('cause-message', message)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _product(self, path):
+        match = re.search(r"Products\('([^']+)'\)", unquote(path))
+        if match is None:
+            return None
+        return self.mock.products.get(match.group(1))
+
+    def do_POST(self):
+        mock = self.mock
+        mock.count('requests')
+        url = urlsplit(self.path)
+        if not url.path.endswith('/search'):
+            return self._send_status(404, 'Not found')
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        params = parse_qs(url.query)
+        mock.count('queries')
+        page, total = mock.search(form.get('q', [''])[0],
+                                  int(params.get('rows', ['100'])[0]),
+                                  int(params.get('start', ['0'])[0]),
+                                  params.get('orderby', [None])[0])
+        self._send_json({'feed': {'opensearch:totalResults': str(total),
+                                  'entry': [mock.entry(p) for p in page]}})
+
+    def do_GET(self):
+        mock = self.mock
+        mock.count('requests')
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        if path.endswith('/$value'):
+            return self._download(self._product(path))
+        if path.endswith('/odata/v1/Products'):
+            # Batched query: $filter=Id eq 'a' or Id eq 'b', the full metadata
+            # or only the status ($select=Id,Online)
+            mock.count('odata')
+            params = parse_qs(url.query)
+            filt = params.get('$filter', [''])[0]
+            select = params.get('$select', [''])[0]
+            results = [
+                {'Id': pid, 'Online': mock.is_online(mock.products[pid])}
+                if select == 'Id,Online' else mock.odata(mock.products[pid])
+                for pid in re.findall(r"Id eq '([^']+)'", filt) if pid in mock.products
+            ]
+            return self._send_json({'d': {'results': results}})
+        product = self._product(path)
+        if product is None:
+            return self._send_status(404, 'Product not found')
+        mock.count('odata')
+        self._send_json({'d': mock.odata(product)})
+
+    def _download(self, product):
+        mock = self.mock
+        if product is None:
+            return self._send_status(404, 'Product not found')
+        if not mock.is_online(product):
+            status = mock.trigger(product, self._user())
+            message = {403: 'Requests for retrieval from LTA exceed user quota',
+                       202: 'Accepted for retrieval'}[status]
+            return self._send_status(status, message)
+
+        start, end = 0, product.size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), end) if match.group(2) else end
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{product.size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        mock.count('downloads')
+
+        # Cut off a part of the downloads half way
+        with mock.lock:
+            cut = mock.random.random() < mock.cut_ratio
+        stop = start + (end - start) // 2 if cut else end
+        pos = start
+        block = 2 ** 16
+        while pos <= stop:
+            data = mock.read(product, pos, min(pos + block, stop + 1) - 1)
+            self.wfile.write(data)
+            mock.count('bytes', len(data))
+            pos += len(data)
+            if mock.bandwidth:
+                sleep(len(data) / mock.bandwidth)
+        if cut:
+            self.close_connection = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock SciHUB (DHuS) server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--products", type=int, default=50)
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--offline", type=float, default=0.5,
+                        help="share of the products in the LTA")
+    parser.add_argument("--restore", type=float, default=5.,
+                        help="seconds until a triggered product is online")
+    parser.add_argument("--quota", type=float, nargs=2, default=(1, 31 * 60),
+                        metavar=("TRIGGERS", "SECONDS"))
+    parser.add_argument("--safe", action="store_true",
+                        help="serve SAFE zip files instead of random data")
+    args = parser.parse_args()
+
+    hub = MockDHuS(args.products, int(args.size_mb * 2 ** 20), args.offline,
+                   args.restore, (int(args.quota[0]), args.quota[1]), safe=args.safe)
+    print(f"Mock DHuS running on {hub.start(args.host, args.port)}")
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        hub.stop()
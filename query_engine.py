@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Paginated and cached queries of the SciHUB OpenSearch API.
+
+Instead of one `api.query()` call for the whole date range, which loads all
+results into memory at once, the query is split into time windows (by
+'beginposition') and every window is fetched page by page:
+    - products are yielded one by one, sorted by 'beginposition', so a long
+      list can be written out without keeping it in memory
+    - the pages of every window are cached on disk (one JSON file per page),
+      keyed by the query string, so identical queries are not sent again
+    - windows that end more than `recent` ago do not change any more and are
+      always read from the cache; recent windows are fetched again once their
+      cache is older than `recent_ttl`
+Windows are aligned to a fixed grid, so a query with a moving date range
+(e.g. 'NOW-2MONTHS') still reuses the cached windows of earlier runs.
+The first page of a window gives the number of products, the remaining pages
+are then requested several at a time if aiohttp is installed (see
+async_client.py).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import pandas as pd
+
+from os.path import join, exists
+from datetime import datetime, date, timedelta
+from time import time
+from sentinelsat.sentinel import _parse_opensearch_response
+from metrics import metrics
+import async_client
+
+
+# Results inside a window are sorted by acquisition time
+ORDER_BY = "beginposition asc"
+
+# Origin of the grid of time windows
+GRID_ORIGIN = datetime(2014, 1, 1)
+
+# Dates relative to now, e.g. 'NOW-2DAYS' or 'NOW-1MONTH+12HOURS'
+NOW_PATTERN = re.compile(r"^NOW((?:[-+]\d+(?:YEAR|MONTH|DAY|HOUR|MINUTE|SECOND)S?)*)$")
+NOW_STEP = re.compile(r"([-+]\d+)(YEAR|MONTH|DAY|HOUR|MINUTE|SECOND)S?")
+
+
+def parse_date(value, now=None):
+    """Convert a query date (see `sentinelsat.format_query_date`) to datetime.
+
+    Returns None for dates that can not be resolved locally (e.g. None, '*' or
+    dates rounded with '/DAY').
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    value = value.strip()
+    match = NOW_PATTERN.match(value)
+    if match:
+        result = pd.Timestamp(now if now is not None else datetime.utcnow())
+        for step, unit in NOW_STEP.findall(match.group(1)):
+            result += pd.DateOffset(**{unit.lower() + "s": int(step)})
+        return result.to_pydatetime()
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ", "%Y%m%d"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+def format_date(value):
+    """Format a datetime for a query, with millisecond precision."""
+    return value.strftime("%Y-%m-%dT%H:%M:%S.") + f"{value.microsecond // 1000:03d}Z"
+
+
+class QueryEngine:
+    """Split queries into time windows, fetch them lazily and cache the pages.
+
+    Parameters
+    ----------
+    api : SentinelAPI
+        Connected API instance.
+    cachedir : str, optional
+        Folder for cached pages (created if missing). Without it nothing is
+        cached, but the results are still streamed window by window.
+    window : timedelta
+        Length of a time window.
+    page_size : int
+        Number of products per request (max. 100 on SciHUB).
+    recent : timedelta
+        Windows ending less than `recent` ago may still get new products
+        (late ingestion) and are fetched again when their cache is stale.
+    recent_ttl : float
+        Seconds for which the cache of a recent window is used.
+    """
+
+    def __init__(self, api, cachedir=None, window=timedelta(days=30), page_size=100,
+                 recent=timedelta(days=30), recent_ttl=60 * 60):
+        self.api = api
+        self.cachedir = cachedir
+        self.window = window
+        self.page_size = page_size
+        self.recent = recent
+        self.recent_ttl = recent_ttl
+        if cachedir is not None:
+            os.makedirs(cachedir, exist_ok=True)
+
+    def windows(self, start, end, now=None):
+        """List of (start, end, stable) of the windows covering a date range.
+
+        Start and end of a window are formatted query dates (both inclusive),
+        `stable` is True if the window can not get new products any more.
+        """
+        if now is None:
+            now = datetime.utcnow()
+        t_start = parse_date(start, now)
+        t_end = parse_date(end, now)
+        if t_start is None or t_end is None:
+            # Range can not be split, query it as a single (unstable) window
+            return [(start, end, False)]
+
+        one_ms = timedelta(milliseconds=1)
+        windows = []
+        t0 = t_start
+        while t0 <= t_end:
+            # Next point on the grid after t0
+            n_windows = (t0 - GRID_ORIGIN) // self.window + 1
+            t_next = min(GRID_ORIGIN + n_windows * self.window, t_end + one_ms)
+            t1 = t_next - one_ms
+            windows.append((format_date(t0), format_date(t1), t1 < now - self.recent))
+            t0 = t_next
+        return windows
+
+    def _key(self, query):
+        params = [self.api.api_url, query, ORDER_BY, self.page_size]
+        return hashlib.sha1(json.dumps(params).encode()).hexdigest()
+
+    def _index_path(self, key):
+        return join(self.cachedir, f"{key}.json")
+
+    def _page_path(self, key, page):
+        return join(self.cachedir, f"{key}-{page}.json")
+
+    @staticmethod
+    def _read(path):
+        with open(path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def _write(path, data):
+        # Write to a temporary file first, so a cache file is never half written
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def _cached(self, key):
+        """Index of a cached window if it can be used, otherwise None."""
+        if self.cachedir is None or not exists(self._index_path(key)):
+            return None
+        index = self._read(self._index_path(key))
+        if not index["stable"] and time() - index["fetched"] > self.recent_ttl:
+            return None
+        if not all(exists(self._page_path(key, p)) for p in range(index["pages"])):
+            return None
+        return index
+
+    def _fetch(self, query, key, stable):
+        """Fetch all pages of a window, yield the raw entries of every page."""
+        client = async_client.for_api(self.api)
+        # The API returns at most `api.page_size` products per page
+        limit = min(self.page_size, self.api.page_size)
+        # The first page also gives the number of products in the window
+        with metrics.timer('query_seconds', source='fetch'):
+            entries, count = self.api._load_subquery(query, ORDER_BY, limit, 0)
+        offset = 0
+        page = 0
+        fetched = []
+        while True:
+            metrics.inc('query_products_total', len(entries), source='fetch')
+            if self.cachedir is not None:
+                self._write(self._page_path(key, page), entries)
+            yield entries
+            offset += len(entries)
+            page += 1
+            if not entries or offset >= count:
+                break
+            if fetched:
+                entries = fetched.pop(0)
+            elif client is not None:
+                # Next pages at once, over the pooled connections
+                offsets = list(range(offset, count, limit))[:client.concurrency]
+                with metrics.timer('query_seconds', source='fetch'):
+                    fetched = client.run(client.query_pages(query, offsets, limit,
+                                                            ORDER_BY))
+                entries = fetched.pop(0)
+            else:
+                with metrics.timer('query_seconds', source='fetch'):
+                    entries, count = self.api._load_subquery(query, ORDER_BY, limit,
+                                                             offset)
+        if self.cachedir is not None:
+            # The window is only complete once the index is written
+            self._write(self._index_path(key), {
+                "query": query, "pages": page, "count": count,
+                "stable": stable, "fetched": time()
+            })
+
+    def pages(self, area=None, start=None, end=None, **keywords):
+        """Yield the pages of a query as dicts {uuid: properties}.
+
+        `start` and `end` limit the 'beginposition' of the products, other
+        keywords are passed to `api.format_query()`.
+        """
+        for w_start, w_end, stable in self.windows(start, end):
+            query = self.api.format_query(area, beginposition=(w_start, w_end), **keywords)
+            key = self._key(query)
+            index = self._cached(key)
+            if index is not None:
+                logging.info(f"Query window {w_start} - {w_end}: "
+                             f"{index['count']} products (cached)")
+                for page in range(index["pages"]):
+                    with metrics.timer('query_seconds', source='cache'):
+                        entries = self._read(self._page_path(key, page))
+                    metrics.inc('query_products_total', len(entries), source='cache')
+                    yield _parse_opensearch_response(entries)
+            else:
+                logging.info(f"Query window {w_start} - {w_end}: fetching")
+                for entries in self._fetch(query, key, stable):
+                    yield _parse_opensearch_response(entries)
+
+    def products(self, area=None, start=None, end=None, **keywords):
+        """Yield (uuid, properties) of all products, sorted by 'beginposition'."""
+        seen = set()
+        for page in self.pages(area, start, end, **keywords):
+            for product_id, properties in page.items():
+                # Products may move between pages if new ones are ingested
+                if product_id not in seen:
+                    seen.add(product_id)
+                    yield product_id, properties
@@ -8,52 +8,85 @@ Created on Thu Aug 22 10:12:00 2019
 IMPORTANT: Set your SciHUB account credentials in apihub.txt!
 
 The script creates CSV file containing the list of files to be downloaded from
-SciHUB API. The list includes file ID, title, and downloaded status.
+SciHUB API. The list includes file ID, title, and downloaded status (and the
+names of the AOIs of every product when several AOIs are queried, see
+aoi_planner.py).
+
+The query is split into time windows, which are fetched page by page and
+cached on disk (see query_engine.py), so the products are written to the CSV
+file as they arrive and repeated queries only fetch the recent windows again.
+
+Only the products that are needed are written to the list, so no LTA quota
+is spent on the others: the query results are selected by orbit,
+polarisation, size and coverage of the AOIs, reprocessed duplicates are
+dropped and optionally only the best frame of every pass is kept (see
+selection.py). The selection needs the whole query result at once.
 """
 
+import csv
 import os
 import sys
 
 from shapely.geometry import box
-from sentinelsat import SentinelAPI
+from credentials import CredentialPool
+from query_engine import QueryEngine
+from aoi_planner import QueryPlanner, read_aois
+from selection import select_products
 # from sentinelsat import read_geojson, geojson_to_wkt
 
 
-def main(csvpath, apipath, qp):
-    # Read password file
-    # ==================
+def main(csvpath, apipath, qp, cachedir=None, sel=None):
+    # Read password file (one or more accounts)
+    # ==========================================
     try:
-        with open(apipath) as f:
-            (usrnam, psswrd) = f.readline().split(" ")
-            if psswrd.endswith("\n"):
-                psswrd = psswrd[:-1]
+        pool = CredentialPool.from_file(apipath)
     except IOError:
         sys.exit("Error reading the password file!")
 
     # Connect to API using <username> and <password>
     # ===============================================
-    print("Connecting to SciHub API...")
-    api = SentinelAPI(usrnam, psswrd, "https://scihub.copernicus.eu/dhus")
+    print(f"Connecting to SciHub API with {len(pool)} account(s)...")
+    api = pool.api
 
     # Search by SciHub query keywords
     # ===============================
-    products = api.query(qp['footprint'],
-                         beginposition=(qp['strtime'], qp['endtime']),
-                         endposition=(qp['strtime'], qp['endtime']),
-                         platformname=qp['platformname'],
-                         producttype=qp['producttype'])
-
-    # Convert to Pandas DataFrame and sort by date ascending
-    # ======================================================
-    products_df = api.to_dataframe(products)
-    products_df_sorted = products_df.sort_values('beginposition', ascending=True)
+    # Products are returned sorted by date ascending
+    engine = QueryEngine(api, cachedir)
+    keywords = dict(endposition=(qp['strtime'], qp['endtime']),
+                    platformname=qp['platformname'],
+                    producttype=qp['producttype'])
+    if qp.get('aois'):
+        # One planned set of queries for all AOIs, the names of the AOIs of
+        # every product are added to the list
+        planner = QueryPlanner(engine, read_aois(qp['aois']))
+        products = planner.products(qp['strtime'], qp['endtime'], **keywords).items()
+    else:
+        products = engine.products(qp['footprint'], qp['strtime'], qp['endtime'],
+                                   **keywords)
+
+    # Select the products that are needed
+    # ===================================
+    if sel:
+        aois = planner.aois if qp.get('aois') else [('footprint', qp['footprint'])]
+        products = select_products(products, aois, **sel).items()
 
     # Save to CSV file
     # ================
     print(f"Saving list to {os.path.basename(csvpath)}")
-    prep_csv = products_df_sorted[['uuid', 'title']]
-    prep_csv.insert(2, "downloaded", False, allow_duplicates=True)
-    prep_csv.to_csv(csvpath, index=False)
+    n_products = 0
+    tmp_path = csvpath + '.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        header = ['uuid', 'title', 'downloaded']
+        writer.writerow(header + ['aois'] if qp.get('aois') else header)
+        for product_id, properties in products:
+            row = [product_id, properties['title'], False]
+            if 'aois' in properties:
+                row.append(";".join(properties['aois']))
+            writer.writerow(row)
+            n_products += 1
+    os.replace(tmp_path, csvpath)
+    print(f"Found {n_products} products.")
 
     print('Finished!')
 
@@ -65,6 +98,9 @@ if __name__ == "__main__":
     # Path to file with SciHub credentials
     api_pth = ".\\userfiles\\apihub.txt"
 
+    # Folder for cached query results
+    cache_pth = ".\\userfiles\\query_cache"
+
     # Set query parameters
     ############################################################################
     #   * (Date-type query parameter 'beginposition' expects a two-element tuple
@@ -88,12 +124,30 @@ if __name__ == "__main__":
     # pth_aoi = join(wrkdir, nam_aoi)
     # footprint = geojson_to_wkt(read_geojson(pth_aoi))
 
+    # Several AOIs from a GeoJSON file (one feature per AOI), used instead of
+    # the footprint if set (see aoi_planner.py)
+    aoi_pth = None  # ".\\userfiles\\polygon.geojson"
+
     query_params = {
         'strtime': strtime,
         'endtime': endtime,
         'platformname': platformname,
         'producttype': producttype,
-        'footprint': footprint
+        'footprint': footprint,
+        'aois': aoi_pth
+    }
+
+    # Selection of the products from the query results (see selection.py),
+    # None to list all products found by the query. All criteria are off
+    # (None or False), set the ones to use
+    selection_params = {
+        'relative_orbits': None,  # e.g. [22, 95, 146]
+        'orbit_direction': None,  # 'ASCENDING' or 'DESCENDING'
+        'polarisation': None,  # e.g. 'VV VH'
+        'max_size': None,  # e.g. '8 GB'
+        'min_coverage': None,  # share of the AOI covered by a product, e.g. 0.05
+        'drop_reprocessed': False,  # only the latest version of a product
+        'best_per_pass': False  # one product per satellite, orbit and day
     }
 
-    main(csv_pth, api_pth, query_params)
+    main(csv_pth, api_pth, query_params, cache_pth, selection_params)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Rate limiting of the requests for retrieval of products from the LTA.
+
+SciHUB allows a limited number of LTA retrievals per user (1 product per
+30 min at the time of writing). Instead of sleeping a fixed time after every
+trigger, each account gets a token bucket that is filled at the quota rate:
+    - a trigger is only sent when a token is available
+    - `next_slot()` tells when the next trigger is allowed
+    - a quota error from the server empties the bucket and backs off
+      (the wait time is doubled after every consecutive quota error)
+    - optionally the rate is increased after successful triggers (up to
+      `max_rate`), to find out if the real quota is looser than configured
+
+All code that may trigger a retrieval goes through `trigger_retrieval()`,
+which uses the bucket of the account of the API (see `for_api()`). It checks
+the 'Online' status first and sends the request for retrieval (a request of
+the '$value' of the product) only for offline products, so a product that is
+already online is never downloaded as a side effect of a trigger. The HTTP
+status of the request is read directly (202 accepted, 403 quota exceeded),
+because not all versions of sentinelsat raise an error on a quota error.
+"""
+
+import logging
+import threading
+
+from time import monotonic, perf_counter, sleep
+from sentinelsat import SentinelAPILTAError
+from metrics import metrics
+
+
+QUOTA_MESSAGE = "Requests for retrieval from LTA exceed user quota"
+
+# Messages of the HTTP status codes of a request for retrieval
+TRIGGER_ERRORS = {
+    403: QUOTA_MESSAGE,
+    500: "Trying to download an offline product",
+    503: "Request for retrieval from LTA not accepted",
+}
+
+# Default quota of a SciHUB account: 1 trigger per 30 min (+1 min margin)
+QUOTA_REQUESTS = 1
+QUOTA_PERIOD = 31 * 60
+
+
+class TokenBucket:
+    """Token bucket with adaptive backoff.
+
+    Parameters
+    ----------
+    rate : float
+        Tokens added per second.
+    capacity : float
+        Maximum number of tokens (size of a burst).
+    max_rate : float, optional
+        Upper limit for increasing the rate after successful requests. By
+        default the rate is never increased.
+    max_backoff : float
+        Upper limit (seconds) for the wait after repeated quota errors.
+    """
+
+    def __init__(self, rate, capacity=1, max_rate=None, max_backoff=6 * 60 * 60):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.max_rate = max_rate if max_rate is not None else rate
+        self.max_backoff = max_backoff
+        self.tokens = float(capacity)
+        self.hold_until = 0.
+        self.backoff = 1. / rate
+        self.stamp = monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_quota(cls, requests=QUOTA_REQUESTS, period=QUOTA_PERIOD, **kwargs):
+        """Bucket for a quota of `requests` per `period` seconds."""
+        return cls(requests / period, capacity=requests, **kwargs)
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def next_slot(self):
+        """Seconds until a token is available (0 if one is available now)."""
+        with self.lock:
+            now = monotonic()
+            self._refill(now)
+            wait = max(self.hold_until - now, 0.)
+            if self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.rate)
+            return wait
+
+    def try_acquire(self):
+        """Take a token if one is available, return True on success."""
+        with self.lock:
+            now = monotonic()
+            self._refill(now)
+            if now < self.hold_until or self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def acquire(self, block=True):
+        """Take a token, waiting for it if `block` is True."""
+        while not self.try_acquire():
+            if not block:
+                return False
+            sleep(max(self.next_slot(), 0.01))
+        return True
+
+    def refund(self):
+        """Return a token (request was rejected without counting to quota)."""
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def success(self):
+        """Request was accepted: reset the backoff, probe a higher rate."""
+        with self.lock:
+            self.backoff = 1. / self.base_rate
+            if self.rate < self.max_rate:
+                self.rate = min(self.rate * 1.25, self.max_rate)
+
+    def penalize(self):
+        """Request was rejected because of the quota: back off."""
+        with self.lock:
+            now = monotonic()
+            self._refill(now)
+            self.tokens = 0.
+            self.rate = max(self.rate / 2, self.base_rate)
+            self.hold_until = now + self.backoff
+            logging.info(f"LTA quota exceeded, backing off for {self.backoff / 60:.0f} min")
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+
+
+# Buckets shared by all code paths in the process, one per account
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def for_account(username, requests=QUOTA_REQUESTS, period=QUOTA_PERIOD, **kwargs):
+    """Token bucket of an account (created on first use)."""
+    with _buckets_lock:
+        if username not in _buckets:
+            _buckets[username] = TokenBucket.from_quota(requests, period, **kwargs)
+        return _buckets[username]
+
+
+def for_api(api):
+    """Token bucket of the account that `api` is logged in with."""
+    auth = api.session.auth
+    return for_account(auth[0] if auth else None)
+
+
+def is_quota_error(e):
+    """True if a SentinelAPILTAError was caused by exceeding the user quota."""
+    if e.response is not None and e.response.status_code == 403:
+        return True
+    return e.msg == QUOTA_MESSAGE
+
+
+def send_trigger(api, product_info):
+    """Request the retrieval of a product from the LTA.
+
+    Returns True if the retrieval was accepted and False if the product is
+    online (its data is not read). Other responses raise SentinelAPILTAError
+    with the 'cause-message' of the server.
+    """
+    with api.session.get(product_info['url'], auth=api.session.auth,
+                         timeout=api.timeout, stream=True) as r:
+        if r.status_code == 202:
+            return True
+        if r.status_code in (200, 206):
+            return False
+        message = r.headers.get('cause-message') or TRIGGER_ERRORS.get(
+            r.status_code, "Unexpected response from SciHub")
+        raise SentinelAPILTAError(message, r)
+
+
+def trigger_retrieval(api, product_id, limiter=None, block=True, max_retries=1,
+                      product_info=None):
+    """Trigger the retrieval of an offline product from the LTA.
+
+    Waits for a free trigger slot of the account (or returns None right away
+    if `block` is False and there is none). A quota error is retried up to
+    `max_retries` times after the backoff, other LTA errors are raised.
+
+    Returns the product info (`api.get_product_odata()`, if not given). A
+    product that is online is not triggered and not downloaded, its 'Online'
+    is True and it has to be downloaded as any other online product.
+    """
+    if limiter is None:
+        limiter = for_api(api)
+    if product_info is None:
+        product_info = api.get_product_odata(product_id)
+    if product_info['Online']:
+        metrics.inc('triggers_total', result='online')
+        return product_info
+    for attempt in range(max_retries + 1):
+        if not limiter.acquire(block):
+            return None
+        start = perf_counter()
+        try:
+            accepted = send_trigger(api, product_info)
+        except SentinelAPILTAError as e:
+            metrics.observe('trigger_seconds', perf_counter() - start)
+            if not is_quota_error(e):
+                metrics.inc('triggers_total', result='error')
+                limiter.refund()
+                raise
+            metrics.inc('triggers_total', result='quota')
+            limiter.penalize()
+            if not block or attempt == max_retries:
+                raise
+            logging.info(f"Retrying the trigger in {limiter.next_slot() / 60:.0f} min")
+        else:
+            metrics.observe('trigger_seconds', perf_counter() - start)
+            if not accepted:
+                # Product came online since its status was read
+                metrics.inc('triggers_total', result='online')
+                limiter.refund()
+                product_info['Online'] = True
+            else:
+                metrics.inc('triggers_total', result='accepted')
+                metrics.event('trigger', id=product_id, title=product_info['title'])
+                limiter.success()
+            return product_info
@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Extraction of selected files from SAFE products, without keeping the zip.
+
+Many jobs only need the manifest, the annotation XMLs or some of the
+measurement TIFFs of a product. The files are selected with glob patterns on
+their path within the SAFE folder, e.g. ['manifest.safe', 'annotation/*.xml',
+'measurement/*-vv-*.tiff'], and written into `<dwndir>/<title>.SAFE`:
+    - remote: the zip is read with HTTP Range requests (`RangeFile`), only
+      the central directory at the end of the zip and the selected members
+      are downloaded
+    - streaming: if the server does not support Range requests, the zip is
+      downloaded in one pass and the selected members are extracted from the
+      stream as it arrives (`StreamExtractor`), the rest is dropped
+Use `ExtractSink` as the output sink of the download (see sinks.py and
+dwn_engine.py), or `open_sink(dwndir, extract=patterns)`.
+"""
+
+import logging
+import os
+import shutil
+import struct
+import zipfile
+import zlib
+
+from fnmatch import fnmatch
+from os.path import exists, isdir, join
+from dwn_engine import RangeNotSupportedError
+from sinks import LocalSink
+import bandwidth
+
+
+BLOCK_SIZE = 4 * 2 ** 20  # 4 MB read-ahead of Range requests
+TAIL_SIZE = 2 ** 16  # end of the zip read at once (central directory)
+
+DEFAULT_PATTERNS = ('manifest.safe', 'annotation/*.xml')
+
+_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+_SIG_LOCAL = b'PK\x03\x04'
+_SIG_CENTRAL = (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06')
+_SIG_DESCRIPTOR = b'PK\x07\x08'
+
+
+def _relative(name):
+    """Path of a member within the SAFE folder (first folder removed)."""
+    name = name.replace('\\', '/')
+    first, _, rest = name.partition('/')
+    return rest if first.upper().endswith('.SAFE') else name
+
+
+def matches(name, patterns):
+    """True if the member `name` matches one of the glob patterns."""
+    rel = _relative(name)
+    return bool(rel) and not rel.endswith('/') and any(fnmatch(rel, p) for p in patterns)
+
+
+def _target(outdir, name):
+    """Output path of a member, refusing paths outside of `outdir`."""
+    parts = [p for p in _relative(name).split('/') if p not in ('', '.')]
+    if not parts or '..' in parts or ':' in parts[0]:
+        raise zipfile.BadZipFile(f"Invalid member name: {name}")
+    path = join(outdir, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+# Remote extraction
+# =================
+class RangeFile:
+    """Read-only file object of a remote file, read with Range requests.
+
+    Consecutive small reads are served from a read-ahead buffer of
+    `block_size` bytes, which never reaches past `limit` (the end of the
+    members that are read). The end of the file is read at once when the
+    object is created, as zipfile starts with the central directory.
+    """
+
+    def __init__(self, session, url, size, timeout=None, block_size=BLOCK_SIZE):
+        self.session = session
+        self.url = url
+        self.size = size
+        self.timeout = timeout
+        self.block_size = block_size
+        self.pos = 0
+        self.limit = size
+        self.bytes_read = 0
+        self.requests = 0
+        self.buffer = b''
+        self.buffer_start = 0
+        self._fill(max(size - TAIL_SIZE, 0), size)
+
+    def _fill(self, start, end):
+        """Read bytes `start` to `end` (exclusive) into the buffer."""
+        headers = {'Range': f'bytes={start}-{end - 1}'}
+        r = self.session.get(self.url, auth=self.session.auth, headers=headers,
+                             timeout=self.timeout)
+        r.raise_for_status()
+        if r.status_code != 206:
+            r.close()
+            raise RangeNotSupportedError(f"Range request for {self.url} returned {r.status_code}")
+        bandwidth.limiter.consume(len(r.content))
+        self.buffer = r.content
+        self.buffer_start = start
+        self.bytes_read += len(r.content)
+        self.requests += 1
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self.pos
+        n = min(n, self.size - self.pos)
+        if n <= 0:
+            return b''
+        offset = self.pos - self.buffer_start
+        if offset < 0 or offset + n > len(self.buffer):
+            end = max(self.pos + n, min(self.pos + self.block_size, self.limit))
+            self._fill(self.pos, min(end, self.size))
+            offset = 0
+        data = self.buffer[offset:offset + n]
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(0, min(offset, self.size))
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self.buffer = b''
+
+
+def extract_remote(session, url, size, outdir, patterns, timeout=None):
+    """Extract members matching `patterns` from a remote zip into `outdir`.
+
+    Raises RangeNotSupportedError if the server ignores Range requests.
+    Returns the list of extracted paths and the number of downloaded bytes.
+    """
+    f = RangeFile(session, url, size, timeout)
+    paths = []
+    with zipfile.ZipFile(f) as zf:
+        # A member ends where the next one (or the central directory) starts
+        infos = sorted(zf.infolist(), key=lambda m: m.header_offset)
+        ends = [m.header_offset for m in infos[1:]] + [zf.start_dir]
+        for member, end in zip(infos, ends):
+            if not matches(member.filename, patterns):
+                continue
+            # Read ahead only within the selected members
+            f.limit = end
+            path = _target(outdir, member.filename)
+            with zf.open(member) as src, open(path, 'wb') as dst:
+                # CRC of the member is checked by zipfile at the end
+                shutil.copyfileobj(src, dst, BLOCK_SIZE)
+            paths.append(path)
+    logging.info(f"Extracted {len(paths)} files with {f.requests} requests "
+                 f"({f.bytes_read / 2 ** 20:.1f} of {size / 2 ** 20:.1f} MB)")
+    return paths, f.bytes_read
+
+
+# Streaming extraction
+# ====================
+class StreamExtractor:
+    """Extract members matching `patterns` from a zip that is fed in order.
+
+    The local headers of the members are parsed as the data arrives. Deflated
+    members with a data descriptor (sizes unknown in the header) are
+    decompressed to find their end.
+    """
+
+    def __init__(self, outdir, patterns):
+        self.outdir = outdir
+        self.patterns = patterns
+        self.buffer = bytearray()
+        self.state = 'header'
+        self.member = None
+        self.finished = False
+        self.paths = []
+
+    def feed(self, data):
+        if self.finished:
+            return
+        self.buffer += data
+        while self._step():
+            pass
+
+    def close(self):
+        """Check that the whole zip was read, close an unfinished member."""
+        if self.member is not None and self.member['file'] is not None:
+            self.member['file'].close()
+        if not self.finished:
+            raise zipfile.BadZipFile("Zip stream ended before the central directory")
+
+    def _step(self):
+        if self.state == 'header':
+            return self._header()
+        if self.state == 'data':
+            return self._data()
+        return self._descriptor()
+
+    def _header(self):
+        if len(self.buffer) < 4:
+            return False
+        signature = bytes(self.buffer[:4])
+        if signature in _SIG_CENTRAL:
+            # All members were read, the rest is the central directory
+            self.finished = True
+            self.buffer = bytearray()
+            return False
+        if signature != _SIG_LOCAL:
+            raise zipfile.BadZipFile("Invalid local header in the zip stream")
+        if len(self.buffer) < _LOCAL_HEADER.size:
+            return False
+        (_, _, flags, method, _, _, crc, csize, usize,
+         name_len, extra_len) = _LOCAL_HEADER.unpack_from(self.buffer)
+        end = _LOCAL_HEADER.size + name_len + extra_len
+        if len(self.buffer) < end:
+            return False
+        raw_name = bytes(self.buffer[_LOCAL_HEADER.size:_LOCAL_HEADER.size + name_len])
+        name = raw_name.decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = bytes(self.buffer[_LOCAL_HEADER.size + name_len:end])
+        del self.buffer[:end]
+
+        # ZIP64 sizes are in the extra field (uncompressed size first)
+        pos = 0
+        while pos + 4 <= len(extra):
+            tag, length = struct.unpack_from('<HH', extra, pos)
+            if tag == 1:
+                values = list(struct.unpack_from(f'<{length // 8}Q', extra, pos + 4))
+                if usize == 0xFFFFFFFF and values:
+                    usize = values.pop(0)
+                if csize == 0xFFFFFFFF and values:
+                    csize = values.pop(0)
+            pos += 4 + length
+
+        descriptor = bool(flags & 0x08)
+        selected = matches(name, self.patterns)
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            if selected or descriptor:
+                raise zipfile.BadZipFile(f"Unsupported compression of {name}")
+        elif method == zipfile.ZIP_STORED and descriptor and csize == 0:
+            raise zipfile.BadZipFile(f"Unknown size of the stored member {name}")
+        self.member = {
+            'name': name,
+            'crc': crc,
+            'method': method,
+            'descriptor': descriptor,
+            # Unknown size: deflated data is read until the end of the stream
+            'left': None if descriptor and csize == 0 else csize,
+            'file': open(_target(self.outdir, name), 'wb') if selected else None,
+            'decompressor': (zlib.decompressobj(-15)
+                             if method == zipfile.ZIP_DEFLATED and (selected or descriptor)
+                             else None),
+            'crc_out': 0,
+        }
+        self.state = 'data'
+        return True
+
+    def _write(self, data, final=False):
+        member = self.member
+        if member['decompressor'] is not None:
+            data = member['decompressor'].decompress(data)
+            if final:
+                data += member['decompressor'].flush()
+        if member['file'] is not None and data:
+            member['file'].write(data)
+            member['crc_out'] = zlib.crc32(data, member['crc_out'])
+
+    def _data(self):
+        member = self.member
+        if member['left'] is not None:
+            if not self.buffer and member['left'] > 0:
+                return False
+            part = bytes(self.buffer[:member['left']])
+            del self.buffer[:len(part)]
+            member['left'] -= len(part)
+            self._write(part, final=member['left'] == 0)
+            if member['left'] > 0:
+                return False
+        else:
+            decompressor = member['decompressor']
+            self._write(bytes(self.buffer))
+            self.buffer = bytearray(decompressor.unused_data)
+            if not decompressor.eof:
+                return False
+        if member['descriptor']:
+            self.state = 'descriptor'
+            return True
+        self._finish(member['crc'])
+        return True
+
+    def _descriptor(self):
+        # [signature] crc, compressed and uncompressed size (4 or 8 bytes)
+        offset = 4 if bytes(self.buffer[:4]) == _SIG_DESCRIPTOR else 0
+        if len(self.buffer) < offset + 24:
+            return False
+        crc = struct.unpack_from('<I', self.buffer, offset)[0]
+        for length in (12, 20):
+            if bytes(self.buffer[offset + length:offset + length + 4]) in (_SIG_LOCAL,) + _SIG_CENTRAL:
+                del self.buffer[:offset + length]
+                self._finish(crc)
+                return True
+        raise zipfile.BadZipFile(f"Invalid data descriptor of {self.member['name']}")
+
+    def _finish(self, crc):
+        member = self.member
+        if member['file'] is not None:
+            member['file'].close()
+            if member['crc_out'] != crc:
+                raise zipfile.BadZipFile(f"Bad CRC-32 of {member['name']}")
+            self.paths.append(member['file'].name)
+        self.member = None
+        self.state = 'header'
+
+
+# Output sink
+# ===========
+class _ExtractWriter:
+    """Writer of a sink that keeps only the selected members of the zip."""
+
+    resumable = False
+
+    def __init__(self, path, patterns):
+        self.path = path
+        self.temp_path = path + '.incomplete'
+        self.bytes = 0
+        if exists(self.temp_path):
+            shutil.rmtree(self.temp_path)
+        os.makedirs(self.temp_path)
+        self.extractor = StreamExtractor(self.temp_path, patterns)
+
+    def write(self, data):
+        self.bytes += len(data)
+        self.extractor.feed(data)
+
+    def commit(self):
+        self.extractor.close()
+        return _replace_dir(self.temp_path, self.path)
+
+    def close(self):
+        try:
+            self.extractor.close()
+        except zipfile.BadZipFile:
+            pass
+
+    def abort(self):
+        self.close()
+        shutil.rmtree(self.temp_path, ignore_errors=True)
+
+
+def _replace_dir(temp_path, path):
+    if exists(path):
+        shutil.rmtree(path)
+    os.replace(temp_path, path)
+    return path
+
+
+class ExtractSink(LocalSink):
+    """Sink that keeps only selected files of the products (SAFE folders).
+
+    Parameters
+    ----------
+    root : str
+        Folder of the extracted SAFE folders.
+    patterns : list of str
+        Glob patterns of the files (path within the SAFE folder).
+    remote : bool
+        Download only the selected members with Range requests (if the server
+        supports them), otherwise the zip is streamed.
+    """
+
+    streaming = True
+
+    def __init__(self, root, patterns=DEFAULT_PATTERNS, remote=True):
+        super().__init__(root)
+        self.patterns = list(patterns)
+        self.remote = remote
+
+    def url(self, name):
+        # '<title>.zip' is stored as '<title>.SAFE'
+        return join(self.root, os.path.splitext(name)[0] + '.SAFE')
+
+    def paths(self):
+        """Paths of all extracted products (SAFE folders) in the sink."""
+        # The folder is created with the first product
+        if not isdir(self.root):
+            return
+        for name in os.listdir(self.root):
+            if name.endswith('.SAFE') and isdir(join(self.root, name)):
+                yield join(self.root, name)
+
+    def open(self, name):
+        return _ExtractWriter(self.url(name), self.patterns)
+
+    def fetch(self, api, product_info, name):
+        """Extract the product with Range requests.
+
+        Returns (path, downloaded bytes), or None if the product has to be
+        streamed instead.
+        """
+        if not self.remote:
+            return None
+        path = self.url(name)
+        temp_path = path + '.incomplete'
+        if exists(temp_path):
+            shutil.rmtree(temp_path)
+        try:
+            _, nbytes = extract_remote(api.session, product_info['url'],
+                                       product_info['size'], temp_path,
+                                       self.patterns, api.timeout)
+        except RangeNotSupportedError:
+            logging.warning("Range requests not supported, streaming the product")
+            shutil.rmtree(temp_path, ignore_errors=True)
+            return None
+        except BaseException:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
+        os.makedirs(temp_path, exist_ok=True)
+        return _replace_dir(temp_path, path), nbytes
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Selection of the products to download from the results of a query.
+
+A query by footprint and date returns every frame that touches the area,
+including frames that only cover a corner of it, several frames of the same
+pass and reprocessed versions of the same acquisition. Every product that is
+not needed still costs an LTA trigger and a download of several GB, so the
+results are pruned on the full metadata first. All criteria are applied to a
+pandas DataFrame of the results (one row per product) with vectorized
+operations:
+    - relative orbits, orbit direction, polarisation and maximum size
+    - coverage: share of the area of an AOI that is covered by the footprint
+      of the product (the best AOI counts, see aoi_planner.py for several
+      AOIs), computed for all products at once with the vectorized geometry
+      functions if shapely >= 2.0 is installed, otherwise one product after
+      another (shapely 1.6 of env.yml), with the same results
+    - reprocessed products: of the products of the same acquisition (same
+      title apart from the product identifier) only the latest one is kept
+    - best frame per pass: of the frames of the same satellite, relative
+      orbit and day only the one covering most of the AOI is kept
+Relative orbit and polarisation are taken from the title of the product if
+they are missing from the metadata.
+"""
+
+import logging
+import numpy as np
+import pandas as pd
+
+from collections import OrderedDict
+from shapely import wkt
+from bandwidth import SIZE_UNITS, size_bytes
+
+try:
+    # Vectorized geometry functions (shapely >= 2.0)
+    from shapely import area, from_wkt, intersection
+except ImportError:
+    area = from_wkt = intersection = None
+
+
+# Polarisation of Sentinel-1 products from the title (e.g. S1A_IW_SLC__1SDV)
+POLARISATIONS = {'SH': 'HH', 'SV': 'VV', 'DH': 'HH HV', 'DV': 'VV VH'}
+
+# Absolute orbit of the first orbit of the relative orbit cycle (175 orbits)
+ORBIT_OFFSETS = {'S1A': 73, 'S1B': 27}
+
+
+def to_dataframe(products):
+    """DataFrame of query results ((uuid, properties) pairs), indexed by UUID.
+
+    Missing columns used by the selection are derived from the titles:
+    'satellite', 'relativeorbitnumber', 'polarisationmode', 'acquisition'
+    (title without the product identifier) and 'size_bytes'.
+    """
+    df = pd.DataFrame.from_dict(OrderedDict(products), orient='index')
+    if df.empty:
+        return df
+    parts = df['title'].str.extract(
+        r'^(?P<satellite>S1[AB])_\w\w_\w{3}._\d\w(?P<pol>\w\w)_'
+        r'\d{8}T\d{6}_\d{8}T\d{6}_(?P<orbit>\d{6})_'
+    )
+    df['satellite'] = parts['satellite']
+    if 'relativeorbitnumber' not in df:
+        offset = parts['satellite'].map(ORBIT_OFFSETS)
+        df['relativeorbitnumber'] = (pd.to_numeric(parts['orbit']) - offset) % 175 + 1
+    if 'polarisationmode' not in df:
+        df['polarisationmode'] = parts['pol'].map(POLARISATIONS)
+    df['acquisition'] = df['title'].str.rsplit('_', n=1).str[0]
+    if 'size' in df:
+        df['size_bytes'] = _sizes(df['size'])
+    return df
+
+
+def _sizes(sizes):
+    """Sizes in bytes from strings such as '4.12 GB' (NaN if unknown)."""
+    parts = sizes.astype(str).str.extract(r'^\s*([\d.]+)\s*([KMGT]?B)\s*$')
+    units = parts[1].str.upper().map(SIZE_UNITS)
+    return pd.to_numeric(parts[0], errors='coerce') * units
+
+
+def coverage(footprints, aois):
+    """Share of the area of every AOI covered by every footprint (WKT).
+
+    Returns an array of shape (products, AOIs).
+    """
+    aoi_geoms = np.array([wkt.loads(g) if isinstance(g, str) else g for _, g in aois],
+                         dtype=object)
+    if from_wkt is not None:
+        geoms = from_wkt(np.asarray(footprints, dtype=object))
+        covered = area(intersection(geoms[:, np.newaxis], aoi_geoms[np.newaxis, :]))
+        return covered / area(aoi_geoms)[np.newaxis, :]
+    # Shapely < 2.0, one product after another
+    geoms = [wkt.loads(footprint) for footprint in footprints]
+    return np.array([[g.intersection(a).area / a.area for a in aoi_geoms]
+                     for g in geoms]).reshape(len(geoms), len(aoi_geoms))
+
+
+def select(df, aois=None, relative_orbits=None, orbit_direction=None,
+           polarisation=None, max_size=None, min_coverage=None,
+           drop_reprocessed=False, best_per_pass=False):
+    """Rows of the products that are needed (see the module docstring).
+
+    All criteria are off by default, without any criteria all rows are kept.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Query results from `to_dataframe()`.
+    aois : list of (str, geometry), optional
+        Areas of interest, needed for `min_coverage` and `best_per_pass`.
+    relative_orbits : list of int, optional
+        Keep only these relative orbits.
+    orbit_direction : str, optional
+        'ASCENDING' or 'DESCENDING'.
+    polarisation : str, optional
+        Polarisation mode, e.g. 'VV VH'.
+    max_size : int or str, optional
+        Maximum size of a product, e.g. '8 GB'.
+    min_coverage : float, optional
+        Minimum share (0-1) of an AOI covered by the product.
+    drop_reprocessed : bool
+        Keep only the latest version of a reprocessed acquisition.
+    best_per_pass : bool
+        Keep only the frame with the best coverage per satellite, relative
+        orbit and day.
+
+    Returns
+    -------
+    DataFrame
+        Selected rows (with the 'coverage' column if AOIs are given), in the
+        order of `df`.
+    """
+    if df.empty:
+        return df
+    n_products = len(df)
+    keep = pd.Series(True, index=df.index)
+    if relative_orbits is not None:
+        keep &= df['relativeorbitnumber'].isin(relative_orbits)
+    if orbit_direction is not None:
+        if 'orbitdirection' in df:
+            keep &= df['orbitdirection'].str.upper() == orbit_direction.upper()
+        else:
+            logging.warning("No orbit direction in the query results, not filtered")
+    if polarisation is not None:
+        keep &= df['polarisationmode'] == polarisation
+    if max_size is not None:
+        # Products of unknown size are kept
+        keep &= ~(df['size_bytes'] > size_bytes(max_size))
+    df = df[keep].copy()
+
+    if aois:
+        covered = coverage(df['footprint'].to_numpy(), aois) if len(df) else None
+        df['coverage'] = covered.max(axis=1) if covered is not None else []
+        if min_coverage is not None:
+            df = df[df['coverage'] >= min_coverage]
+
+    if drop_reprocessed and 'ingestiondate' in df:
+        latest = df.sort_values('ingestiondate', kind='mergesort')
+        latest = latest[~latest.duplicated('acquisition', keep='last')]
+        df = df[df.index.isin(latest.index)]
+
+    if best_per_pass and 'coverage' not in df:
+        logging.warning("Best frame per pass needs the AOIs, not selected")
+    elif best_per_pass and len(df):
+        # Unknown satellites and orbits form their own group
+        keys = [df['satellite'].fillna(''), df['relativeorbitnumber'].fillna(-1),
+                pd.to_datetime(df['beginposition']).dt.date]
+        best = df.groupby(keys)['coverage'].idxmax()
+        df = df[df.index.isin(best.to_numpy())]
+
+    logging.info(f"Selection: {len(df)} of {n_products} products kept")
+    return df
+
+
+def select_products(products, aois=None, **criteria):
+    """Select from query results ((uuid, properties) pairs).
+
+    Returns an OrderedDict {uuid: properties} of the selected products in the
+    order of the query results (see `select()` for the criteria). The
+    coverage of the AOIs is added to the properties.
+    """
+    products = OrderedDict(products)
+    df = select(to_dataframe(products.items()), aois, **criteria)
+    selected = OrderedDict()
+    for product_id in df.index:
+        properties = products[product_id]
+        if 'coverage' in df:
+            properties['coverage'] = float(df.at[product_id, 'coverage'])
+        selected[product_id] = properties
+    return selected
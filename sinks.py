@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Output sinks: where the downloaded products are stored.
+
+    - LocalSink: a folder on a local disk. Products are downloaded with the
+      resumable chunked download of dwn_engine.py (the default).
+    - ShareSink: a folder on a file share (e.g. the mapped R:\\ drive). The
+      product is streamed in one sequential pass and written in large blocks,
+      the MD5 checksum is computed on the stream. There is no chunk manifest;
+      an interrupted download is resumed at the end of the incomplete file,
+      which is only read back from the share in that case.
+    - S3Sink: a bucket of an S3-compatible object store (AWS, MinIO, Ceph).
+      The product is streamed into a multipart upload, parts are uploaded as
+      soon as they are full, so no full copy of the product is kept anywhere.
+      An interrupted upload is aborted and the download starts again. Needs
+      the optional `boto3` package.
+
+Use `open_sink()` to create a sink from a path or an URL, e.g.
+`open_sink('s3://sentinel/S1_SLC/')` or `open_sink('R:\\Sentinel-1_SLC\\',
+stream=True)`. A sink that keeps only selected files of the products is
+described in safe_extract.py. The writers of all sinks have the same interface: `write()`
+the data in order, then `commit()` it under the final name or `abort()`.
+`close()` stops writing without removing the temporary data, which belongs
+to another downloader that took over the product (see state_store.py).
+Writers that can be `resumable` start with `bytes` already written by an
+interrupted download, which `read_back()` returns; `suspend()` keeps the
+data for the next attempt and `restart()` discards it.
+"""
+
+import logging
+import os
+
+from os import walk
+from os.path import exists, getsize, join
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+
+BLOCK_SIZE = 16 * 2 ** 20  # 16 MB blocks written to the file share
+PART_SIZE = 16 * 2 ** 20  # 16 MB parts of multipart uploads
+MIN_PART_SIZE = 5 * 2 ** 20  # S3 rejects smaller parts (except the last one)
+
+
+class _FileWriter:
+    """Write a file as `<path>.incomplete`, rename it when complete. With
+    `resumable` an existing incomplete file is continued."""
+
+    def __init__(self, path, block_size=None, resumable=False):
+        self.path = path
+        self.temp_path = path + '.incomplete'
+        self.block_size = block_size
+        self.resumable = resumable
+        self.buffer = bytearray()
+        self.bytes = getsize(self.temp_path) if resumable and exists(self.temp_path) else 0
+        # Unbuffered, the data is collected into blocks here
+        self.f = open(self.temp_path, 'ab' if self.bytes else 'wb',
+                      buffering=0 if block_size else -1)
+
+    def write(self, data):
+        self.bytes += len(data)
+        if not self.block_size:
+            self.f.write(data)
+            return
+        self.buffer += data
+        if len(self.buffer) >= self.block_size:
+            self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            self.f.write(self.buffer)
+            self.buffer = bytearray()
+
+    def commit(self):
+        self._flush()
+        self.f.close()
+        os.replace(self.temp_path, self.path)
+        return self.path
+
+    def read_back(self, block_size=BLOCK_SIZE):
+        """Yield the data kept from an interrupted download."""
+        with open(self.temp_path, 'rb') as f:
+            for data in iter(lambda: f.read(block_size), b''):
+                yield data
+
+    def restart(self):
+        self.f.truncate(0)
+        self.buffer = bytearray()
+        self.bytes = 0
+
+    def suspend(self):
+        self._flush()
+        self.f.close()
+
+    def close(self):
+        self.f.close()
+
+    def abort(self):
+        self.close()
+        if exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class LocalSink:
+    """Products in a local folder, downloaded with resumable chunks."""
+
+    streaming = False
+
+    def __init__(self, root):
+        self.root = root
+
+    def __str__(self):
+        return self.root
+
+    def url(self, name):
+        return join(self.root, name)
+
+    def exists(self, name):
+        return exists(self.url(name))
+
+    def paths(self):
+        """Paths of all complete products ('.zip' files) in the sink."""
+        # r=root, d=directories, f=files
+        for r, d, f in walk(self.root):
+            for file in f:
+                if file.endswith(".zip"):
+                    yield join(r, file)
+
+    def open(self, name):
+        return _FileWriter(self.url(name))
+
+
+class ShareSink(LocalSink):
+    """Products in a folder on a file share, streamed in large blocks.
+
+    Parameters
+    ----------
+    root : str
+        Folder on the share.
+    block_size : int
+        Size (bytes) of the blocks written to the share.
+    """
+
+    streaming = True
+
+    def __init__(self, root, block_size=BLOCK_SIZE):
+        super().__init__(root)
+        self.block_size = block_size
+
+    def open(self, name):
+        return _FileWriter(self.url(name), self.block_size, resumable=True)
+
+
+class _MultipartWriter:
+    """Stream an object into a multipart upload."""
+
+    resumable = False
+
+    def __init__(self, client, bucket, key, part_size):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.bytes = 0
+        self.parts = []
+        self.upload_id = client.create_multipart_upload(
+            Bucket=bucket, Key=key
+        )['UploadId']
+
+    def write(self, data):
+        self.bytes += len(data)
+        self.buffer += data
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=number, Body=bytes(self.buffer)
+        )
+        self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+        self.buffer = bytearray()
+
+    def commit(self):
+        # The last part may be smaller than the minimum part size
+        if self.buffer or not self.parts:
+            self._upload_part()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+        return f"s3://{self.bucket}/{self.key}"
+
+    def abort(self):
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+        except Exception as e:
+            logging.warning(f"Could not abort the upload of {self.key}: {e}")
+
+    def close(self):
+        # The upload is not shared with other downloaders
+        self.abort()
+
+
+class S3Sink:
+    """Products in a bucket of an S3-compatible object store.
+
+    Parameters
+    ----------
+    bucket : str
+        Name of the bucket.
+    prefix : str
+        Prefix (folder) of the product keys.
+    endpoint_url : str, optional
+        URL of the object store (e.g. http://localhost:9000 for MinIO). By
+        default the `S3_ENDPOINT_URL` environment variable or AWS.
+    part_size : int
+        Size (bytes) of the parts of the multipart uploads (at least 5 MB).
+    client : optional
+        S3 client, by default created with boto3 (credentials are read by
+        boto3 from the environment or ~/.aws).
+    """
+
+    streaming = True
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, part_size=PART_SIZE,
+                 client=None):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"Parts of multipart uploads must be at least "
+                             f"{MIN_PART_SIZE // 2 ** 20} MB")
+        if client is None:
+            if boto3 is None:
+                raise ImportError("The S3 sink needs the boto3 package")
+            endpoint_url = endpoint_url or os.environ.get("S3_ENDPOINT_URL")
+            client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.part_size = part_size
+
+    def __str__(self):
+        return f"s3://{self.bucket}/{self.prefix}"
+
+    def url(self, name):
+        return f"s3://{self.bucket}/{self.prefix}{name}"
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + name)
+            return True
+        except Exception as e:
+            # botocore ClientError with the HTTP status of the request
+            error = getattr(e, 'response', {}).get('Error', {})
+            if error.get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def paths(self):
+        """URLs of all complete products ('.zip' objects) in the sink."""
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                if obj['Key'].endswith('.zip'):
+                    yield f"s3://{self.bucket}/{obj['Key']}"
+
+    def open(self, name):
+        return _MultipartWriter(self.client, self.bucket, self.prefix + name,
+                                self.part_size)
+
+
+def open_sink(target, stream=False, extract=None, **kwargs):
+    """Sink for a folder or an 's3://bucket/prefix' URL.
+
+    Folders are written with the resumable chunked download, unless `stream`
+    is True (for file shares, see ShareSink). If `extract` is a list of glob
+    patterns, only the matching files of the products are written to the
+    folder (see safe_extract.py). A sink is returned unchanged.
+    """
+    if not isinstance(target, str):
+        return target
+    if extract:
+        # Imported here, safe_extract.py uses dwn_engine.py, which uses sinks
+        from safe_extract import ExtractSink
+        if target.startswith('s3://'):
+            raise ValueError("Files can only be extracted into a folder")
+        return ExtractSink(target, extract, **kwargs)
+    if target.startswith('s3://'):
+        bucket, _, prefix = target[5:].partition('/')
+        return S3Sink(bucket, prefix, **kwargs)
+    if stream:
+        return ShareSink(target, **kwargs)
+    return LocalSink(target)
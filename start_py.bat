@@ -20,6 +20,8 @@ set PATH=%py_path%%PATH%
 
 :: LOCATION OF PYTHON SCRIPT
 set py_script=D:\nejc\auto_dwn_slc\auto_dwn_slc.py
+:: (or start dwn_daemon.py once instead of scheduling this script weekly)
+:: set py_script=D:\nejc\auto_dwn_slc\dwn_daemon.py
 
 :: Run python script
 python %py_script%
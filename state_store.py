@@ -0,0 +1,542 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+State of the products in the LTA workflow, shared by trigger_LTA.py,
+download_LTA.py and lta_scheduler.py.
+
+The state is kept in a SQLite database next to the CSV list (e.g.
+`slc_list.csv` -> `slc_list.sqlite`). The CSV file is only used to import the
+list of products (see query_list_LTA.py) and to export the 'downloaded' column
+at the end of a session, so it is no longer rewritten after every product.
+
+Every product has one of the statuses:
+    queued -> triggered -> online -> downloading -> done
+                                                 -> failed
+A change of status is a single transaction (`transition()`), which only
+succeeds if the product is in one of the expected statuses. Several processes
+can therefore work on the same list at the same time. All changes are also
+appended to a journal table.
+
+The products are processed as a priority queue (`queue()`): highest priority
+first, then the earliest deadline, then the order of the CSV list. Priorities
+and deadlines are read from the optional 'priority' and 'deadline' columns of
+the CSV list or set with `set_priority()`.
+
+Several downloaders (processes or hosts) can share one list if the database
+is on a shared folder with working file locks. A downloader claims a product
+with `claim()`, which moves it to 'downloading' under a lease: the name of the
+downloader (host and process) and the time until which the claim is valid.
+While the download runs, `Lease` renews the claim in a background thread
+(heartbeat). When a downloader crashes, its lease expires and the product
+can be claimed by another downloader (`reclaim()`). The new download resumes
+the partial file of the crashed one (see dwn_engine.py). The final status is
+set with `release()`, which only succeeds while the lease is still held.
+"""
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import pandas as pd
+
+from os.path import splitext
+from datetime import datetime, timedelta
+from query_engine import parse_date
+
+
+STATUSES = ('queued', 'triggered', 'online', 'downloading', 'done', 'failed')
+
+# Statuses of products that can be claimed for download
+CLAIMABLE = ('queued', 'triggered', 'online', 'failed')
+
+# Seconds a claim stays valid without a heartbeat
+LEASE = 10 * 60
+
+
+class LeaseLostError(Exception):
+    """Claim of a product was taken over by another downloader."""
+    pass
+
+
+def worker_id():
+    """Name of this downloader (host and process)."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _isoformat(value):
+    """ISO string of a date (datetime, ISO date or a query date such as
+    'NOW+2DAYS', see query_engine.parse_date)."""
+    date = parse_date(value)
+    if date is None:
+        date = datetime.fromisoformat(str(value).strip().rstrip('Z'))
+    return date.isoformat()
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    uuid TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    account TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    deadline TEXT,
+    owner TEXT,
+    lease_until TEXT
+);
+CREATE TABLE IF NOT EXISTS journal (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    uuid TEXT NOT NULL,
+    old_status TEXT,
+    new_status TEXT NOT NULL,
+    time TEXT NOT NULL,
+    pid INTEGER NOT NULL
+);
+"""
+
+
+class StateStore:
+    """Product statuses stored in a SQLite database.
+
+    Parameters
+    ----------
+    dbpath : str
+        Path to the SQLite database (created if missing).
+    timeout : float
+        Seconds to wait for a lock held by another process.
+    """
+
+    def __init__(self, dbpath, timeout=60):
+        self.dbpath = dbpath
+        self._lock = threading.Lock()
+        # Transactions are started explicitly (BEGIN IMMEDIATE)
+        self._con = sqlite3.connect(dbpath, timeout=timeout,
+                                    isolation_level=None,
+                                    check_same_thread=False)
+        self._con.executescript(SCHEMA)
+        # Stores created before accounts, priorities and leases were tracked
+        columns = [row[1] for row in self._con.execute("PRAGMA table_info(products)")]
+        for name, definition in (('account', 'TEXT'),
+                                 ('priority', 'INTEGER NOT NULL DEFAULT 0'),
+                                 ('deadline', 'TEXT'),
+                                 ('owner', 'TEXT'),
+                                 ('lease_until', 'TEXT')):
+            if name not in columns:
+                self._con.execute(f"ALTER TABLE products ADD COLUMN {name} {definition}")
+
+    @classmethod
+    def from_csv(cls, csvpath, dbpath=None):
+        """Open the store belonging to a CSV list and import new products."""
+        if dbpath is None:
+            dbpath = splitext(csvpath)[0] + '.sqlite'
+        store = cls(dbpath)
+        store.import_csv(csvpath)
+        return store
+
+    def close(self):
+        self._con.close()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._con.execute(sql, params).fetchall()
+
+    def _transaction(self, func):
+        """Run `func(con)` in an immediate (write-locked) transaction."""
+        with self._lock:
+            self._con.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self._con)
+            except BaseException:
+                self._con.execute("ROLLBACK")
+                raise
+            self._con.execute("COMMIT")
+            return result
+
+    def import_csv(self, csvpath):
+        """Add products from a CSV list ('uuid', 'title', 'downloaded' and the
+        optional 'priority' and 'deadline').
+
+        Products already in the store keep their status, unless the CSV marks
+        them as downloaded (products already done are left as they are).
+        Priorities and deadlines in the CSV are always updated. Returns the
+        number of new products.
+        """
+        dwnfil = pd.read_csv(csvpath)
+        now = datetime.utcnow().isoformat()
+        has_priority = 'priority' in dwnfil.columns or 'deadline' in dwnfil.columns
+
+        def insert(con):
+            added = 0
+            start = con.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+            for i, row in enumerate(dwnfil.itertuples(index=False)):
+                status = 'done' if row.downloaded else 'queued'
+                cur = con.execute(
+                    "INSERT OR IGNORE INTO products (uuid, title, pos, status, updated) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (row.uuid, row.title, start + i, status, now)
+                )
+                added += cur.rowcount
+                if cur.rowcount == 0 and row.downloaded:
+                    old_status = con.execute(
+                        "SELECT status FROM products WHERE uuid = ?", (row.uuid,)
+                    ).fetchone()[0]
+                    # Products already done are not rewritten on every import
+                    if old_status != 'done':
+                        self._set(con, row.uuid, 'done', now, old_status)
+                if has_priority:
+                    priority = getattr(row, 'priority', 0)
+                    deadline = getattr(row, 'deadline', None)
+                    con.execute(
+                        "UPDATE products SET priority = ?, deadline = ? WHERE uuid = ?",
+                        (0 if pd.isna(priority) else int(priority),
+                         None if pd.isna(deadline) else _isoformat(deadline), row.uuid)
+                    )
+            return added
+
+        added = self._transaction(insert)
+        logging.info(f"Imported {csvpath} into {self.dbpath} ({added} new products)")
+        return added
+
+    def export_csv(self, csvpath):
+        """Write the list in the CSV format of query_list_LTA.py (with the
+        priorities and deadlines, if any were set)."""
+        rows = self._execute(
+            "SELECT uuid, title, status, priority, deadline FROM products ORDER BY pos"
+        )
+        dwnfil = pd.DataFrame(
+            [(uuid, title, status == 'done', priority, deadline)
+             for uuid, title, status, priority, deadline in rows],
+            columns=['uuid', 'title', 'downloaded', 'priority', 'deadline']
+        )
+        if not (dwnfil['priority'].any() or dwnfil['deadline'].notna().any()):
+            dwnfil = dwnfil[['uuid', 'title', 'downloaded']]
+        # Write to a temporary file first, so the CSV is never left half written
+        tmp_path = csvpath + '.tmp'
+        dwnfil.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, csvpath)
+
+    @staticmethod
+    def _set(con, uuid, status, now, old_status=None):
+        # A change of status ends the lease of a claim
+        con.execute(
+            "UPDATE products SET status = ?, updated = ?, owner = NULL, "
+            "lease_until = NULL WHERE uuid = ?",
+            (status, now, uuid)
+        )
+        con.execute(
+            "INSERT INTO journal (uuid, old_status, new_status, time, pid) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (uuid, old_status, status, now, os.getpid())
+        )
+
+    def transition(self, uuid, status, from_status=None):
+        """Atomically change the status of a product.
+
+        Parameters
+        ----------
+        uuid : str
+            UUID of the product.
+        status : str
+            New status (one of `STATUSES`).
+        from_status : str or tuple of str, optional
+            The change is only made if the current status is one of these.
+
+        Returns
+        -------
+        bool
+            True if the status was changed.
+        """
+        if status not in STATUSES:
+            raise ValueError(f"Unknown status {status}")
+        if isinstance(from_status, str):
+            from_status = (from_status,)
+
+        def update(con):
+            row = con.execute(
+                "SELECT status FROM products WHERE uuid = ?", (uuid,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(uuid)
+            if from_status is not None and row[0] not in from_status:
+                return False
+            self._set(con, uuid, status, datetime.utcnow().isoformat(), row[0])
+            return True
+
+        return self._transaction(update)
+
+    # Claims of downloaders
+    # ======================
+    @staticmethod
+    def _expired(con, uuid, now, lease):
+        """True if a product in 'downloading' has no valid lease."""
+        owner, lease_until, updated = con.execute(
+            "SELECT owner, lease_until, updated FROM products WHERE uuid = ?", (uuid,)
+        ).fetchone()
+        if lease_until is None:
+            # Claimed with transition() by an older version of the scripts
+            return updated < (now - timedelta(seconds=lease)).isoformat()
+        return lease_until < now.isoformat()
+
+    def claim(self, uuid, owner=None, lease=LEASE, from_status=CLAIMABLE):
+        """Claim a product for download.
+
+        The product is moved to 'downloading' with a lease of `lease` seconds
+        for `owner` (by default this process, see `worker_id()`). Products in
+        'downloading' whose lease has expired can be claimed again.
+
+        Returns
+        -------
+        bool
+            True if the product was claimed.
+        """
+        owner = owner if owner is not None else worker_id()
+
+        def update(con):
+            row = con.execute(
+                "SELECT status FROM products WHERE uuid = ?", (uuid,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(uuid)
+            now = datetime.utcnow()
+            if row[0] == 'downloading':
+                if not self._expired(con, uuid, now, lease):
+                    return False
+                logging.info(f"Lease of {uuid} has expired, claimed by {owner}")
+            elif row[0] not in from_status:
+                return False
+            self._set(con, uuid, 'downloading', now.isoformat(), row[0])
+            con.execute(
+                "UPDATE products SET owner = ?, lease_until = ? WHERE uuid = ?",
+                (owner, (now + timedelta(seconds=lease)).isoformat(), uuid)
+            )
+            return True
+
+        return self._transaction(update)
+
+    def heartbeat(self, uuid, owner=None, lease=LEASE):
+        """Renew the lease of a claimed product.
+
+        Returns False if the product is no longer claimed by `owner`.
+        """
+        owner = owner if owner is not None else worker_id()
+        lease_until = (datetime.utcnow() + timedelta(seconds=lease)).isoformat()
+        return self._transaction(lambda con: con.execute(
+            "UPDATE products SET lease_until = ? "
+            "WHERE uuid = ? AND owner = ? AND status = 'downloading'",
+            (lease_until, uuid, owner)
+        ).rowcount == 1)
+
+    def release(self, uuid, status, owner=None):
+        """Set the status of a claimed product at the end of the download.
+
+        Returns False (and leaves the status) if the lease was lost to
+        another downloader.
+        """
+        if status not in STATUSES:
+            raise ValueError(f"Unknown status {status}")
+        owner = owner if owner is not None else worker_id()
+
+        def update(con):
+            row = con.execute(
+                "SELECT owner FROM products WHERE uuid = ? AND status = 'downloading'",
+                (uuid,)
+            ).fetchone()
+            if row is None or row[0] != owner:
+                logging.warning(f"Lease of {uuid} was lost, status {status} not set")
+                return False
+            self._set(con, uuid, status, datetime.utcnow().isoformat(), 'downloading')
+            return True
+
+        return self._transaction(update)
+
+    def reclaim(self, lease=LEASE):
+        """Move products whose lease has expired back to 'online' (their
+        downloader has stopped). Returns the list of their UUIDs."""
+        def update(con):
+            now = datetime.utcnow()
+            rows = con.execute(
+                "SELECT uuid FROM products WHERE status = 'downloading'"
+            ).fetchall()
+            expired = [uuid for uuid, in rows if self._expired(con, uuid, now, lease)]
+            for uuid in expired:
+                self._set(con, uuid, 'online', now.isoformat(), 'downloading')
+            return expired
+
+        expired = self._transaction(update)
+        if expired:
+            logging.info(f"{len(expired)} products with an expired lease reclaimed")
+        return expired
+
+    def lease(self, uuid, owner=None, lease=LEASE):
+        """Heartbeat of a claimed product while it is downloaded, e.g.
+        `with store.lease(uuid): ...` (see `Lease`)."""
+        return Lease(self, uuid, owner if owner is not None else worker_id(), lease)
+
+    def owners(self):
+        """Dict {uuid: owner} of the products being downloaded."""
+        return dict(self._execute(
+            "SELECT uuid, owner FROM products "
+            "WHERE status = 'downloading' AND owner IS NOT NULL"
+        ))
+
+    def status(self, uuid):
+        """Current status of a product."""
+        rows = self._execute("SELECT status FROM products WHERE uuid = ?", (uuid,))
+        if not rows:
+            raise KeyError(uuid)
+        return rows[0][0]
+
+    def changed_at(self, uuid, status):
+        """UTC time of the last change of a product to `status` (or None)."""
+        rows = self._execute(
+            "SELECT MAX(time) FROM journal WHERE uuid = ? AND new_status = ?",
+            (uuid, status)
+        )
+        if rows[0][0] is None:
+            return None
+        return datetime.fromisoformat(rows[0][0])
+
+    def since_trigger(self, uuid):
+        """Seconds since the last trigger of a product (or None)."""
+        triggered = self.changed_at(uuid, 'triggered')
+        if triggered is None:
+            return None
+        return (datetime.utcnow() - triggered).total_seconds()
+
+    def products(self, *statuses):
+        """List of (uuid, title, status) in the order of the CSV list,
+        optionally only products with one of the given statuses."""
+        rows = self._execute("SELECT uuid, title, status FROM products ORDER BY pos")
+        if statuses:
+            rows = [row for row in rows if row[2] in statuses]
+        return rows
+
+    def queue(self, *statuses):
+        """List of (uuid, title, status) in the order of the priority queue,
+        optionally only products with one of the given statuses.
+
+        Products with a higher priority come first, then products with an
+        earlier deadline (products without a deadline last), then the order
+        of the CSV list.
+        """
+        rows = self._execute(
+            "SELECT uuid, title, status FROM products "
+            "ORDER BY priority DESC, deadline IS NULL, deadline, pos"
+        )
+        if statuses:
+            rows = [row for row in rows if row[2] in statuses]
+        return rows
+
+    def set_priority(self, uuid, priority=0, deadline=None):
+        """Set the priority and the deadline (datetime or date string in UTC,
+        e.g. 'NOW+2DAYS') of a product."""
+        deadline = _isoformat(deadline) if deadline is not None else None
+        self._transaction(lambda con: con.execute(
+            "UPDATE products SET priority = ?, deadline = ? WHERE uuid = ?",
+            (priority, deadline, uuid)
+        ))
+
+    def deadline(self, uuid):
+        """Deadline (UTC datetime) of a product or None."""
+        rows = self._execute("SELECT deadline FROM products WHERE uuid = ?", (uuid,))
+        if not rows:
+            raise KeyError(uuid)
+        return datetime.fromisoformat(rows[0][0]) if rows[0][0] is not None else None
+
+    def changes(self, status, seconds, from_status=None):
+        """Number of changes to `status` within the last `seconds`, optionally
+        only changes from `from_status`."""
+        since = (datetime.utcnow() - timedelta(seconds=seconds)).isoformat()
+        if from_status is None:
+            rows = self._execute(
+                "SELECT COUNT(*) FROM journal WHERE new_status = ? AND time >= ?",
+                (status, since)
+            )
+        else:
+            rows = self._execute(
+                "SELECT COUNT(*) FROM journal "
+                "WHERE new_status = ? AND old_status = ? AND time >= ?",
+                (status, from_status, since)
+            )
+        return rows[0][0]
+
+    def set_account(self, uuid, username):
+        """Assign a product to an account (see credentials.py)."""
+        self._transaction(lambda con: con.execute(
+            "UPDATE products SET account = ? WHERE uuid = ?", (username, uuid)
+        ))
+
+    def accounts(self):
+        """Dict {uuid: username} of products assigned to an account."""
+        rows = self._execute(
+            "SELECT uuid, account FROM products WHERE account IS NOT NULL"
+        )
+        return dict(rows)
+
+    def counts(self):
+        """Number of products per status."""
+        rows = self._execute("SELECT status, COUNT(*) FROM products GROUP BY status")
+        return dict(rows)
+
+
+class Lease:
+    """Renew the lease of a claimed product in a background thread.
+
+    Parameters
+    ----------
+    store : StateStore
+        Store of the product.
+    uuid : str
+        UUID of the claimed product.
+    owner : str
+        Downloader that claimed the product.
+    duration : float
+        Seconds of the lease, renewed every third of it.
+    """
+
+    def __init__(self, store, uuid, owner, duration=LEASE):
+        self.store = store
+        self.uuid = uuid
+        self.owner = owner
+        self.duration = duration
+        self.lost = False
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _renew(self):
+        with self._lock:
+            if self.lost:
+                return
+            if not self.store.heartbeat(self.uuid, self.owner, self.duration):
+                logging.warning(f"Lease of {self.uuid} was taken over by "
+                                f"another downloader")
+                self.lost = True
+
+    def _run(self):
+        while not self.lost and not self._stop.wait(self.duration / 3):
+            try:
+                self._renew()
+            except sqlite3.Error as e:
+                # Database busy, try again with the next heartbeat
+                logging.warning(f"Heartbeat of {self.uuid} failed: {e}")
+
+    def check(self, renew=False):
+        """Raise LeaseLostError if the claim was taken over. With `renew`
+        the lease is renewed first (e.g. before the download is committed)."""
+        if renew:
+            self._renew()
+        if self.lost:
+            raise LeaseLostError(f"Claim of {self.uuid} was taken over by "
+                                 f"another downloader")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures of the tests: the scripts are imported from the repository folder
+and downloads run against the local mock hub (mock_dhus.py).
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sentinelsat import SentinelAPI  # noqa: E402
+from mock_dhus import MockDHuS  # noqa: E402
+
+
+@pytest.fixture
+def hub():
+    """Mock hub with a few online products of 3 MB."""
+    mock = MockDHuS(n_products=2, size=3 * 2 ** 20, offline_ratio=0.)
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def api(hub):
+    return SentinelAPI('user', 'password', hub.url, show_progressbars=False)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Queries for several AOIs of aoi_planner.py against the mock hub: merged
+footprints, deduplicated products and their AOIs.
+"""
+
+import json
+
+import pytest
+
+from shapely.geometry import box, mapping
+from sentinelsat import SentinelAPI
+from mock_dhus import MockDHuS
+from query_engine import QueryEngine
+from aoi_planner import QueryPlanner, merge_aois, read_aois, tile
+
+
+# Two neighbouring AOIs and one far away
+AOIS = [('west', box(11.0, 41.0, 11.5, 41.5)),
+        ('east', box(11.55, 41.0, 12.0, 41.5)),
+        ('far', box(16.0, 46.0, 16.5, 46.5))]
+
+
+@pytest.fixture(scope='module')
+def wide_hub():
+    """Mock hub with 40 frames spread over a large area."""
+    mock = MockDHuS(n_products=40, size=2 ** 10, area=box(10., 40., 20., 50.))
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def planner(wide_hub):
+    wide_hub.reset_stats()
+    api = SentinelAPI('user', 'password', wide_hub.url, show_progressbars=False)
+    return QueryPlanner(QueryEngine(api), AOIS)
+
+
+def test_merge_and_tile():
+    assert merge_aois(AOIS, merge_distance=0.1) == [[0, 1], [2]]
+    assert merge_aois(AOIS, merge_distance=0.01) == [[0], [1], [2]]
+    tiles = tile(box(0., 0., 5., 2.), max_extent=2.)
+    assert len(tiles) == 3
+    assert sum(t.area for t in tiles) == pytest.approx(10.)
+
+
+def test_read_aois(tmp_path):
+    path = str(tmp_path / 'aois.geojson')
+    with open(path, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {'name': 'west'},
+             'geometry': mapping(AOIS[0][1])},
+            {'type': 'Feature', 'properties': {},
+             'geometry': mapping(AOIS[2][1])}
+        ]}, f)
+    aois = read_aois(path)
+    assert [name for name, _ in aois] == ['west', 'aoi_1']
+    assert aois[1][1].equals(AOIS[2][1])
+
+
+def test_products_of_all_aois(wide_hub, planner):
+    start, end = '2017-01-01T00:00:00.000Z', '2017-02-01T00:00:00.000Z'
+    products = planner.products(start, end)
+    # One query per merged footprint (and time window)
+    assert len(planner.footprints()) == 2
+    assert wide_hub.stats['queries'] == 2 * len(planner.engine.windows(start, end))
+
+    expected = {}
+    for product in wide_hub.products.values():
+        names = [name for name, geom in AOIS if product.footprint.intersects(geom)]
+        if names:
+            expected[product.uuid] = names
+    assert expected
+    assert {pid: p['aois'] for pid, p in products.items()} == expected
+    begin = [p['beginposition'] for p in products.values()]
+    assert begin == sorted(begin)
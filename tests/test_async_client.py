@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Batched and concurrent metadata requests of async_client.py against the mock
+hub (skipped without aiohttp).
+"""
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from sentinelsat import SentinelAPI  # noqa: E402
+from mock_dhus import MockDHuS  # noqa: E402
+from async_client import AsyncClient  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def meta_hub():
+    """Mock hub with 25 products, about half of them in the LTA."""
+    mock = MockDHuS(n_products=25, size=2 ** 10, offline_ratio=0.5)
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def meta_api(meta_hub):
+    meta_hub.reset_stats()
+    return SentinelAPI('user', 'password', meta_hub.url, show_progressbars=False)
+
+
+@pytest.fixture
+def client(meta_api):
+    client = AsyncClient(meta_api, concurrency=4, batch_size=10)
+    yield client
+    client.close()
+
+
+def test_metadata_in_batches(meta_hub, meta_api, client):
+    product_ids = list(meta_hub.products)
+    unknown = '00000000-0000-4000-8000-000000000000'
+    infos = client.run(client.odata_many(product_ids + [unknown]))
+    assert meta_hub.stats['odata'] == 3
+    assert set(infos) == set(product_ids)
+
+    # Same metadata as one request per product
+    for product_id in product_ids[:3]:
+        expected = meta_api.get_product_odata(product_id)
+        for key in ('id', 'title', 'size', 'md5', 'url', 'Online'):
+            assert infos[product_id][key] == expected[key]
+
+
+def test_status_in_batches(meta_hub, client):
+    status = client.run(client.status(list(meta_hub.products)))
+    assert status == {pid: p.online for pid, p in meta_hub.products.items()}
+    assert meta_hub.stats['odata'] == 3
+
+
+def test_query_pages_at_once(meta_hub, meta_api, client):
+    query = meta_api.format_query(None, platformname='Sentinel-1')
+    pages = client.run(client.query_pages(query, [0, 10, 20], 10,
+                                          'beginposition asc'))
+    assert meta_hub.stats['queries'] == 3
+    titles = [entry['title'] for entries in pages for entry in entries]
+    assert titles == [p.title for p in meta_hub.products.values()]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Bandwidth limit of bandwidth.py shared by concurrent downloads from the mock
+hub, time-of-day windows and the order of the downloads.
+"""
+
+from datetime import datetime
+from time import perf_counter
+
+import pytest
+
+import bandwidth
+from bandwidth import BandwidthLimiter, order_products
+from dwn_pool import download_pool
+
+
+@pytest.fixture
+def limit():
+    """Set the limit of all downloads, removed after the test."""
+    yield bandwidth.limiter.configure
+    bandwidth.limiter.configure(None)
+
+
+def test_limit_shared_by_all_downloads(hub, api, limit, tmp_path):
+    # 2 products of 3 MB at 4 MB/s together
+    limit(4 * 2 ** 20)
+    start = perf_counter()
+    _, failed, _ = download_pool(api, list(hub.products), str(tmp_path), workers=2)
+    seconds = perf_counter() - start
+    assert not failed
+    assert seconds > 0.9 * 6 / 4
+
+
+def test_rate_of_the_time_windows():
+    limiter = BandwidthLimiter(2 ** 20, [("20:00", "06:00", None),
+                                         ("12:00", "13:00", 2 ** 10)])
+    assert limiter.rate_at(datetime(2020, 1, 1, 23, 0)) is None
+    assert limiter.rate_at(datetime(2020, 1, 1, 5, 59)) is None
+    assert limiter.rate_at(datetime(2020, 1, 1, 12, 30)) == 2 ** 10
+    assert limiter.rate_at(datetime(2020, 1, 1, 6, 0)) == 2 ** 20
+
+
+def test_order_products():
+    products = {
+        'a': {'size': '2.5 GB', 'beginposition': datetime(2020, 1, 2)},
+        'b': {'size': '800 MB', 'beginposition': datetime(2020, 1, 3)},
+        'c': {'size': None, 'beginposition': datetime(2020, 1, 1)},
+        'd': {'size': '4 GB'},
+    }
+    assert order_products(products) == ['a', 'b', 'c', 'd']
+    assert order_products(products, 'smallest') == ['b', 'a', 'd', 'c']
+    assert order_products(products, 'largest') == ['d', 'a', 'b', 'c']
+    assert order_products(products, 'newest') == ['b', 'a', 'c', 'd']
+    with pytest.raises(ValueError):
+        order_products(products, 'fastest')
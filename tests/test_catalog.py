@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Catalog of downloaded products (catalog.py): products of the mock hub that
+are downloaded already and products added to the download folder by hand
+after the first scan.
+"""
+
+import os
+
+from catalog import Catalog
+
+
+def add_product(folder, title, mtime):
+    """Put a product into a folder and set the modification time of the
+    folder (the resolution of the file system can be coarse)."""
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, title + '.zip'), 'wb') as f:
+        f.write(b'zip')
+    os.utime(folder, ns=(mtime, mtime))
+
+
+def test_refresh_registers_products_added_by_hand(tmp_path):
+    dwndir = str(tmp_path)
+    add_product(dwndir, 'S1A_FIRST', 10 ** 18)
+    cat = Catalog(str(tmp_path / 'catalog.sqlite'))
+    assert cat.refresh(dwndir) == 1
+
+    # Nothing has changed, the folder is not walked
+    assert cat.refresh(dwndir) == 0
+
+    add_product(os.path.join(dwndir, '2017'), 'S1A_SECOND', 10 ** 18 + 10 ** 9)
+    assert cat.refresh(dwndir) == 1
+    assert cat.done()[0] == {'S1A_FIRST', 'S1A_SECOND'}
+    cat.close()
+
+
+def test_own_downloads_do_not_cause_a_scan(tmp_path, monkeypatch):
+    dwndir = str(tmp_path / 'dwn')
+    add_product(dwndir, 'S1A_FIRST', 10 ** 18)
+    cat = Catalog()
+    cat.refresh(dwndir)
+
+    add_product(dwndir, 'S1A_SECOND', 10 ** 18 + 10 ** 9)
+    cat.mark_done({'id': 'uuid-2', 'title': 'S1A_SECOND'})
+    cat.mark_scanned(dwndir)
+    monkeypatch.setattr(Catalog, 'scan', lambda self, dwndir: 1 / 0)
+    assert cat.refresh(dwndir) == 0
+
+
+def test_failed_product_from_the_lta(tmp_path):
+    cat = Catalog()
+    cat.mark_offline({'id': 'uuid-1', 'title': 'S1A_OFFLINE', 'triggered': True})
+    cat.mark_failed('uuid-1', 'S1A_OFFLINE')
+    assert cat.failed() == {'uuid-1': 'S1A_OFFLINE'}
+    assert not cat.offline()
+
+    cat.mark_done({'id': 'uuid-1', 'title': 'S1A_OFFLINE'})
+    cat.mark_failed('uuid-1', 'S1A_OFFLINE')
+    assert not cat.failed()
+
+
+def test_missing_products_of_a_query(hub, api, tmp_path):
+    first, second = hub.products.values()
+    results = api.query(platformname='Sentinel-1')
+    # The first product is in a subfolder of the download folder already
+    add_product(str(tmp_path / '2017'), first.title, 10 ** 18)
+    cat = Catalog()
+    cat.refresh(str(tmp_path))
+    assert cat.missing(results) == [second.uuid]
+
+    cat.mark_done({'id': second.uuid, 'title': second.title})
+    assert cat.missing(results) == []
+    cat.close()
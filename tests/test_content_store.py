@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Products of the mock hub shared by two download folders through the content
+store (content_store.py): links, references and cleanup.
+"""
+
+import os
+from collections import OrderedDict
+
+import pytest
+
+import credentials
+import rate_limiter
+from auto_dwn_slc import download_products
+from catalog import Catalog
+from content_store import ContentStore
+from credentials import CredentialPool
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ContentStore(str(tmp_path / 'store'))
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def download(hub, store, tmp_path, monkeypatch):
+    """Download all products of the hub into a project folder."""
+    monkeypatch.setattr(credentials, 'API_URL', hub.url)
+    monkeypatch.setattr(rate_limiter, '_buckets', {})
+    apipath = str(tmp_path / 'apihub.txt')
+    with open(apipath, 'w') as f:
+        f.write('user password\n')
+    pool = CredentialPool.from_file(apipath)
+    titles = OrderedDict((p.uuid, p.title) for p in hub.products.values())
+
+    def run(project):
+        dwndir = str(tmp_path / project)
+        os.makedirs(dwndir)
+        cat = Catalog()
+        failed, _ = download_products(pool, cat, titles, dwndir, workers=2,
+                                      store=store)
+        assert not failed
+        assert cat.done()[1] == set(titles)
+        cat.close()
+        return {pid: os.path.join(dwndir, title + '.zip')
+                for pid, title in titles.items()}
+
+    return run
+
+
+def test_product_linked_into_a_second_folder(hub, store, download):
+    first = download('project_a')
+    assert hub.stats['downloads'] == 2
+    second = download('project_b')
+    assert hub.stats['downloads'] == 2
+
+    for product_id, path in second.items():
+        assert os.path.samefile(path, first[product_id])
+        assert store.refcount(product_id) == 2
+    assert len(store) == 2
+
+
+def test_stored_copy_removed_with_the_last_reference(hub, store, download):
+    first = download('project_a')
+    second = download('project_b')
+    product_id = next(iter(first))
+    stored = store.get(product_id)['path']
+
+    assert store.release(first[product_id]) == 1
+    assert not os.path.exists(first[product_id])
+    assert os.path.exists(stored) and os.path.exists(second[product_id])
+
+    assert store.release(second[product_id]) == 0
+    assert not os.path.exists(stored)
+    assert store.get(product_id) is None
+
+
+def test_gc_after_products_deleted_by_hand(hub, store, download):
+    first = download('project_a')
+    product_id = next(iter(first))
+    stored = store.get(product_id)['path']
+    os.remove(first[product_id])
+
+    assert store.gc() == 1
+    assert not os.path.exists(stored)
+    assert len(store) == 1
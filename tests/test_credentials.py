@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Pool of SciHUB accounts of credentials.py against the mock hub: triggers and
+downloads spread over the accounts.
+"""
+
+import threading
+
+import pytest
+
+import dwn_engine
+import rate_limiter
+from mock_dhus import MockDHuS
+from credentials import Account, CredentialPool, read_credentials
+from dwn_pool import download_pool
+from rate_limiter import trigger_retrieval
+
+
+@pytest.fixture
+def lta_hub(monkeypatch):
+    """Mock hub with 4 offline products and a quota of 1 trigger per minute."""
+    monkeypatch.setattr(rate_limiter, '_buckets', {})
+    mock = MockDHuS(n_products=4, size=2 ** 20, offline_ratio=1.,
+                    restore_latency=0.1, quota=(1, 60.), bandwidth=2 * 2 ** 20)
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def pool(lta_hub):
+    """Two accounts with the quota of the hub and 1 download at a time."""
+    return CredentialPool([
+        Account(name, 'password', lta_hub.url, quota=(1, 60.), max_downloads=1)
+        for name in ('alice', 'bob')
+    ])
+
+
+def test_read_credentials(tmp_path):
+    apipath = str(tmp_path / 'apihub.txt')
+    with open(apipath, 'w') as f:
+        f.write("# accounts\nalice secret\n\nbob two words \n")
+    assert read_credentials(apipath) == [('alice', 'secret'), ('bob', 'two words ')]
+
+    with open(apipath, 'w') as f:
+        f.write("alice secret\nbobsecret\n")
+    with pytest.raises(IOError, match="Line 2") as e:
+        read_credentials(apipath)
+    assert 'bobsecret' not in str(e.value)
+
+
+def test_triggers_spread_over_the_accounts(lta_hub, pool):
+    used = []
+    for product in list(lta_hub.products.values())[:2]:
+        account = pool.trigger_account()
+        pool.assign(product.uuid, account)
+        trigger_retrieval(account.api, product.uuid, account.limiter, block=False)
+        used.append(account.username)
+    assert sorted(used) == ['alice', 'bob']
+    assert lta_hub.stats['triggers'] == 2
+    assert lta_hub.stats['quota_errors'] == 0
+    assert pool.next_trigger_slot() > 0
+
+
+def test_product_downloaded_by_its_account(lta_hub, pool, monkeypatch, tmp_path):
+    for product in lta_hub.products.values():
+        product.online = True
+    first = next(iter(lta_hub.products))
+    pool.assign(first, pool.accounts[1])
+
+    # Downloads of every account at the same time
+    running = {}
+    peak = {}
+    lock = threading.Lock()
+    download = dwn_engine.download
+
+    def counting_download(api, *args, **kwargs):
+        user = api.session.auth[0]
+        with lock:
+            running[user] = running.get(user, 0) + 1
+            peak[user] = max(peak.get(user, 0), running[user])
+        try:
+            return download(api, *args, **kwargs)
+        finally:
+            with lock:
+                running[user] -= 1
+
+    monkeypatch.setattr(dwn_engine, 'download', counting_download)
+    return_values, failed, _ = download_pool(
+        pool.api, list(lta_hub.products), str(tmp_path), workers=4, pool=pool
+    )
+    assert not failed
+    assert peak == {'alice': 1, 'bob': 1}
+    assert pool.assign(first).username == 'bob'
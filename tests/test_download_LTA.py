@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+download_LTA.py against the mock hub: products that go back to the LTA
+between the status poll and the download.
+"""
+
+import os
+from time import monotonic
+
+import pandas as pd
+import pytest
+
+import credentials
+import download_LTA
+import rate_limiter
+from mock_dhus import MockDHuS
+from lta_status import StatusPoller
+from state_store import StateStore
+
+
+@pytest.fixture
+def lta_hub():
+    """Mock hub with online products, restored from the LTA within 0.5 s."""
+    mock = MockDHuS(n_products=2, size=2 ** 20, offline_ratio=0.,
+                    restore_latency=0.5, quota=(10, 1.))
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def session(lta_hub, tmp_path, monkeypatch):
+    """Paths of a download session with the products of the hub."""
+    monkeypatch.setattr(credentials, 'API_URL', lta_hub.url)
+    monkeypatch.setattr(rate_limiter, '_buckets', {})
+    monkeypatch.setattr(download_LTA, 'POLL_INTERVAL', 0.1)
+    products = list(lta_hub.products.values())
+    csvpath = str(tmp_path / 'slc_list.csv')
+    pd.DataFrame({'uuid': [p.uuid for p in products],
+                  'title': [p.title for p in products],
+                  'downloaded': False}).to_csv(csvpath, index=False)
+    apipath = str(tmp_path / 'apihub.txt')
+    with open(apipath, 'w') as f:
+        f.write('user password\n')
+    dwndir = str(tmp_path / 'dwn')
+    os.makedirs(dwndir)
+    return dwndir, csvpath, str(tmp_path / 'download.log'), apipath
+
+
+def test_slow_restore_does_not_block_the_list(lta_hub, session):
+    slow, fast = lta_hub.products.values()
+    # Both products are being restored, the first one of the list takes longer
+    for product, latency in ((slow, 1.5), (fast, 0.2)):
+        product.online = False
+        product.restored_at = monotonic() + latency
+    dwndir, csvpath, logpath, apipath = session
+    download_LTA.main(dwndir, csvpath, logpath, apipath)
+
+    store = StateStore.from_csv(csvpath)
+    assert store.counts() == {'done': 2}
+    assert store.changed_at(fast.uuid, 'done') < store.changed_at(slow.uuid, 'done')
+    store.close()
+
+
+def test_product_evicted_before_download(lta_hub, session, monkeypatch):
+    evicted = []
+
+    class EvictingPoller(StatusPoller):
+        """Reports the first product online, then it goes back to the LTA."""
+
+        def get(self, product_ids, refresh=False):
+            status = super().get(product_ids, refresh)
+            if not evicted:
+                product = next(iter(lta_hub.products.values()))
+                product.online = False
+                evicted.append(product)
+            return status
+
+    monkeypatch.setattr(download_LTA, 'StatusPoller', EvictingPoller)
+    dwndir, csvpath, logpath, apipath = session
+    download_LTA.main(dwndir, csvpath, logpath, apipath)
+
+    product = evicted[0]
+    assert lta_hub.stats['triggers'] == 1
+    assert os.path.exists(os.path.join(dwndir, product.title + '.zip'))
+    store = StateStore.from_csv(csvpath)
+    assert store.counts() == {'done': 2}
+    store.close()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Cycles of dwn_daemon.py against the mock hub: the watermark of the queries
+and products restored from the LTA.
+"""
+
+import os
+from time import sleep
+
+import pytest
+
+from shapely.geometry import box
+from sentinelsat import SentinelAPI
+import credentials
+import dwn_daemon
+import rate_limiter
+from catalog import Catalog
+from mock_dhus import MockDHuS
+from query_engine import QueryEngine, parse_date
+
+
+@pytest.fixture
+def daemon_hub():
+    """Mock hub with 3 products, the last one in the LTA."""
+    mock = MockDHuS(n_products=3, size=2 ** 20, offline_ratio=0.,
+                    restore_latency=0.2)
+    list(mock.products.values())[-1].online = False
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def run_cycle(daemon_hub, tmp_path, monkeypatch):
+    """Run one cycle of the daemon, return the catalog."""
+    monkeypatch.setattr(credentials, 'API_URL', daemon_hub.url)
+    monkeypatch.setattr(rate_limiter, '_buckets', {})
+
+    def stop(seconds):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(dwn_daemon, 'sleep', stop)
+    apipath = str(tmp_path / 'apihub.txt')
+    with open(apipath, 'w') as f:
+        f.write('user password\n')
+    dwndir = str(tmp_path / 'dwn')
+    os.makedirs(dwndir)
+    catpath = str(tmp_path / 'catalog.sqlite')
+    qp = {'strtime': '2016-12-01T00:00:00.000Z', 'platformname': 'Sentinel-1',
+          'producttype': 'SLC', 'footprint': box(13., 45., 17., 47.), 'aois': None}
+
+    def run():
+        dwn_daemon.main(dwndir, str(tmp_path / 'daemon.log'), apipath, qp, catpath,
+                        workers=2)
+        return Catalog(catpath)
+
+    return run
+
+
+def test_cycles_continue_at_the_watermark(daemon_hub, run_cycle):
+    online = [p.uuid for p in daemon_hub.products.values() if p.online]
+    offline = [p.uuid for p in daemon_hub.products.values() if not p.online]
+
+    cat = run_cycle()
+    assert cat.done()[1] == set(online)
+    assert list(cat.offline()) == offline
+    assert cat.offline()[offline[0]][1] == 'triggered'
+    watermark = parse_date(cat.get_meta('watermark'))
+    cat.close()
+    assert daemon_hub.stats['triggers'] == 1
+
+    # The next cycle queries only the products ingested since the watermark,
+    # the product restored from the LTA is downloaded
+    sleep(0.3)
+    daemon_hub.reset_stats()
+    cat = run_cycle()
+    assert cat.done()[1] == set(online + offline)
+    assert not cat.offline()
+    assert parse_date(cat.get_meta('watermark')) > watermark
+    cat.close()
+    assert daemon_hub.stats['downloads'] == 1
+
+
+def test_query_new_by_ingestion_date(daemon_hub):
+    api = SentinelAPI('user', 'password', daemon_hub.url, show_progressbars=False)
+    qp = {'platformname': 'Sentinel-1', 'producttype': 'SLC',
+          'footprint': box(13., 45., 17., 47.)}
+    first, second, third = daemon_hub.products.values()
+    products = dwn_daemon.query_new(QueryEngine(api), None, qp,
+                                    second.ingestion, third.ingestion)
+    assert list(products) == [second.uuid, third.uuid]
+    assert set(products[second.uuid]) == {'title', 'size', 'beginposition'}
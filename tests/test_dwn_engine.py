@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Resumed downloads and refetched chunks of dwn_engine.py.
+"""
+
+import hashlib
+import os
+
+import pytest
+
+import dwn_engine
+
+CHUNK_SIZE = 2 ** 20
+
+
+def _paths(dwndir, product):
+    path = os.path.join(dwndir, product.title + '.zip')
+    return path, path + '.incomplete', path + '.incomplete.json'
+
+
+def _md5(path):
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def test_interrupted_download_resumes(hub, api, tmp_path):
+    product = next(iter(hub.products.values()))
+    path, temp_path, state_path = _paths(str(tmp_path), product)
+
+    # The connection is closed half way
+    hub.cut_ratio = 1.
+    with pytest.raises(Exception):
+        dwn_engine.download(api, product.uuid, str(tmp_path), chunk_size=CHUNK_SIZE)
+    assert not os.path.exists(path)
+    assert os.path.exists(temp_path) and os.path.exists(state_path)
+
+    # Only the chunks that are not on disk are downloaded again
+    hub.cut_ratio = 0.
+    info = dwn_engine.download(api, product.uuid, str(tmp_path), chunk_size=CHUNK_SIZE)
+    assert 0 < info['downloaded_bytes'] < product.size
+    assert _md5(path) == product.md5
+    assert not os.path.exists(temp_path) and not os.path.exists(state_path)
+
+
+def test_corrupt_chunk_is_refetched(hub, api, tmp_path):
+    product = next(iter(hub.products.values()))
+    path, temp_path, _ = _paths(str(tmp_path), product)
+
+    hub.cut_ratio = 1.
+    with pytest.raises(Exception):
+        dwn_engine.download(api, product.uuid, str(tmp_path), chunk_size=CHUNK_SIZE)
+
+    # Damage the first chunk, which is in the manifest
+    with open(temp_path, 'r+b') as f:
+        f.write(b'\0' * 1024)
+    hub.cut_ratio = 0.
+    info = dwn_engine.download(api, product.uuid, str(tmp_path), chunk_size=CHUNK_SIZE)
+    assert info['downloaded_bytes'] > product.size - CHUNK_SIZE
+    assert _md5(path) == product.md5
+
+
+def test_chunks_missing_after_refetches(hub, api, tmp_path, monkeypatch):
+    product = next(iter(hub.products.values()))
+    path, temp_path, state_path = _paths(str(tmp_path), product)
+
+    # Every chunk after the first one is damaged on disk once it is written,
+    # all chunks are read back by the checksum
+    fetch_run = dwn_engine._fetch_run
+
+    def damaging_fetch_run(session, url, temp_path, run, size, chunk_size,
+                           on_chunk, *args):
+        def on_damaged_chunk(idx, chunk_md5, hashed):
+            if idx > 0:
+                with open(temp_path, 'r+b') as f:
+                    f.seek(idx * chunk_size)
+                    f.write(b'\0' * 1024)
+            on_chunk(idx, chunk_md5, hashed)
+        return fetch_run(session, url, temp_path, run, size, chunk_size,
+                         on_damaged_chunk, *args)
+
+    monkeypatch.setattr(dwn_engine, '_fetch_run', damaging_fetch_run)
+    monkeypatch.setattr(dwn_engine._Md5Cursor, 'is_next', lambda self, idx: False)
+    with pytest.raises(IOError, match="still missing"):
+        dwn_engine.download(api, product.uuid, str(tmp_path), checksum=False,
+                            segments=2, chunk_size=CHUNK_SIZE, max_refetch=1)
+    # The holes are never renamed to the product, the manifest is kept
+    assert not os.path.exists(path)
+    assert os.path.exists(temp_path) and os.path.exists(state_path)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent downloads of dwn_pool.py against the mock hub.
+"""
+
+import hashlib
+import os
+import threading
+
+import pytest
+
+import dwn_engine
+from sentinelsat import SentinelAPI
+from mock_dhus import MockDHuS
+from dwn_pool import download_pool
+
+
+@pytest.fixture
+def slow_hub():
+    """Mock hub with 4 online products, served at 2 MB/s per connection."""
+    mock = MockDHuS(n_products=4, size=2 ** 20, offline_ratio=0.,
+                    bandwidth=2 * 2 ** 20)
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def slow_api(slow_hub):
+    return SentinelAPI('user', 'password', slow_hub.url, show_progressbars=False)
+
+
+@pytest.fixture
+def running(monkeypatch):
+    """Highest number of downloads that ran at the same time."""
+    state = {'now': 0, 'peak': 0}
+    lock = threading.Lock()
+    download = dwn_engine.download
+
+    def counting_download(*args, **kwargs):
+        with lock:
+            state['now'] += 1
+            state['peak'] = max(state['peak'], state['now'])
+        try:
+            return download(*args, **kwargs)
+        finally:
+            with lock:
+                state['now'] -= 1
+
+    monkeypatch.setattr(dwn_engine, 'download', counting_download)
+    return state
+
+
+def test_products_downloaded_concurrently(slow_hub, slow_api, running, tmp_path):
+    products = list(slow_hub.products.values())
+    done = []
+    return_values, failed, last_exception = download_pool(
+        slow_api, [p.uuid for p in products], str(tmp_path), workers=2,
+        on_done=done.append
+    )
+    assert running['peak'] == 2
+    assert not failed and last_exception is None
+    # Results in the order of the list, the callback in the order of the end
+    assert list(return_values) == [p.uuid for p in products]
+    assert sorted(info['id'] for info in done) == sorted(return_values)
+    for product in products:
+        with open(os.path.join(str(tmp_path), product.title + '.zip'), 'rb') as f:
+            assert hashlib.md5(f.read()).hexdigest() == product.md5
+
+
+def test_failed_product_does_not_stop_the_pool(hub, api, tmp_path):
+    first, second = hub.products.values()
+    uuid_list = [first.uuid, '00000000-0000-4000-8000-000000000000', second.uuid]
+    return_values, failed, last_exception = download_pool(
+        api, uuid_list, str(tmp_path), workers=3, max_attempts=2
+    )
+    assert list(return_values) == [first.uuid, second.uuid]
+    assert failed == {uuid_list[1]}
+    assert last_exception is not None
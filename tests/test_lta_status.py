@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Batched 'Online' status polling of lta_status.py against the mock hub.
+"""
+
+import pytest
+
+import async_client
+from sentinelsat import SentinelAPI
+from mock_dhus import MockDHuS
+from lta_status import StatusPoller
+
+
+@pytest.fixture(scope='module')
+def lta_hub():
+    """Mock hub with 25 products, about half of them in the LTA."""
+    mock = MockDHuS(n_products=25, size=2 ** 10, offline_ratio=0.5)
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def poller(lta_hub, monkeypatch):
+    """Poller that sends one batch after another (without aiohttp)."""
+    monkeypatch.setattr(async_client, 'for_api', lambda api: None)
+    lta_hub.reset_stats()
+    return StatusPoller(SentinelAPI('user', 'password', lta_hub.url), batch_size=10)
+
+
+def test_status_polled_in_batches(lta_hub, poller):
+    status = poller.get(list(lta_hub.products))
+    assert status == {pid: p.online for pid, p in lta_hub.products.items()}
+    # 3 batches of up to 10 products instead of 25 requests
+    assert lta_hub.stats['odata'] == 3
+
+
+def test_cached_status_reused(lta_hub, poller):
+    product_ids = list(lta_hub.products)
+    poller.get(product_ids[:10])
+    poller.get(product_ids[:10])
+    assert lta_hub.stats['odata'] == 1
+
+    # Only the products that are not cached are requested
+    poller.get(product_ids[5:15])
+    assert lta_hub.stats['odata'] == 2
+    poller.get(product_ids[:10], refresh=True)
+    assert lta_hub.stats['odata'] == 3
+
+
+def test_invalidated_status_polled_again(lta_hub, poller):
+    product = next(p for p in lta_hub.products.values() if not p.online)
+    assert not poller.is_online(product.uuid)
+
+    product.online = True
+    assert not poller.is_online(product.uuid)
+    poller.invalidate(product.uuid)
+    assert poller.is_online(product.uuid)
+    product.online = False
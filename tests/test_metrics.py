@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Timings and counters of metrics.py recorded by downloads and triggers from
+the mock hub.
+"""
+
+import json
+from urllib.request import urlopen
+
+import pytest
+
+import dwn_engine
+import dwn_pool
+import rate_limiter
+from metrics import Metrics
+from dwn_pool import download_pool
+
+
+@pytest.fixture
+def registry(monkeypatch, tmp_path):
+    """Fresh registry of the download modules, written to `tmp_path`."""
+    registry = Metrics(flush_interval=0)
+    for module in (dwn_engine, dwn_pool, rate_limiter):
+        monkeypatch.setattr(module, 'metrics', registry)
+    monkeypatch.setattr(rate_limiter, '_buckets', {})
+    registry.configure(str(tmp_path / 'metrics'))
+    yield registry
+    registry.close()
+
+
+def test_download_and_trigger_recorded(hub, api, registry, tmp_path):
+    online, offline = hub.products.values()
+    offline.online = False
+    download_pool(api, [online.uuid, offline.uuid], str(tmp_path), workers=2)
+    registry.close()
+
+    counters = registry.counters
+    assert counters[('downloads_total', (('result', 'done'),))] == 1
+    assert counters[('downloads_total', (('result', 'triggered'),))] == 1
+    assert counters[('triggers_total', (('result', 'accepted'),))] == 1
+    assert counters[('transfer_bytes_total', ())] == online.size
+
+    with open(str(tmp_path / 'metrics.prom')) as f:
+        prom = f.read()
+    assert '# TYPE scihub_transfer_seconds summary' in prom
+    assert 'scihub_stage_seconds_count{stage="checksum"}' in prom
+    assert 'scihub_downloads_total{result="done"} 1' in prom
+
+    with open(str(tmp_path / 'metrics.jsonl')) as f:
+        events = [json.loads(line) for line in f]
+    assert sorted(e['event'] for e in events) == ['download', 'trigger']
+    download = next(e for e in events if e['event'] == 'download')
+    assert download['id'] == online.uuid and download['bytes'] == online.size
+
+
+def test_served_over_http():
+    registry = Metrics()
+    registry.inc('triggers_total', result='quota')
+    registry.observe('trigger_seconds', 0.25)
+    registry.serve(0)
+    try:
+        with urlopen(f"http://127.0.0.1:{registry._server.server_port}/metrics") as r:
+            text = r.read().decode()
+    finally:
+        registry.close()
+    assert 'scihub_triggers_total{result="quota"} 1' in text
+    assert 'scihub_trigger_seconds_sum 0.250000' in text
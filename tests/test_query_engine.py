@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Time windows and cached pages of query_engine.py against the mock hub.
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from sentinelsat import SentinelAPI
+from mock_dhus import MockDHuS
+from query_engine import QueryEngine, parse_date
+
+
+START = '2017-01-01T00:00:00.000Z'
+END = '2017-01-31T23:59:59.999Z'
+
+
+@pytest.fixture(scope='module')
+def query_hub():
+    """Mock hub with 30 products, one every 12 hours from 1 January 2017."""
+    mock = MockDHuS(n_products=30, size=2 ** 10)
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def query_api(query_hub):
+    query_hub.reset_stats()
+    return SentinelAPI('user', 'password', query_hub.url, show_progressbars=False)
+
+
+def engine(api, cachedir=None, **kwargs):
+    return QueryEngine(api, cachedir, window=timedelta(days=10), page_size=4,
+                       **kwargs)
+
+
+def test_windows_on_a_fixed_grid():
+    qe = QueryEngine(None, window=timedelta(days=10))
+    now = datetime(2017, 3, 1)
+    windows = qe.windows('NOW-45DAYS', 'NOW', now)
+    later = qe.windows('NOW-45DAYS', 'NOW', now + timedelta(days=3))
+    # A moving date range reuses the complete windows of the earlier range
+    assert set(windows[2:-1]) <= set(later)
+    starts = [parse_date(w[0]) for w in windows[1:]]
+    assert all((t - datetime(2014, 1, 1)) % timedelta(days=10) == timedelta(0)
+               for t in starts)
+    # Only windows that ended more than 30 days ago are stable
+    assert [stable for _, _, stable in windows] == [True] + 4 * [False]
+
+
+def test_all_products_in_order(query_hub, query_api):
+    products = list(engine(query_api).products(None, START, END))
+    assert [pid for pid, _ in products] == list(query_hub.products)
+    begin = [properties['beginposition'] for _, properties in products]
+    assert begin == sorted(begin)
+
+
+def test_stable_windows_read_from_the_cache(query_hub, query_api, tmp_path):
+    cachedir = str(tmp_path / 'cache')
+    first = list(engine(query_api, cachedir).products(None, START, END))
+    queries = query_hub.stats['queries']
+    assert queries > 0
+
+    second = list(engine(query_api, cachedir).products(None, START, END))
+    assert second == first
+    assert query_hub.stats['queries'] == queries
+
+
+def test_recent_windows_fetched_again(query_hub, query_api, tmp_path):
+    cachedir = str(tmp_path / 'cache')
+    # All windows are recent, their cache is used for an hour
+    recent = dict(recent=timedelta(days=100 * 365), recent_ttl=60 * 60)
+    list(engine(query_api, cachedir, **recent).products(None, START, END))
+    queries = query_hub.stats['queries']
+    list(engine(query_api, cachedir, **recent).products(None, START, END))
+    assert query_hub.stats['queries'] == queries
+
+    recent['recent_ttl'] = 0
+    list(engine(query_api, cachedir, **recent).products(None, START, END))
+    assert query_hub.stats['queries'] == 2 * queries
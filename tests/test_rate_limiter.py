@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+LTA triggers of rate_limiter.py against the mock hub: online products are
+not triggered, quota errors (HTTP 403) back off. Refill and backoff of the
+token bucket.
+"""
+
+import pytest
+
+from sentinelsat import SentinelAPI, SentinelAPILTAError
+from mock_dhus import MockDHuS
+from rate_limiter import TokenBucket, is_quota_error, trigger_retrieval
+
+
+@pytest.fixture
+def lta_hub():
+    """Mock hub with offline products and a quota of 1 trigger per minute."""
+    mock = MockDHuS(n_products=3, size=2 ** 20, offline_ratio=1.,
+                    restore_latency=60., quota=(1, 60.))
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def lta_api(lta_hub):
+    return SentinelAPI('user', 'password', lta_hub.url, show_progressbars=False)
+
+
+def test_online_product_is_not_triggered(lta_hub, lta_api):
+    product = next(iter(lta_hub.products.values()))
+    product.online = True
+    limiter = TokenBucket(1.)
+
+    info = trigger_retrieval(lta_api, product.uuid, limiter)
+    assert info['Online']
+    assert lta_hub.stats['triggers'] == 0
+    assert lta_hub.stats['downloads'] == 0
+    assert limiter.try_acquire()
+
+
+def test_offline_product_is_triggered(lta_hub, lta_api):
+    product = next(iter(lta_hub.products.values()))
+    info = trigger_retrieval(lta_api, product.uuid, TokenBucket(1.))
+    assert not info['Online']
+    assert lta_hub.stats['triggers'] == 1
+    assert lta_hub.stats['downloads'] == 0
+
+
+def test_quota_error_backs_off(lta_hub, lta_api):
+    # The bucket is looser than the quota of the server
+    limiter = TokenBucket(10., capacity=2)
+    first, second, _ = lta_hub.products.values()
+    trigger_retrieval(lta_api, first.uuid, limiter, block=False)
+
+    with pytest.raises(SentinelAPILTAError) as e:
+        trigger_retrieval(lta_api, second.uuid, limiter, block=False)
+    assert is_quota_error(e.value)
+    assert lta_hub.stats['quota_errors'] == 1
+    assert limiter.next_slot() > 0
+    assert not limiter.try_acquire()
+
+
+def test_bucket_refills_at_the_quota_rate():
+    limiter = TokenBucket.from_quota(2, 0.2)
+    assert limiter.try_acquire() and limiter.try_acquire()
+    assert not limiter.try_acquire()
+    assert 0 < limiter.next_slot() <= 0.1
+
+    limiter.refund()
+    assert limiter.try_acquire()
+    assert limiter.acquire(block=True)
+
+
+def test_backoff_doubles_until_success():
+    limiter = TokenBucket(100., max_rate=200.)
+    limiter.penalize()
+    first = limiter.next_slot()
+    limiter.penalize()
+    assert limiter.next_slot() > 1.5 * first
+
+    # A success resets the backoff and probes a higher rate
+    limiter.success()
+    assert limiter.backoff == 1. / 100.
+    assert limiter.rate == 125.
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Extraction of selected files of SAFE products (safe_extract.py) from the
+zips of the mock hub, with Range requests and from the stream.
+"""
+
+import os
+import zipfile
+from io import BytesIO
+
+import pytest
+
+import dwn_engine
+from sentinelsat import SentinelAPI
+from mock_dhus import MockDHuS
+from safe_extract import ExtractSink
+
+
+PATTERNS = ['manifest.safe', 'annotation/*-vv-*.xml']
+
+
+@pytest.fixture
+def safe_hub():
+    """Mock hub with a SAFE zip of about 4 MB."""
+    mock = MockDHuS(n_products=1, size=4 * 2 ** 20, offline_ratio=0., safe=True)
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def safe_api(safe_hub):
+    return SentinelAPI('user', 'password', safe_hub.url, show_progressbars=False)
+
+
+def selected_members(product):
+    """Paths within the SAFE folder and data of the selected members."""
+    members = {}
+    with zipfile.ZipFile(BytesIO(product.data)) as zf:
+        for name in zf.namelist():
+            rel = name.split('/', 1)[1]
+            if rel == 'manifest.safe' or (rel.startswith('annotation/')
+                                          and '-vv-' in rel):
+                members[rel] = zf.read(name)
+    return members
+
+
+def extracted_files(folder):
+    files = {}
+    for root, _, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, folder).replace(os.sep, '/')] = f.read()
+    return files
+
+
+def test_members_read_with_range_requests(safe_hub, safe_api, tmp_path):
+    product = next(iter(safe_hub.products.values()))
+    sink = ExtractSink(str(tmp_path), PATTERNS)
+    info = dwn_engine.download(safe_api, product.uuid, sink)
+
+    folder = os.path.join(str(tmp_path), product.title + '.SAFE')
+    assert extracted_files(folder) == selected_members(product)
+    assert not os.path.exists(os.path.join(str(tmp_path), product.title + '.zip'))
+    # Only the central directory and the XML members were downloaded, not
+    # the measurements
+    assert info['downloaded_bytes'] < product.size / 4
+    assert safe_hub.stats['bytes'] == info['downloaded_bytes']
+
+
+def test_members_extracted_from_the_stream(safe_hub, safe_api, tmp_path):
+    product = next(iter(safe_hub.products.values()))
+    sink = ExtractSink(str(tmp_path), PATTERNS, remote=False)
+    info = dwn_engine.download(safe_api, product.uuid, sink)
+
+    folder = os.path.join(str(tmp_path), product.title + '.SAFE')
+    assert extracted_files(folder) == selected_members(product)
+    assert info['downloaded_bytes'] == product.size
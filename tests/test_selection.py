@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Selection of the products from the query results of the mock hub
+(selection.py).
+"""
+
+from collections import OrderedDict
+from datetime import timedelta
+
+import numpy as np
+import pytest
+
+from shapely.geometry import box
+from sentinelsat import SentinelAPI
+from mock_dhus import MockDHuS
+import selection
+
+
+AOIS = [('aoi', box(13.5, 44.5, 15.0, 45.5))]
+
+
+@pytest.fixture(scope='module')
+def results():
+    """Query results of a mock hub with 20 frames over the AOI."""
+    mock = MockDHuS(n_products=20, size=2 ** 10, offline_ratio=0.)
+    mock.start()
+    api = SentinelAPI('user', 'password', mock.url, show_progressbars=False)
+    products = api.query(platformname='Sentinel-1')
+    mock.stop()
+    return products
+
+
+def test_min_coverage(results):
+    selected = selection.select_products(results, AOIS, min_coverage=0.2)
+    assert 0 < len(selected) < len(results)
+    assert all(p['coverage'] >= 0.2 for p in selected.values())
+    # The order of the query results is kept
+    assert list(selected) == [pid for pid in results if pid in selected]
+
+
+def test_coverage_without_vectorized_shapely(results, monkeypatch):
+    """The per-product path (shapely < 2.0) selects the same products."""
+    footprints = [p['footprint'] for p in results.values()]
+    criteria = dict(min_coverage=0.2, best_per_pass=True)
+    vectorized = selection.coverage(footprints, AOIS)
+    fast = selection.select_products(results, AOIS, **criteria)
+
+    monkeypatch.setattr(selection, 'from_wkt', None)
+    np.testing.assert_allclose(selection.coverage(footprints, AOIS), vectorized)
+    slow = selection.select_products(results, AOIS, **criteria)
+    assert list(slow) == list(fast)
+
+
+def test_relative_orbits(results):
+    df = selection.to_dataframe(results.items())
+    orbits = sorted(df['relativeorbitnumber'].unique())[:3]
+    selected = selection.select(df, relative_orbits=orbits)
+    assert set(selected['relativeorbitnumber']) == set(orbits)
+    assert len(selected) == df['relativeorbitnumber'].isin(orbits).sum()
+
+
+def variant(results, uuid, **changes):
+    """Query results with a copy of the first product under a new UUID."""
+    products = OrderedDict((pid, dict(p)) for pid, p in results.items())
+    first = next(iter(products.values()))
+    products[uuid] = dict(first, uuid=uuid, **changes)
+    return products
+
+
+def test_reprocessed_products(results):
+    first = next(iter(results.values()))
+    products = variant(results, 'reprocessed',
+                       title=first['title'][:-len('MOCK')] + 'A1B2',
+                       ingestiondate=first['ingestiondate'] + timedelta(days=30))
+    # All products are kept unless the criterion is set
+    assert list(selection.select_products(products.items())) == list(products)
+
+    selected = selection.select_products(products.items(), drop_reprocessed=True)
+    assert first['uuid'] not in selected and 'reprocessed' in selected
+    assert len(selected) == len(results)
+
+
+def test_polarisation_and_size(results):
+    first = next(iter(results.values()))
+    products = variant(results, 'single',
+                       title=first['title'].replace('_1SDV_', '_1SSV_'),
+                       size='7.90 GB')
+    selected = selection.select_products(products.items(), polarisation='VV VH')
+    assert list(selected) == list(results)
+    selected = selection.select_products(products.items(), max_size='5 GB')
+    assert list(selected) == list(results)
+    selected = selection.select_products(products.items(), polarisation='VV')
+    assert list(selected) == ['single']
+
+
+def test_best_frame_per_pass(results):
+    first = next(iter(results.values()))
+    # Another frame of the same pass, covering less of the AOI
+    products = variant(results, 'corner', title=first['title'][:-len('MOCK')] + 'C0C0',
+                       footprint=box(14.9, 44.0, 17.0, 45.6).wkt)
+    selected = selection.select_products(products.items(), AOIS, best_per_pass=True)
+    assert 'corner' not in selected and first['uuid'] in selected
+    selected = selection.select_products(products.items(), AOIS)
+    assert selected['corner']['coverage'] < selected[first['uuid']]['coverage']
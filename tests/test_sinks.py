@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Streamed downloads into the sinks of sinks.py: a folder on a file share and
+an S3 object store (a local moto server, the tests are skipped without the
+moto package).
+"""
+
+import hashlib
+import os
+import socket
+
+import pytest
+import requests
+
+import dwn_engine
+from mock_dhus import MockDHuS
+from sentinelsat import SentinelAPI
+from sinks import MIN_PART_SIZE, S3Sink, ShareSink
+
+
+BUCKET = 'sentinel'
+
+
+@pytest.fixture
+def product(hub):
+    return next(iter(hub.products.values()))
+
+
+@pytest.fixture
+def large_hub():
+    """Mock hub with a product of three multipart upload parts."""
+    mock = MockDHuS(n_products=1, size=2 * MIN_PART_SIZE + 2 ** 20, offline_ratio=0.)
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def large_api(large_hub):
+    return SentinelAPI('user', 'password', large_hub.url, show_progressbars=False)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """S3 client of a local moto server with an empty bucket."""
+    server_module = pytest.importorskip('moto.server')
+    boto3 = pytest.importorskip('boto3')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = server_module.ThreadedMotoServer(ip_address='127.0.0.1', port=port,
+                                              verbose=False)
+    server.start()
+    endpoint = f"http://127.0.0.1:{port}"
+    monkeypatch.setenv('S3_ENDPOINT_URL', endpoint)
+    client = boto3.client('s3', endpoint_url=endpoint)
+    # The buckets of moto are kept in the process, start with none
+    requests.post(endpoint + '/moto-api/reset')
+    client.create_bucket(Bucket=BUCKET)
+    yield client
+    server.stop()
+
+
+def test_s3_multipart_upload(large_hub, large_api, s3):
+    product = next(iter(large_hub.products.values()))
+    sink = S3Sink(BUCKET, 'S1_SLC', part_size=MIN_PART_SIZE)
+    name = product.title + '.zip'
+    assert not sink.exists(name)
+
+    info = dwn_engine.download(large_api, product.uuid, sink)
+    obj = s3.get_object(Bucket=BUCKET, Key='S1_SLC/' + name)
+    assert hashlib.md5(obj['Body'].read()).hexdigest() == product.md5
+    # ETag of a multipart upload: MD5 of the part ETags and the part count
+    assert obj['ETag'].strip('"').endswith('-3')
+    assert info['path'] == f"s3://{BUCKET}/S1_SLC/{name}"
+    assert sink.exists(name)
+    assert list(sink.paths()) == [info['path']]
+    assert not s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads')
+
+
+def test_s3_upload_aborted_on_failure(large_hub, large_api, s3):
+    product = next(iter(large_hub.products.values()))
+    sink = S3Sink(BUCKET, 'S1_SLC', part_size=MIN_PART_SIZE)
+    large_hub.cut_ratio = 1.
+    with pytest.raises(Exception):
+        dwn_engine.download(large_api, product.uuid, sink)
+    assert 'Contents' not in s3.list_objects_v2(Bucket=BUCKET)
+    assert not s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads')
+    assert not sink.exists(product.title + '.zip')
+
+
+def test_s3_small_upload(hub, api, product, s3):
+    """A product smaller than one part is uploaded as a single part."""
+    sink = S3Sink(BUCKET)
+    info = dwn_engine.download(api, product.uuid, sink)
+    obj = s3.get_object(Bucket=BUCKET, Key=product.title + '.zip')
+    assert hashlib.md5(obj['Body'].read()).hexdigest() == product.md5
+    assert info['path'] == f"s3://{BUCKET}/{product.title}.zip"
+
+
+def test_s3_exists_raises_other_errors(s3):
+    from botocore.stub import Stubber
+    sink = S3Sink(BUCKET)
+    with Stubber(sink.client) as stubber:
+        stubber.add_client_error('head_object', service_error_code='403',
+                                 http_status_code=403)
+        with pytest.raises(Exception) as e:
+            sink.exists('product.zip')
+    assert e.value.response['Error']['Code'] == '403'
+
+
+def test_s3_part_size_minimum():
+    with pytest.raises(ValueError):
+        S3Sink(BUCKET, part_size=2 ** 20, client=object())
+
+
+def test_share_download_resumes(hub, api, product, tmp_path):
+    sink = ShareSink(str(tmp_path), block_size=2 ** 20)
+    path = os.path.join(str(tmp_path), product.title + '.zip')
+
+    hub.cut_ratio = 1.
+    with pytest.raises(Exception):
+        dwn_engine.download(api, product.uuid, sink)
+    kept = os.path.getsize(path + '.incomplete')
+    assert kept > 0
+
+    hub.cut_ratio = 0.
+    info = dwn_engine.download(api, product.uuid, sink)
+    assert info['downloaded_bytes'] == product.size - kept
+    with open(path, 'rb') as f:
+        assert hashlib.md5(f.read()).hexdigest() == product.md5
+    assert not os.path.exists(path + '.incomplete')
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Statuses and journal of the products in state_store.py and the claims of
+products shared by several downloaders (leases).
+"""
+
+import time
+
+import pandas as pd
+import pytest
+
+from state_store import LeaseLostError, StateStore
+
+
+UUID = 'c0ffee00-0000-0000-0000-000000000001'
+
+
+@pytest.fixture
+def store(tmp_path):
+    csvpath = str(tmp_path / 'slc_list.csv')
+    pd.DataFrame({'uuid': [UUID], 'title': ['S1A_IW_SLC__MOCK'],
+                  'downloaded': [False]}).to_csv(csvpath, index=False)
+    store = StateStore.from_csv(csvpath)
+    yield store
+    store.close()
+
+
+def write_list(csvpath, rows):
+    pd.DataFrame(rows, columns=['uuid', 'title', 'downloaded']).to_csv(csvpath,
+                                                                      index=False)
+
+
+def test_import_keeps_the_status(store, tmp_path):
+    assert store.transition(UUID, 'triggered', 'queued')
+    csvpath = str(tmp_path / 'slc_list.csv')
+    other = 'c0ffee00-0000-0000-0000-000000000002'
+    write_list(csvpath, [(UUID, 'S1A_IW_SLC__MOCK', False),
+                         (other, 'S1A_IW_SLC__OTHER', False)])
+    assert store.import_csv(csvpath) == 1
+    assert store.products() == [(UUID, 'S1A_IW_SLC__MOCK', 'triggered'),
+                                (other, 'S1A_IW_SLC__OTHER', 'queued')]
+
+    # Products downloaded by hand are marked in the CSV list
+    write_list(csvpath, [(UUID, 'S1A_IW_SLC__MOCK', True),
+                         (other, 'S1A_IW_SLC__OTHER', False)])
+    assert store.import_csv(csvpath) == 0
+    assert store.status(UUID) == 'done'
+    assert store.changes('done', 60, 'triggered') == 1
+
+
+def test_transition_from_expected_status(store):
+    assert store.transition(UUID, 'triggered', ('queued', 'failed'))
+    assert not store.transition(UUID, 'triggered', ('queued', 'failed'))
+    assert store.status(UUID) == 'triggered'
+    with pytest.raises(ValueError):
+        store.transition(UUID, 'lost')
+    with pytest.raises(KeyError):
+        store.transition('c0ffee00-0000-0000-0000-00000000ffff', 'done')
+    assert store.changes('triggered', 60) == 1
+
+
+def test_one_process_wins_a_transition(store):
+    other = StateStore(store.dbpath)
+    assert other.transition(UUID, 'triggered', 'queued')
+    assert not store.transition(UUID, 'triggered', 'queued')
+    assert store.status(UUID) == 'triggered'
+    other.close()
+
+
+def test_export_csv(store, tmp_path):
+    store.transition(UUID, 'done')
+    csvpath = str(tmp_path / 'export.csv')
+    store.export_csv(csvpath)
+    dwnfil = pd.read_csv(csvpath)
+    assert list(dwnfil.columns) == ['uuid', 'title', 'downloaded']
+    assert dwnfil['downloaded'].tolist() == [True]
+
+
+def expire(store, owner):
+    """Claim the product with a lease that has already run out."""
+    assert store.claim(UUID, owner, lease=0.01)
+    time.sleep(0.05)
+
+
+def test_second_owner_cannot_claim(store):
+    assert store.claim(UUID, 'host-a:1')
+    assert not store.claim(UUID, 'host-b:2')
+    assert store.owners() == {UUID: 'host-a:1'}
+
+
+def test_claim_taken_over_after_lease_expires(store):
+    expire(store, 'host-a:1')
+    assert store.claim(UUID, 'host-b:2')
+    assert store.owners() == {UUID: 'host-b:2'}
+    assert store.status(UUID) == 'downloading'
+
+
+def test_reclaim_expired_lease(store):
+    expire(store, 'host-a:1')
+    assert store.reclaim() == [UUID]
+    assert store.status(UUID) == 'online'
+    assert store.owners() == {}
+
+
+def test_heartbeat_after_lease_lost(store):
+    expire(store, 'host-a:1')
+    assert store.claim(UUID, 'host-b:2')
+    assert not store.heartbeat(UUID, 'host-a:1')
+
+    with store.lease(UUID, 'host-a:1') as lease:
+        with pytest.raises(LeaseLostError):
+            lease.check(renew=True)
+    assert store.owners() == {UUID: 'host-b:2'}
+
+
+def test_release_after_lease_lost(store):
+    expire(store, 'host-a:1')
+    assert store.claim(UUID, 'host-b:2')
+
+    assert not store.release(UUID, 'failed', 'host-a:1')
+    assert store.status(UUID) == 'downloading'
+    assert store.owners() == {UUID: 'host-b:2'}
+
+    assert store.release(UUID, 'done', 'host-b:2')
+    assert store.status(UUID) == 'done'
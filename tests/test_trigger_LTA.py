@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+trigger_LTA.py against the mock hub: products triggered again, order of the
+priority queue and the admission of triggers (trigger_policy.py).
+"""
+
+import pandas as pd
+import pytest
+
+import credentials
+import rate_limiter
+import trigger_LTA
+from mock_dhus import MockDHuS
+from state_store import StateStore
+from trigger_policy import TriggerPolicy
+
+
+@pytest.fixture
+def lta_hub():
+    """Mock hub with offline products."""
+    mock = MockDHuS(n_products=4, size=2 ** 20, offline_ratio=1., quota=(10, 1.))
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def session(lta_hub, tmp_path, monkeypatch):
+    """Write the list of products (with extra columns), return the paths."""
+    monkeypatch.setattr(credentials, 'API_URL', lta_hub.url)
+    monkeypatch.setattr(rate_limiter, '_buckets', {})
+    apipath = str(tmp_path / 'apihub.txt')
+    with open(apipath, 'w') as f:
+        f.write('user password\n')
+    csvpath = str(tmp_path / 'slc_list.csv')
+
+    def write_list(**columns):
+        products = list(lta_hub.products.values())
+        pd.DataFrame(dict({'uuid': [p.uuid for p in products],
+                           'title': [p.title for p in products],
+                           'downloaded': False}, **columns)).to_csv(csvpath, index=False)
+        return csvpath, str(tmp_path / 'trigger.log'), apipath
+
+    return write_list
+
+
+def test_evicted_online_product_is_triggered_again(lta_hub, session):
+    csvpath, logpath, apipath = session()
+    products = list(lta_hub.products.values())
+
+    # The first product was online in an earlier session
+    store = StateStore.from_csv(csvpath)
+    store.transition(products[0].uuid, 'online')
+    store.close()
+
+    trigger_LTA.main(csvpath, logpath, apipath, (10, 1.))
+
+    store = StateStore.from_csv(csvpath)
+    assert all(store.status(p.uuid) == 'triggered' for p in products)
+    store.close()
+    assert lta_hub.stats['triggers'] == 4
+
+
+def test_triggered_by_priority_and_deadline(lta_hub, session):
+    # The last product has the highest priority, the third one the earliest
+    # deadline
+    csvpath, logpath, apipath = session(
+        priority=[0, 0, 0, 1],
+        deadline=[None, '2030-01-05T00:00:00.000Z', '2030-01-01T00:00:00.000Z', None]
+    )
+    products = list(lta_hub.products.values())
+
+    # Only 2 products in flight until the download rate is known
+    trigger_LTA.main(csvpath, logpath, apipath, (10, 1.), None, 2)
+
+    store = StateStore.from_csv(csvpath)
+    assert [store.status(p.uuid) for p in products] == [
+        'queued', 'queued', 'triggered', 'triggered']
+    store.close()
+    assert lta_hub.stats['triggers'] == 2
+
+
+def test_policy_follows_the_download_rate(session):
+    csvpath, _, _ = session()
+    store = StateStore.from_csv(csvpath)
+    policy = TriggerPolicy(store, online_window=60., rate_window=60.,
+                           min_in_flight=1, margin=1.)
+    first, second, third, fourth = [row[0] for row in store.products()]
+    store.transition(first, 'triggered')
+    assert not policy.admit()
+
+    # 2 downloads within the last minute drain 2 products per online window
+    for product_id in (second, third):
+        store.transition(product_id, 'downloading')
+        store.transition(product_id, 'done')
+    assert policy.limit() == 2
+    assert policy.admit()
+    store.transition(fourth, 'triggered')
+    assert not policy.admit()
+    store.close()
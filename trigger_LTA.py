@@ -14,19 +14,36 @@ to False, the file has to be retrieved from LTA before starting the download.
 
 The program loops through a list of products provided through a CSV file. For
 each product, the program first checks the 'Online' status and triggers its
-retrieval if false. It waits 31 min before starting the retrieval of the next
-product.
+retrieval if false. The status of all remaining products is checked in batches
+(see lta_status.py) instead of one request per product. Triggers are limited
+by a token bucket filled at the quota rate (see rate_limiter.py), so the program
+only waits when the quota is used up and backs off when the server reports
+that the quota was exceeded. The status of the products is kept in a state
+store next to the CSV file (see state_store.py), which download_LTA.py can use
+at the same time.
+
+Products are triggered in the order of the priority queue of the state store
+(priority, deadline, order of the CSV list). Only as many products are
+triggered as the downloads can drain while they are online (see
+trigger_policy.py), the rest stays queued for the next session. Products that
+are already online (also those that come online just before their trigger)
+are only marked for download, they are downloaded by download_LTA.py.
 """
 
 import logging
 from datetime import datetime
-import pandas as pd
 import sys
-from sentinelsat import SentinelAPI, SentinelAPILTAError
-from time import sleep
+from sentinelsat import SentinelAPILTAError
+from lta_status import StatusPoller
+from state_store import StateStore
+from rate_limiter import trigger_retrieval, QUOTA_REQUESTS, QUOTA_PERIOD
+from credentials import CredentialPool
+from trigger_policy import TriggerPolicy
+from metrics import metrics
 
 
-def main(csvpath, logpath, apipath):
+def main(csvpath, logpath, apipath, quota=(QUOTA_REQUESTS, QUOTA_PERIOD),
+         metpath=None, min_in_flight=10):
     # Configure file for logging
     # ===========================
     logging.basicConfig(filename=logpath,
@@ -37,82 +54,112 @@ def main(csvpath, logpath, apipath):
         f.write(loghead)
     logging.info("Started trigger_LTA.py")
 
-    # Read password file
-    # ==================
+    # Timings and counters of all stages (see metrics.py)
+    metrics.configure(metpath)
+
+    # Read password file (one or more accounts)
+    # ==========================================
     try:
-        with open(apipath) as f:
-            (usrnam, psswrd) = f.readline().split(" ")
-            if psswrd.endswith("\n"):
-                psswrd = psswrd[:-1]
+        pool = CredentialPool.from_file(apipath, quota=quota)
     except IOError:
         logging.error("Error reading the password file!")
         sys.exit("Error reading the password file!")
 
     # Connect to API using <username> and <password>
     # ==============================================
-    print("Connecting to SciHub API...")
-    api = SentinelAPI(usrnam, psswrd, "https://scihub.copernicus.eu/dhus")
+    print(f"Connecting to SciHub API with {len(pool)} account(s)...")
+    api = pool.api
 
     # Read CSV file
     # ==============
     try:
-        dwnfil = pd.read_csv(csvpath)
+        store = StateStore.from_csv(csvpath)
+        pool.attach_store(store)
         print(f"Import CSV file: {csvpath}")
         logging.info(f"Import CSV file: {csvpath}")
     except IOError:
         logging.info("Error reading the CSV file!")
         sys.exit("Error reading the CSV file!")
-    print(f"Found {dwnfil.shape[0]} products.")
-    logging.info(f"Found {dwnfil.shape[0]} products.")
+    products = store.queue()
+    print(f"Found {len(products)} products.")
+    logging.info(f"Found {len(products)} products.")
 
     # Trigger LTA retrieval
     # ======================
-    product_ids = list(dwnfil['uuid'])
+    # Triggers are limited by the quota of each account, the account whose
+    # next trigger slot opens first is used (and later downloads the product)
+
+    # The 'Online' status is checked for all remaining products at once
+    poller = StatusPoller(api)
+
+    # Products are only triggered while the downloads can keep up
+    policy = TriggerPolicy(store, min_in_flight=min_in_flight)
+    admitted = True
 
     f_skip = 0
     f_trig = 0
-    for i, product_id in enumerate(product_ids):
-        current_file = api.get_product_odata(product_id)
-        logging.info(f"     Next file: {current_file['title']}")
+    f_wait = 0
+    for i, (product_id, title, _) in enumerate(products):
+        logging.info(f"     Next file: {title}")
         logging.info(f"     File uuid: {product_id}")
-        print(f"Product {i+1}/{len(product_ids)}: {current_file['title']}")
-        if not dwnfil['downloaded'].get(i):
-            if not current_file['Online']:
-                # Trigger retrieval from LTA
+        print(f"Product {i+1}/{len(products)}: {title}")
+        # Status is read again, the list can be processed by download_LTA.py
+        # at the same time
+        if store.status(product_id) not in ('done', 'downloading'):
+            pending = [
+                row[0] for row in products[i:]
+                if row[2] not in ('done', 'downloading')
+            ]
+            if not poller.get(pending).get(product_id, False):
+                admitted = admitted and policy.admit()
+                if not admitted:
+                    f_wait += 1
+                    continue
+                if policy.overdue(product_id):
+                    logging.warning(f"Deadline of {title} has passed")
+                # Trigger retrieval from LTA (waits for a free trigger slot)
+                account = pool.trigger_account()
+                wait = account.limiter.next_slot()
+                if wait > 0:
+                    logging.info(f"Waiting {wait / 60:.0f} min before triggering next file")
                 try:
-                    api.download(product_id)
-                    f_trig += 1
+                    product_info = trigger_retrieval(account.api, product_id,
+                                                     limiter=account.limiter)
+                    pool.assign(product_id, account)
+                    if product_info['Online']:
+                        # Came online in the meantime, not triggered
+                        f_skip += 1
+                        store.transition(product_id, 'online', ('queued', 'triggered', 'failed'))
+                        logging.info("File came online before the trigger")
+                    else:
+                        f_trig += 1
+                        # Also products that were online and went back to the LTA
+                        store.transition(product_id, 'triggered',
+                                         ('queued', 'triggered', 'online', 'failed'))
                 except (KeyboardInterrupt, SystemExit):
                     raise
-                except SentinelAPILTAError as e:
-                    # Retry if user quota exceeded, else log error and go to next file
-                    if e.msg == "Requests for retrieval from LTA exceed user quota":
-                        logging.info("Waiting 31 min before retrying")
-                        sleep(31 * 60)
-                        try:
-                            api.download(product_id)
-                            f_trig += 1
-                        except (KeyboardInterrupt, SystemExit):
-                            raise
-                        except SentinelAPILTAError:
-                            logging.info(f"There was an error retrieving {product_id} from the LTA")
-                    else:
-                        logging.info(f"There was an error retrieving {product_id} from the LTA")
-                # Wait 31 min after a successful trigger
-                logging.info("Waiting 31 min before triggering next file\n")
-                sleep(31*60)
+                except SentinelAPILTAError:
+                    logging.info(f"There was an error retrieving {product_id} from the LTA")
             else:
                 f_skip += 1
+                store.transition(product_id, 'online', ('queued', 'triggered', 'failed'))
                 print("File already online")
                 logging.info("File already online")
         else:
             logging.info("File already downloaded")
 
+    # Update the CSV file
+    store.export_csv(csvpath)
+    store.close()
+    metrics.close()
+
     # End message
     # ============
     print("---------  Session finished  ---------")
     logging.info("   FINISHED!")
     logging.info(f"{f_trig} files retrieved, {f_skip} files skipped")
+    if f_wait:
+        logging.info(f"{f_wait} files left in the queue, the downloads are behind")
     logging.shutdown()
 
 
@@ -126,4 +173,15 @@ if __name__ == "__main__":
     # Path to file with SciHub credentials
     api_pth = ".\\userfiles\\apihub.txt"
 
-    main(csv_pth, log_pth, api_pth)
+    # LTA quota of the account: number of triggers per period (in seconds)
+    lta_quota = (1, 31 * 60)
+
+    # Path (without extension) of the metrics files (.prom and .jsonl)
+    met_pth = ".\\userfiles\\metrics_trigger"
+
+    # Number of products that may always be triggered but not yet downloaded
+    # (more are triggered once the download rate is known, see
+    # trigger_policy.py)
+    min_flight = 10
+
+    main(csv_pth, log_pth, api_pth, lta_quota, met_pth, min_flight)
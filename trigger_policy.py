@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+@copyright: ZRC SAZU (Novi trg 2, 1000 Ljubljana, Slovenia)
+
+Policy for triggering products from the LTA (used by trigger_LTA.py and
+lta_scheduler.py).
+
+A product restored from the LTA stays online for a limited time (3 days at
+the time of writing) and has to be triggered again if it is not downloaded
+by then. Triggering the whole list as fast as the quota allows therefore
+wastes triggers when the downloads are slower than the triggers. The policy:
+    - products are triggered in the order of the priority queue of the state
+      store (priority, deadline, order of the CSV list)
+    - a new product is only triggered while the number of products in flight
+      (triggered or online, not yet downloaded) is lower than the number of
+      products the downloads can drain within the online window
+    - the download rate is measured from the journal of the state store
+      (downloads finished within `rate_window`); until there is enough
+      history, at most `min_in_flight` products are in flight
+"""
+
+import logging
+
+from datetime import datetime
+from metrics import metrics
+
+
+# Time a restored product stays online
+ONLINE_WINDOW = 3 * 24 * 60 * 60
+
+
+class TriggerPolicy:
+    """Admission of new LTA triggers.
+
+    Parameters
+    ----------
+    store : StateStore
+        State of the products (see state_store.py).
+    online_window : float
+        Seconds a restored product stays online.
+    rate_window : float
+        Seconds of the journal used to measure the download rate.
+    min_in_flight : int
+        Products that are always allowed in flight (e.g. at the start).
+    max_in_flight : int, optional
+        Upper limit of products in flight.
+    margin : float
+        Share of the online window that is used for planning (the rest is
+        left for the restore time and for retries).
+    """
+
+    def __init__(self, store, online_window=ONLINE_WINDOW, rate_window=24 * 60 * 60,
+                 min_in_flight=10, max_in_flight=None, margin=0.5):
+        self.store = store
+        self.online_window = online_window
+        self.rate_window = rate_window
+        self.min_in_flight = min_in_flight
+        self.max_in_flight = max_in_flight
+        self.margin = margin
+
+    def download_rate(self):
+        """Products downloaded per second (measured over `rate_window`)."""
+        # Only finished downloads, not products marked as done by the import
+        # of the CSV list
+        done = self.store.changes('done', self.rate_window, from_status='downloading')
+        return done / self.rate_window
+
+    def in_flight(self):
+        """Number of triggered or online products not yet downloaded."""
+        counts = self.store.counts()
+        return sum(counts.get(status, 0) for status in ('triggered', 'online', 'downloading'))
+
+    def limit(self):
+        """Number of products that can be in flight."""
+        drained = int(self.download_rate() * self.online_window * self.margin)
+        limit = max(self.min_in_flight, drained)
+        if self.max_in_flight is not None:
+            limit = min(limit, self.max_in_flight)
+        metrics.set('trigger_in_flight_limit', limit)
+        return limit
+
+    def admit(self):
+        """True if one more product can be triggered."""
+        in_flight = self.in_flight()
+        limit = self.limit()
+        metrics.set('trigger_in_flight', in_flight)
+        if in_flight >= limit:
+            logging.info(f"{in_flight} products in flight, the downloads can drain "
+                         f"{limit} within the online window: not triggering")
+            return False
+        return True
+
+    def overdue(self, product_id):
+        """True if the deadline of a product has passed."""
+        deadline = self.store.deadline(product_id)
+        return deadline is not None and deadline < datetime.utcnow()